@@ -8,26 +8,37 @@ for _v in ("HTTP_PROXY","HTTPS_PROXY","ALL_PROXY","http_proxy","https_proxy","al
 os.environ["NO_PROXY"] = "api.telegram.org,telegram.org,*"
 
 # --- базовые импорты ---
+import atexit
 import base64
+import copy
 import json
 import logging
+import logging.handlers
 import mimetypes
+import queue
 import random
 import re
+import signal
+import sys
 import threading
 import time
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Optional, Pattern
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Pattern, Set
 
-from db_adapter import get_store
+from db_adapter import COUNTER_COLUMNS, get_store
 store = get_store()
 
 # --- сети/бот ---
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 requests.sessions.Session.trust_env = False  # игнорировать прокси из окружения
 
 import telebot
-from flask import Flask, abort, request
+from flask import Flask, abort, jsonify, request
+from werkzeug.exceptions import HTTPException
 from telebot import types, apihelper
 apihelper.proxy = {"http": None, "https": None}
 from dotenv import load_dotenv
@@ -46,17 +57,128 @@ if not DB_URL:
 
 
 # ================== ЛОГИ ==================
+# Записи кладутся в ограниченную очередь (QueueHandler), в stderr их пишет отдельный
+# поток (QueueListener): поток запроса не ждёт вывода. Очередь полна — запись
+# отбрасывается и считается в log_dropped (/metrics), а не блокирует вебхук.
+try:
+    import orjson  # быстрее json для LOG_FORMAT=json; необязателен
+except ImportError:
+    orjson = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись; поля из extra= попадают в объект как есть."""
+
+    _SKIP = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self._SKIP:
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        if orjson is not None:
+            return orjson.dumps(data, default=str).decode()
+        return json.dumps(data, ensure_ascii=False, default=str, separators=(",", ":"))
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при полной очереди теряет запись, а не ждёт."""
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # базовый prepare() вклеивает traceback в msg и обнуляет exc_info —
+        # тогда JsonFormatter не видит исключения. Очередь внутри процесса,
+        # пиклить нечего: оставляем exc_info, traceback форматирует поток вывода
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_log_handler: Optional[DroppingQueueHandler] = None
+_log_output: Optional[logging.Handler] = None
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(level: str = "INFO", fmt: str = "text", queue_size: int = 10000) -> None:
+    """Ставит очередь логов на root. После fork (gunicorn) вызывается заново:
+    поток вывода fork не переживает, а очередь могла остаться с занятым lock."""
+    global _log_handler, _log_output
+    _log_output = logging.StreamHandler()
+    if fmt == "json":
+        _log_output.setFormatter(JsonFormatter())
+    else:
+        _log_output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
+    _log_handler = DroppingQueueHandler(queue.Queue(max(1, queue_size)))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_log_handler)
+    root.setLevel(level.upper())
+    start_log_listener()
+
+
+def start_log_listener() -> None:
+    global _log_listener
+    if _log_handler is None:
+        return
+    _log_listener = logging.handlers.QueueListener(_log_handler.queue, _log_output)
+    _log_listener.start()
+
+
+def stop_log_listener() -> None:
+    """Дописывает очередь логов; вызывается при выходе."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+def dropped_log_records() -> int:
+    return _log_handler.dropped if _log_handler is not None else 0
+
+
+atexit.register(stop_log_listener)
+# до load_dotenv — обычный вывод; setup_logging() в конфиге заменит его очередью
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
 telebot.logger.setLevel(logging.INFO)
 
 # ================== КОНФИГ ==================
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), ".env"))
 
+# LOG_FORMAT: text | json; LOG_QUEUE_SIZE — сколько записей ждут вывода, лишние теряются
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# доля апдейтов вебхука, тело которых попадает в лог; с LOG_REDACT тексты и имена вырезаются
+LOG_UPDATE_SAMPLE = float(os.getenv("LOG_UPDATE_SAMPLE", "0.01"))
+LOG_REDACT = os.getenv("LOG_REDACT", "1").strip().lower() in {"1", "true", "yes", "on"}
+setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE)
+
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN пуст. Заполни .env")
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+# threaded=False: хендлеры выполняются в потоке, который вызвал process_new_updates,
+# параллельностью и порядком апдейтов управляет update_pool
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=False)
 
 app = Flask(__name__)
 
@@ -67,6 +189,22 @@ app = Flask(__name__)
 TRIAL_MESSAGES = int(os.getenv("TRIAL_MESSAGES", "75"))
 SESSION_TTL_HOURS = int(os.getenv("SESSION_TTL_HOURS", "24"))
 STATE_FILE = os.getenv("STATE_FILE", "users.json")
+# write-behind: изменения пишутся в стор не реже раза в STATE_FLUSH_INTERVAL секунд
+# или сразу, как только накопилось STATE_FLUSH_BATCH изменённых пользователей
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "1.0"))
+STATE_FLUSH_BATCH = int(os.getenv("STATE_FLUSH_BATCH", "200"))
+# несколько инстансов бота на одной базе Postgres (вебхук за балансировщиком):
+# чат перечитывается из стора перед каждым апдейтом и пишется сразу после него.
+# Пишутся только изменённые поля; счётчики (free_used, abuse_strikes) — приростом, так что
+# их изменения с разных инстансов складываются, а для остальных полей побеждает последняя
+# запись (по полю, см. DbStore.merge_users). Включает STATE_LAZY
+STATE_SHARED = os.getenv("STATE_SHARED", "0").strip().lower() in {"1", "true", "yes", "on"}
+# ленивый режим: пользователи подгружаются из стора по одному при первом U(),
+# в памяти держится не больше STATE_CACHE_SIZE чистых записей (LRU)
+STATE_LAZY = os.getenv("STATE_LAZY", "0").strip().lower() in {"1", "true", "yes", "on"} or STATE_SHARED
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "10000"))
+# пользователи в памяти разбиты на STATE_SHARDS шардов со своими locks (см. UserTable)
+STATE_SHARDS = int(os.getenv("STATE_SHARDS", "16"))
 DEFAULT_LANGUAGE = os.getenv("DEFAULT_LANGUAGE", "ru").lower()
 
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
@@ -77,6 +215,41 @@ WEBHOOK_PORT = int(_port_env)
 WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", f"/webhook/{BOT_TOKEN}")
 WEBHOOK_SSL_CERT = os.getenv("WEBHOOK_SSL_CERT", "").strip() or None
 WEBHOOK_SSL_KEY = os.getenv("WEBHOOK_SSL_KEY", "").strip() or None
+# апдейты (и вебхук, и поллинг) обрабатывает пул из WEBHOOK_WORKERS потоков с очередью на WEBHOOK_QUEUE_SIZE;
+# апдейты одного чата — строго по очереди, разных чатов — параллельно.
+# Очередь полна: retry — отвечаем 503, Telegram повторит доставку позже;
+# shed — апдейты бесплатного тарифа отбрасываются уже с WEBHOOK_SHED_AT заполнения, платным остаётся запас
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "256"))
+WEBHOOK_OVERLOAD = os.getenv("WEBHOOK_OVERLOAD", "retry").strip().lower()
+WEBHOOK_SHED_AT = float(os.getenv("WEBHOOK_SHED_AT", "0.8"))
+# поллинг: апдейты разбирают POLLING_WORKERS потоков того же пула (порядок внутри чата тот же),
+# следующий getUpdates уходит, не дожидаясь обработки текущей пачки
+POLLING_WORKERS = int(os.getenv("POLLING_WORKERS", str(WEBHOOK_WORKERS)))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "50"))  # long polling, секунды
+POLLING_LIMIT = int(os.getenv("POLLING_LIMIT", "100"))  # апдейтов за один getUpdates
+# повторная доставка апдейта (вебхук ответил медленно или с ошибкой) отбрасывается по update_id:
+# помним UPDATE_DEDUP_WINDOW секунд, но не больше UPDATE_DEDUP_SIZE штук. UPDATE_DEDUP_SHARED —
+# ещё и через таблицу seen_updates в Postgres, для нескольких инстансов (по умолчанию — как STATE_SHARED)
+UPDATE_DEDUP_WINDOW = float(os.getenv("UPDATE_DEDUP_WINDOW", "3600"))
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "50000"))
+UPDATE_DEDUP_SHARED = os.getenv("UPDATE_DEDUP_SHARED", "1" if STATE_SHARED else "0").strip().lower() in {"1", "true", "yes", "on"}
+# сервер вебхука: flask — встроенный dev-сервер (по умолчанию), waitress — один процесс с пулом потоков,
+# gunicorn — WEBHOOK_SERVER_WORKERS процессов (больше одного — только со STATE_SHARED)
+WEBHOOK_SERVER = os.getenv("WEBHOOK_SERVER", "flask").strip().lower()
+WEBHOOK_SERVER_WORKERS = int(os.getenv("WEBHOOK_SERVER_WORKERS", "1"))
+WEBHOOK_SERVER_THREADS = int(os.getenv("WEBHOOK_SERVER_THREADS", "8"))  # потоков на соединения в процессе
+WEBHOOK_CONNECTION_LIMIT = int(os.getenv("WEBHOOK_CONNECTION_LIMIT", "100"))
+WEBHOOK_TIMEOUT = int(os.getenv("WEBHOOK_TIMEOUT", "30"))  # зависший воркер / молчащее соединение, секунды
+WEBHOOK_KEEPALIVE = int(os.getenv("WEBHOOK_KEEPALIVE", "5"))
+WEBHOOK_GRACEFUL_TIMEOUT = int(os.getenv("WEBHOOK_GRACEFUL_TIMEOUT", "30"))
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", str(1024 * 1024)))  # больше — 413
+app.config["MAX_CONTENT_LENGTH"] = WEBHOOK_MAX_BODY
+# при остановке (SIGTERM) апдейты в очереди и в работе дорабатываются не дольше SHUTDOWN_TIMEOUT секунд;
+# под gunicorn должен быть меньше WEBHOOK_GRACEFUL_TIMEOUT
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))
+# threads — TeleBot + Flask (по умолчанию); async — AsyncTeleBot + aiohttp, см. lumi_async.py
+LUMI_RUNTIME = os.getenv("LUMI_RUNTIME", "threads").strip().lower()
 
 OPENAI_KEY = os.getenv("OPENAI_API_KEY", "").strip()
 OPENAI_TEXT_MODEL = os.getenv("OPENAI_TEXT_MODEL", "gpt-4o-mini").strip()
@@ -388,6 +561,9 @@ PLAN_BEHAVIOR: Dict[str, Dict[str, object]] = {
         "presence_penalty": 0.0,
         "frequency_penalty": 0.0,
         "support_interval": None,
+        "queue_priority": 3,
+        "queue_max_wait": 3.0,
+        "prompt_token_budget": 1200,
     },
     "basic": {
         "history_limit": 10,
@@ -396,6 +572,9 @@ PLAN_BEHAVIOR: Dict[str, Dict[str, object]] = {
         "presence_penalty": 0.1,
         "frequency_penalty": 0.0,
         "support_interval": None,
+        "queue_priority": 2,
+        "queue_max_wait": 8.0,
+        "prompt_token_budget": 1600,
     },
     "comfort": {
         "history_limit": 14,
@@ -404,6 +583,9 @@ PLAN_BEHAVIOR: Dict[str, Dict[str, object]] = {
         "presence_penalty": 0.25,
         "frequency_penalty": 0.05,
         "support_interval": 48,
+        "queue_priority": 1,
+        "queue_max_wait": 15.0,
+        "prompt_token_budget": 2400,
     },
     "warm": {
         "history_limit": 18,
@@ -412,6 +594,9 @@ PLAN_BEHAVIOR: Dict[str, Dict[str, object]] = {
         "presence_penalty": 0.35,
         "frequency_penalty": 0.1,
         "support_interval": 24,
+        "queue_priority": 0,
+        "queue_max_wait": 25.0,
+        "prompt_token_budget": 3200,
     },
 }
 
@@ -684,7 +869,7 @@ def build_subscription_entry(
     except Exception:
         chat_id_int = None
     if chat_id_int is not None:
-        plan_code = active_plan(chat_id_int)
+        plan_code = plan_from_info(chat_id_int, info)
     else:
         raw_plan = str(info.get("permanent_plan") or info.get("premium_plan") or "free")
         plan_code = raw_plan if raw_plan in PLAN_BEHAVIOR else "free"
@@ -757,7 +942,7 @@ def subscription_overview(show_all: bool, admin_lang: str) -> str:
         except Exception:
             chat_id_int = None
         if chat_id_int is not None:
-            plan_code = active_plan(chat_id_int)
+            plan_code = plan_from_info(chat_id_int, info)
         else:
             raw_plan = str(info.get("permanent_plan") or info.get("premium_plan") or "free")
             plan_code = raw_plan if raw_plan in PLAN_BEHAVIOR else "free"
@@ -767,8 +952,9 @@ def subscription_overview(show_all: bool, admin_lang: str) -> str:
         numeric_id = chat_id_int if isinstance(chat_id_int, int) else 0
         return (0 if active else 1, 0 if permanent else 1, until_dt, numeric_id)
 
-    entries: List[str] = []
-    for chat_id_str, info in sorted(users.items(), key=sort_key):
+    # выборка идёт потоком: в памяти остаются только попавшие в отчёт строки
+    keyed: List[tuple] = []
+    for chat_id_str, info in iter_user_states():
         entry = build_subscription_entry(
             chat_id_str,
             info,
@@ -778,7 +964,9 @@ def subscription_overview(show_all: bool, admin_lang: str) -> str:
             show_all=show_all,
         )
         if entry:
-            entries.append(entry)
+            keyed.append((sort_key((chat_id_str, info)), entry))
+    keyed.sort(key=lambda item: item[0])
+    entries = [entry for _, entry in keyed]
 
     if not entries:
         return phrases.get("none_all", "No user data yet.") if show_all else phrases.get("none_active", "No active subscriptions.")
@@ -822,6 +1010,10 @@ SENSITIVE_REGEXES = [
 ]
 
 DEFAULT_HISTORY_LIMIT = 12
+# сколько последних реплик читать из messages: хватает на любой план
+HISTORY_TAIL = max(int(b.get("history_limit") or DEFAULT_HISTORY_LIMIT) for b in PLAN_BEHAVIOR.values()) * 2
+MESSAGES_KEEP_PER_CHAT = int(os.getenv("MESSAGES_KEEP_PER_CHAT", "200"))
+MESSAGES_PRUNE_INTERVAL = float(os.getenv("MESSAGES_PRUNE_INTERVAL", "3600"))
 
 FALLBACK = {
     "basic": os.getenv("CRYPTO_FALLBACK_BASIC", ""),
@@ -831,28 +1023,534 @@ FALLBACK = {
 
 # ================== СОСТОЯНИЕ ==================
 # ================== СОСТОЯНИЕ ==================
-users: Dict[str, Dict[str, object]] = {}
+users: "UserTable"  # создаётся после объявления UserTable, заменяется в load_state()
+
+# chat_id -> имена изменённых полей; ALL_FIELDS означает «записать строку целиком»
+ALL_FIELDS = "*"
+_dirty: Dict[str, Set[str]] = {}
+_flushing: Set[str] = set()  # уже забраны флашером, но ещё не записаны
+# сами изменённые записи: LRU мог вытеснить запись из users, пока хендлер её держал,
+# а записать и вернуть в users (см. U) нужно именно её, а не перечитанную из стора
+_dirty_refs: Dict[str, "UserState"] = {}
+# новые реплики (chat_id, role, content) для стора с журналом сообщений
+_pending_messages: List[tuple] = []
+_dirty_lock = threading.Lock()
+
+
+def mark_dirty(chat_id: object, *fields: str, info: Optional["UserState"] = None) -> None:
+    """Отмечает запись (или отдельные поля) как требующую сохранения."""
+    cid = str(chat_id)
+    with _dirty_lock:
+        pending = _dirty.setdefault(cid, set())
+        pending.update(fields or (ALL_FIELDS,))
+        if info is not None:
+            _dirty_refs[cid] = info
+
+
+def dirty_record(chat_id: object) -> Optional["UserState"]:
+    """Запись с незаписанными изменениями, даже если её уже нет в users."""
+    with _dirty_lock:
+        return _dirty_refs.get(str(chat_id))
+
+
+def queue_messages(chat_id: int, *messages: tuple) -> None:
+    """Ставит реплики (role, content) в очередь на дозапись в store.append_messages."""
+    with _dirty_lock:
+        _pending_messages.extend((int(chat_id), role, content) for role, content in messages)
+
+
+def dirty_count() -> int:
+    with _dirty_lock:
+        return len(_dirty)
+
+
+def is_dirty(chat_id: object) -> bool:
+    cid = str(chat_id)
+    with _dirty_lock:
+        return cid in _dirty or cid in _flushing
+
+
+def has_unsaved(chat_id: object) -> bool:
+    """Есть ли у чата изменения или реплики, ещё не записанные в стор."""
+    cid = str(chat_id)
+    with _dirty_lock:
+        if cid in _dirty or cid in _flushing:
+            return True
+        return any(str(m[0]) == cid for m in _pending_messages)
+
+
+def dirty_fields(chat_id: object) -> Set[str]:
+    with _dirty_lock:
+        fields = set(_dirty.get(str(chat_id), ()))
+    return set(USER_DEFAULTS) if ALL_FIELDS in fields else fields
+
+
+class _Shard:
+    __slots__ = ("lock", "items", "version", "snap", "snap_version")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items: "OrderedDict[str, UserState]" = OrderedDict()
+        self.version = 0  # растёт, когда запись добавляется или вытесняется
+        self.snap: tuple = ()
+        self.snap_version = 0
+
+
+class UserTable:
+    """Пользователи в памяти: shards словарей, у каждого свой lock.
+
+    U() блокирует только шард своего чата, так что обращения к разным чатам
+    друг другу не мешают. snapshot() — неизменяемый список (chat_id, info)
+    для обходов всей таблицы (/subs, выгрузки): копия шарда пересобирается,
+    только если в нём с прошлого снимка менялся состав, и lock держится лишь
+    на время копирования одного шарда. Сами записи в снимке общие — поля
+    читаются текущие.
+
+    capacity — LRU ленивого режима, по capacity/shards записей на шард.
+    Вытесняются только чистые записи: несохранённые изменения и реплики
+    из очереди в messages держат чат в памяти, пока флашер их не запишет.
+    """
+
+    def __init__(self, shards: int, capacity: Optional[int] = None):
+        self._shards = [_Shard() for _ in range(max(1, shards))]
+        self.capacity = max(1, capacity) if capacity else None
+        self._per_shard = -(-self.capacity // len(self._shards)) if self.capacity else None
+
+    def _shard(self, cid: str) -> _Shard:
+        return self._shards[hash(cid) % len(self._shards)]
+
+    def get(self, cid: str, default=None):
+        shard = self._shard(cid)
+        with shard.lock:
+            info = shard.items.get(cid)
+            if info is None:
+                return default
+            if self._per_shard:
+                shard.items.move_to_end(cid)
+            return info
+
+    def setdefault(self, cid: str, info: "UserState") -> "UserState":
+        shard = self._shard(cid)
+        with shard.lock:
+            existing = shard.items.get(cid)
+            if existing is not None:
+                if self._per_shard:
+                    shard.items.move_to_end(cid)
+                return existing
+            shard.items[cid] = info
+            shard.version += 1
+            if self._per_shard:
+                self._evict(shard, keep=cid)
+            return info
+
+    def _evict(self, shard: _Shard, keep: str) -> None:
+        overflow = len(shard.items) - self._per_shard
+        if overflow <= 0:
+            return
+        for cid in list(shard.items.keys()):
+            if overflow <= 0:
+                break
+            if cid == keep or has_unsaved(cid):
+                continue
+            del shard.items[cid]
+            shard.version += 1
+            overflow -= 1
+
+    def snapshot(self) -> List[tuple]:
+        out: List[tuple] = []
+        for shard in self._shards:
+            with shard.lock:
+                if shard.snap_version != shard.version:
+                    shard.snap = tuple(shard.items.items())
+                    shard.snap_version = shard.version
+                snap = shard.snap
+            out.extend(snap)
+        return out
+
+    items = snapshot
+
+    def __contains__(self, cid: object) -> bool:
+        key = str(cid)
+        shard = self._shard(key)
+        with shard.lock:
+            return key in shard.items
+
+    def __len__(self) -> int:
+        return sum(len(shard.items) for shard in self._shards)
+
+
+users = UserTable(STATE_SHARDS)
+
+
+USER_DEFAULTS: Dict[str, object] = {
+    "language": DEFAULT_LANGUAGE,
+    "lang_confirmed": False,
+    "policy_shown": False,
+    "accepted_at": None,
+    "free_used": 0,
+    "premium_until": None,
+    "premium_plan": None,
+    "premium_source": None,
+    "premium_started_at": None,
+    "premium_payment_method": None,
+    "premium_payment_reference": None,
+    "permanent_plan": None,
+    "news_opt_out": False,
+    "news_opted_at": None,
+    "offer_prompted": False,
+    "offer_remind_at": None,
+    "abuse_strikes": 0,
+    "lyrics_expected": False,
+    "last_support": None,
+    "last_seen_at": None,
+    "last_username": None,
+    "last_first_name": None,
+    "last_last_name": None,
+    "last_full_name": None,
+    "last_vent_at": None,
+    "last_vent_note": None,
+    "history": None,  # None — ещё не загружена (см. get_history)
+}
+_DATETIME_FIELDS = frozenset({
+    "accepted_at", "premium_until", "premium_started_at", "news_opted_at",
+    "offer_remind_at", "last_support", "last_seen_at", "last_vent_at",
+})
+_INTERNED_FIELDS = frozenset({
+    "language", "premium_plan", "permanent_plan", "premium_source", "premium_payment_method", "last_vent_note",
+})
+_INT_FIELDS = frozenset({"free_used", "abuse_strikes"})
+_BOOL_FIELDS = frozenset({"lang_confirmed", "policy_shown", "news_opt_out", "offer_prompted", "lyrics_expected"})
+
+
+def _coerce_field(name: str, value: object) -> object:
+    if value is None:
+        return None
+    if name in _DATETIME_FIELDS:
+        return parse_iso_datetime(value)
+    if name in _INTERNED_FIELDS:
+        return sys.intern(str(value))
+    if name in _INT_FIELDS:
+        try:
+            return int(value)
+        except Exception:
+            return 0
+    if name in _BOOL_FIELDS:
+        return bool(value)
+    return value
+
+
+class UserState:
+    """Состояние пользователя: поля в __slots__ вместо словаря на 25 ключей.
+
+    Даты хранятся как datetime и разбираются один раз при загрузке, коды языка
+    и плана интернируются. Присваивание атрибута отмечает поле изменённым
+    (mark_dirty); to_row()/serialized() отдают значения в прежнем формате стора
+    (даты — ISO-строками). info["x"] и info.get("x") оставлены для кода,
+    который работает и со строками стора, и с UserState.
+
+    В STATE_SHARED запись помнит версию строки стора (version) и значения
+    счётчиков на момент чтения (base): в стор уходит прирост, а не итог,
+    поэтому параллельные инкременты с других инстансов не теряются.
+    """
+
+    __slots__ = ("chat_key", "extra", "version", "base") + tuple(USER_DEFAULTS)
+
+    def __init__(self, chat_key: str, data: Optional[Dict[str, object]] = None):
+        init = object.__setattr__
+        init(self, "chat_key", chat_key)
+        init(self, "extra", None)  # поля стора, которых нет в USER_DEFAULTS
+        init(self, "version", None)  # None — строки в сторе ещё нет (или стор без версий)
+        for name, default in USER_DEFAULTS.items():
+            init(self, name, default)
+        if data:
+            for key, value in data.items():
+                self.set_cached(key, value)
+        init(self, "base", {c: getattr(self, c) or 0 for c in COUNTER_COLUMNS} if STATE_SHARED else None)
+
+    def __setattr__(self, name: str, value: object) -> None:
+        self.set_cached(name, value)
+        mark_dirty(self.chat_key, name, info=self)
+
+    def set_cached(self, name: str, value: object) -> None:
+        """Меняет поле, не отмечая его как изменение для стора."""
+        if name in USER_DEFAULTS:
+            object.__setattr__(self, name, _coerce_field(name, value))
+        elif name == "version":
+            object.__setattr__(self, "version", value)
+        elif name != "chat_id":
+            if self.extra is None:
+                object.__setattr__(self, "extra", {})
+            self.extra[name] = value
+
+    def get(self, key: str, default: object = None) -> object:
+        if key in USER_DEFAULTS:
+            value = getattr(self, key)
+        else:
+            value = (self.extra or {}).get(key)
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> object:
+        if key in USER_DEFAULTS:
+            return getattr(self, key)
+        return (self.extra or {})[key]
+
+    def __setitem__(self, key: str, value: object) -> None:
+        setattr(self, key, value)
+
+    def __contains__(self, key: object) -> bool:
+        return key in USER_DEFAULTS or key in (self.extra or {})
+
+    def serialized(self, name: str) -> object:
+        value = self.get(name)
+        if isinstance(value, datetime):
+            return value.isoformat()
+        if name == "history" and value is None:
+            return []
+        return value
+
+    def counter_deltas(self, fields: Set[str]) -> Dict[str, int]:
+        """Прирост счётчиков из fields с момента чтения строки (только STATE_SHARED)."""
+        return {c: (getattr(self, c) or 0) - self.base[c] for c in COUNTER_COLUMNS if c in fields}
+
+    def sync(self, row: Dict[str, object], keep: Set[str] = frozenset()) -> None:
+        """Подтягивает строку стора, которую мог изменить другой инстанс.
+
+        Поля из keep (ещё не записанные изменения) остаются локальными;
+        к счётчикам незаписанный прирост прибавляется поверх значения стора.
+        """
+        for name in USER_DEFAULTS:
+            if name not in row or name == "history":
+                continue
+            if name in self.base:
+                fresh = _coerce_field(name, row[name]) or 0
+                object.__setattr__(self, name, (getattr(self, name) or 0) + fresh - self.base[name])
+                self.base[name] = fresh
+            elif name not in keep:
+                object.__setattr__(self, name, _coerce_field(name, row[name]))
+        object.__setattr__(self, "version", row.get("version"))
+
+    def to_row(self) -> Dict[str, object]:
+        row: Dict[str, object] = {"chat_id": int(self.chat_key)}
+        for name in USER_DEFAULTS:
+            row[name] = self.serialized(name)
+        for name in self.extra or {}:
+            row[name] = self.serialized(name)
+        return row
+
 
 def load_state() -> None:
     global users
+    if STATE_LAZY:
+        # никого не читаем заранее: U() подтянет пользователя при первом обращении
+        users = UserTable(STATE_SHARDS, capacity=STATE_CACHE_SIZE)
+        with _dirty_lock:
+            _dirty.clear()
+            _dirty_refs.clear()
+        return
     rows = store.load_all()  # список словарей
-    mapping: Dict[str, Dict[str, object]] = {}
+    table = UserTable(STATE_SHARDS)
     for r in rows or []:
         cid = r.get("chat_id")
         if cid is None:
             continue
         key = str(int(cid))
-        mapping[key] = {k: v for k, v in r.items() if k != "chat_id"}
-    users = mapping
+        table.setdefault(key, UserState(key, r))
+    users = table
+    with _dirty_lock:
+        _dirty.clear()
+        _dirty_refs.clear()
 
-def save_state() -> None:
-    # преобразуем обратно в список для DbStore/FileStore
+
+_flush_lock = threading.Lock()
+
+
+def flush_state() -> int:
+    """Записывает в стор только изменённые с прошлого вызова записи."""
+    with _flush_lock:
+        return _flush_dirty()
+
+
+def flush_chat(chat_id: object) -> int:
+    """Записывает изменения и реплики одного чата (STATE_SHARED — сразу после его апдейта).
+
+    Без _flush_lock: воркеры разных чатов пишут параллельно. Чат, который
+    в этот момент пишет флашер, пропускается — остаток допишет следующий сброс.
+    """
+    return _flush_dirty(str(chat_id))
+
+
+def _flush_dirty(only: Optional[str] = None) -> int:
+    # чаты из _flushing уже пишет другой вызов: второй параллельный сброс того же чата
+    # задвоил бы приросты счётчиков и мог переставить его реплики
+    with _dirty_lock:
+        if only is None:
+            pending = {cid: fields for cid, fields in _dirty.items() if cid not in _flushing}
+        elif only in _flushing:
+            return 0
+        else:
+            pending = {only: _dirty[only]} if only in _dirty else {}
+        for cid in pending:
+            del _dirty[cid]
+        messages: List[tuple] = []
+        kept: List[tuple] = []
+        for message in _pending_messages:
+            cid = str(message[0])
+            if cid in _flushing or (only is not None and cid != only):
+                kept.append(message)
+            else:
+                messages.append(message)
+        _pending_messages[:] = kept
+        claimed = set(pending).union(str(message[0]) for message in messages)
+        _flushing.update(claimed)
+    try:
+        if messages:
+            try:
+                store.append_messages(messages)
+            except Exception as exc:
+                logging.exception("append_messages failed for %d messages: %r", len(messages), exc)
+                with _dirty_lock:
+                    _pending_messages[:0] = messages
+        if not pending:
+            return 0
+        return _write_pending(pending)
+    finally:
+        with _dirty_lock:
+            _flushing.difference_update(claimed)
+            for cid in pending:
+                if cid not in _dirty:
+                    _dirty_refs.pop(cid, None)
+
+
+def _pending_record(cid: str) -> Optional["UserState"]:
+    info = dirty_record(cid) or users.get(cid)
+    if info is None:
+        logging.error("chat %s: changes lost, record is gone from memory", cid)
+    return info
+
+
+def _write_pending(pending: Dict[str, Set[str]]) -> int:
+    if STATE_SHARED:
+        return _merge_pending(pending)
+    # новые записи уходят строкой целиком, остальные — только изменёнными полями
     rows: List[Dict[str, object]] = []
-    for cid, info in (users or {}).items():
-        row = {"chat_id": int(cid)}
-        row.update(info or {})
-        rows.append(row)
-    store.save_all(rows)
+    updates: List[tuple] = []
+    for cid, fields in pending.items():
+        info = _pending_record(cid)
+        if info is None:
+            continue
+        if ALL_FIELDS in fields:
+            rows.append(info.to_row())
+        else:
+            updates.append((int(cid), {field: info.serialized(field) for field in fields}))
+
+    try:
+        if rows:
+            store.upsert_users(rows)
+        if updates:
+            store.update_fields_many(updates)
+    except Exception as exc:
+        logging.exception("flush_state failed for %d users: %r", len(rows) + len(updates), exc)
+        # возвращаем изменения в очередь, следующий вызов попробует снова
+        for cid, fields in pending.items():
+            mark_dirty(cid, *fields)
+        return 0
+    return len(rows) + len(updates)
+
+
+shared_conflicts = 0  # записи STATE_SHARED, которые опередил другой инстанс
+
+
+def _merge_pending(pending: Dict[str, Set[str]]) -> int:
+    # STATE_SHARED: только изменённые поля, счётчики — приростом; версия нужна, чтобы
+    # узнать о записи другого инстанса и подтянуть его поля (см. DbStore.merge_users)
+    global shared_conflicts
+    written: List[tuple] = []
+    changes: List[tuple] = []
+    for cid, fields in pending.items():
+        info = _pending_record(cid)
+        if info is None:
+            continue
+        if ALL_FIELDS in fields:
+            fields = set(USER_DEFAULTS)
+        deltas = info.counter_deltas(fields)
+        values = {field: info.serialized(field) for field in fields if field not in deltas}
+        changes.append((int(cid), values, deltas, info.version))
+        written.append((cid, info, deltas))
+
+    try:
+        results = store.merge_users(changes)
+    except Exception as exc:
+        logging.exception("flush_state failed for %d users: %r", len(changes), exc)
+        for cid, fields in pending.items():
+            mark_dirty(cid, *fields)
+        return 0
+    for (cid, info, deltas), (row, conflicted) in zip(written, results):
+        for name, delta in deltas.items():
+            info.base[name] += delta  # этот прирост уже в сторе
+        # другой инстанс мог поменять и другие поля — подтягиваем их
+        info.sync(row, keep=dirty_fields(cid))
+        if conflicted:
+            shared_conflicts += 1
+            logging.debug("chat %s was changed by another instance, merged", cid)
+    return len(changes)
+
+
+class StateFlusher:
+    """Фоновый поток, который сбрасывает изменённых пользователей в стор.
+
+    Повторные изменения одного чата между сбросами схлопываются в одну запись
+    (см. _dirty). Гарантия сохранности: при падении процесса теряется не больше
+    STATE_FLUSH_INTERVAL секунд изменений плюс время одной записи в стор;
+    при SIGTERM очередь дописывается полностью (stop()).
+    """
+
+    def __init__(self, interval: float, batch: int):
+        self.interval = max(0.05, interval)
+        self.batch = max(1, batch)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="state-flusher", daemon=True)
+        self._thread.start()
+
+    def notify(self) -> None:
+        if dirty_count() >= self.batch:
+            self._wake.set()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Останавливает поток и синхронно дописывает всё, что осталось."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        flush_state()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            flush_state()
+
+
+state_flusher = StateFlusher(STATE_FLUSH_INTERVAL, STATE_FLUSH_BATCH)
+
+
+def save_state() -> None:
+    """Просит сохранить изменения: в фоне, если запущен флашер, иначе сразу."""
+    if state_flusher.running:
+        state_flusher.notify()
+    else:
+        flush_state()
 
 def language_preset(code: str) -> Dict[str, object]:
     default_pack = LANGUAGES.get(DEFAULT_LANGUAGE) or next(iter(LANGUAGES.values()))
@@ -878,27 +1576,27 @@ def touch_user_profile(message) -> None:
     chat_id = message.chat.id
     info = U(chat_id)
     changed = False
-    now_iso = datetime.now(timezone.utc).isoformat()
-    if info.get("last_seen_at") != now_iso:
-        info["last_seen_at"] = now_iso
+    now = datetime.now(timezone.utc)
+    if info.last_seen_at != now:
+        info.last_seen_at = now
         changed = True
     user = getattr(message, "from_user", None)
     if user:
         username = user.username or None
-        if info.get("last_username") != username:
-            info["last_username"] = username
+        if info.last_username != username:
+            info.last_username = username
             changed = True
         full_name = user.full_name or None
-        if info.get("last_full_name") != full_name:
-            info["last_full_name"] = full_name
+        if info.last_full_name != full_name:
+            info.last_full_name = full_name
             changed = True
         first_name = user.first_name or None
-        if info.get("last_first_name") != first_name:
-            info["last_first_name"] = first_name
+        if info.last_first_name != first_name:
+            info.last_first_name = first_name
             changed = True
         last_name = user.last_name or None
-        if info.get("last_last_name") != last_name:
-            info["last_last_name"] = last_name
+        if info.last_last_name != last_name:
+            info.last_last_name = last_name
             changed = True
     if changed:
         save_state()
@@ -917,32 +1615,23 @@ def ensure_ready(message) -> bool:
         logging.info("ensure_ready: policy not accepted for %s", chat_id)
         info = U(chat_id)
         now = datetime.now(timezone.utc)
-        if not info.get("offer_prompted"):
-            info["offer_prompted"] = True
-            info["offer_remind_at"] = now.isoformat()
+        if not info.offer_prompted:
+            info.offer_prompted = True
+            info.offer_remind_at = now
             save_state()
             bot.send_message(chat_id, greeting_text(chat_id))
             send_policy(chat_id)
             return False
 
         # напоминание раз в 2 минуты
-        remind_ok = True
-        last = info.get("offer_remind_at")
-        if last:
-            try:
-                last_dt = datetime.fromisoformat(last)
-                if last_dt.tzinfo is None:
-                    last_dt = last_dt.replace(tzinfo=timezone.utc)
-                if now - last_dt < timedelta(minutes=2):
-                    remind_ok = False
-            except Exception:
-                pass
+        last = info.offer_remind_at
+        remind_ok = not last or now - last >= timedelta(minutes=2)
         if remind_ok:
             msg = lang_text_fallback(chat_id, "policy_repeat") or "Чтобы продолжить, нажми «Принимаю» или /accept."
             bot.send_message(chat_id, msg)  # без кнопки
             kb.add(types.InlineKeyboardButton(lang_text(chat_id, "policy_accept") or "Принимаю", callback_data="offer:accept"))
             bot.send_message(chat_id, msg, reply_markup=kb)
-            info["offer_remind_at"] = now.isoformat()
+            info.offer_remind_at = now
             save_state()
         return False
 
@@ -951,63 +1640,119 @@ def ensure_ready(message) -> bool:
 
 
 
-def U(chat_id: int) -> Dict[str, object]:
+def iter_user_states():
+    """Все пользователи (chat_id, info) для админских выборок.
+
+    В ленивом режиме строки читаются потоково из стора и в LRU не попадают;
+    для тех, кто уже в памяти, берётся более свежая версия из кэша.
+    """
+    cached = dict(users.snapshot())
+    if not STATE_LAZY:
+        yield from cached.items()
+        return
+    for row in store.iter_all():
+        cid = str(int(row["chat_id"]))
+        info = cached.pop(cid, None)
+        yield cid, info if info is not None else {k: v for k, v in row.items() if k != "chat_id"}
+    # новые пользователи, которых ещё нет в сторе
+    yield from cached.items()
+
+
+def U(chat_id: int) -> UserState:
     cid = str(chat_id)
-    users.setdefault(cid, {
-        "policy_shown": False,
-        "accepted_at": None,
-        "free_used": 0,
-        "premium_until": None,
-        "premium_plan": None,
-        "premium_source": None,
-        "premium_started_at": None,
-        "premium_payment_method": None,
-        "premium_payment_reference": None,
-        "permanent_plan": None,
-        "language": DEFAULT_LANGUAGE,
-        "history": [],
-        "news_opt_out": False,
-        "news_opted_at": None,
-        "offer_prompted": False,   # <- НОВОЕ
-        "offer_remind_at": None,   # <- НОВОЕ
-        "abuse_strikes": 0,
-        "lyrics_expected": False,
-        "last_seen_at": None,
-        "last_username": None,
-        "last_first_name": None,
-        "last_last_name": None,
-        "last_full_name": None,
-        "last_vent_at": None,
-        "last_vent_note": None,
-    })
-    info = users[cid]
-    info.setdefault("offer_prompted", False)
-    info.setdefault("offer_remind_at", None)
-    info.setdefault("abuse_strikes", 0)
-    info.setdefault("lyrics_expected", False)
-    info.setdefault("premium_plan", None)
-    info.setdefault("premium_source", None)
-    info.setdefault("premium_started_at", None)
-    info.setdefault("premium_payment_method", None)
-    info.setdefault("premium_payment_reference", None)
-    info.setdefault("permanent_plan", None)
-    info.setdefault("last_seen_at", None)
-    info.setdefault("last_username", None)
-    info.setdefault("last_first_name", None)
-    info.setdefault("last_last_name", None)
-    info.setdefault("last_full_name", None)
-    info.setdefault("last_vent_at", None)
-    info.setdefault("last_vent_note", None)
+    info = users.get(cid)
+    if info is None and STATE_LAZY:
+        # вытеснена, но ещё не записана: строка в сторе старее этой записи
+        info = dirty_record(cid)
+        if info is not None:
+            return users.setdefault(cid, info)
+    if info is None and STATE_LAZY:
+        row = store.load_one(int(chat_id))
+        if row is not None:
+            info = users.setdefault(cid, UserState(cid, row))
+    if info is None:
+        # новый пользователь: строку целиком нужно будет записать в стор
+        # (отмечаем заранее, чтобы LRU не вытеснил запись до первого сохранения)
+        fresh = UserState(cid)
+        fresh.set_cached("history", [])
+        mark_dirty(cid, info=fresh)
+        info = users.setdefault(cid, fresh)
+        if info is not fresh:
+            mark_dirty(cid, info=info)  # параллельный U() успел раньше
     return info
 
 
+def refresh_user(chat_id: int) -> None:
+    """STATE_SHARED: перед апдейтом перечитывает чат — его мог изменить другой инстанс.
+
+    Чат с незаписанными изменениями не трогаем: они уйдут через merge_users,
+    а свежая строка вернётся вместе с результатом записи.
+    """
+    cid = str(chat_id)
+    info = users.get(cid)
+    if info is None or has_unsaved(cid):
+        return  # промах U() и так прочитает свежую строку
+    try:
+        row = store.load_one(int(chat_id))
+    except Exception as exc:
+        logging.warning("refresh_user %s failed, using cached state: %r", cid, exc)
+        return
+    if row is not None and row.get("version") != info.version:
+        info.sync(row)
+    # хвост истории — заново из messages: там и реплики, записанные другими инстансами
+    info.set_cached("history", None)
+
+
+def prefetch_user(chat_id: int) -> None:
+    """Для asyncio-рантайма: заранее, в потоке, читает из стора всё, что хендлер
+    возьмёт через U() и get_history(), чтобы запросы к базе не шли из event loop."""
+    if STATE_SHARED:
+        refresh_user(chat_id)
+    if STATE_LAZY or store.has_message_log():
+        get_history(chat_id)
+
+
+def get_history(chat_id: int) -> List[Dict[str, str]]:
+    """Копия истории диалога; в Postgres хвост читается из messages при первом обращении."""
+    info = U(chat_id)
+    history = info.history
+    if history is None and store.has_message_log():
+        history = store.load_history(int(chat_id), HISTORY_TAIL)
+        info.set_cached("history", history)
+    return list(history or [])
+
+
+def record_turn(chat_id: int, user_content: str, reply: str, plan_code: str) -> None:
+    """Дописывает реплику пользователя и ответ Lumi в историю и сохраняет."""
+    if reply in OPENAI_ERROR_REPLIES:
+        # «сервис недоступен» — не ответ Lumi: в истории модель стала бы его повторять
+        return
+    info = U(chat_id)
+    history = get_history(chat_id)
+    history.append({"role": "user", "content": user_content})
+    history.append({"role": "assistant", "content": reply})
+    history_limit = int(plan_behavior(plan_code).get("history_limit", DEFAULT_HISTORY_LIMIT))
+    if history_limit <= 0:
+        history_limit = DEFAULT_HISTORY_LIMIT
+    if len(history) > history_limit * 2:
+        history = history[-history_limit * 2:]
+    if store.has_message_log():
+        # строка users не меняется: реплики уходят в messages отдельной вставкой
+        info.set_cached("history", history)
+        queue_messages(chat_id, ("user", user_content), ("assistant", reply))
+    else:
+        info.history = history
+    save_state()
+
 
 def get_language(chat_id: int) -> str:
     info = U(chat_id)
-    lang = (info.get("language") or DEFAULT_LANGUAGE).lower()
+    lang = info.language or DEFAULT_LANGUAGE
     if lang not in LANGUAGES:
-        lang = DEFAULT_LANGUAGE
-        info["language"] = lang
+        lang = lang.lower()
+        if lang not in LANGUAGES:
+            lang = DEFAULT_LANGUAGE
+        info.language = lang
     return lang
 
 
@@ -1015,7 +1760,7 @@ def set_language(chat_id: int, lang: str) -> None:
     if lang not in LANGUAGES:
         return
     info = U(chat_id)
-    info["language"] = lang
+    info.language = lang
     save_state()
 
 
@@ -1059,41 +1804,24 @@ def greeting_text(chat_id: int) -> str:
 
 
 def is_language_confirmed(chat_id: int) -> bool:
-    return bool(U(chat_id).get("lang_confirmed"))
+    return bool(U(chat_id).lang_confirmed)
 
 
 def mark_language_confirmed(chat_id: int) -> None:
     info = U(chat_id)
-    info["lang_confirmed"] = True
+    info.lang_confirmed = True
     save_state()
 
 
 def policy_is_shown(chat_id: int) -> bool:
     info = U(chat_id)
-    ts = info.get("accepted_at")
-    if not ts:
-        return False
-    accepted: Optional[datetime]
-    if isinstance(ts, datetime):
-        accepted = ts
-    else:
-        try:
-            accepted = datetime.fromisoformat(str(ts)) if isinstance(ts, str) else None
-        except Exception:
-            accepted = None
-
+    accepted = info.accepted_at
     if not accepted:
-        info["accepted_at"] = None
-        info["policy_shown"] = False
-        save_state()
         return False
 
-    if accepted.tzinfo is None:
-        accepted = accepted.replace(tzinfo=timezone.utc)
-
     if datetime.now(timezone.utc) - accepted >= timedelta(hours=SESSION_TTL_HOURS):
-        info["accepted_at"] = None
-        info["policy_shown"] = False
+        info.accepted_at = None
+        info.policy_shown = False
         save_state()
         return False
 
@@ -1102,54 +1830,44 @@ def policy_is_shown(chat_id: int) -> bool:
 
 def mark_policy_shown(chat_id: int) -> None:
     info = U(chat_id)
-    info["policy_shown"] = True
-    info["accepted_at"] = datetime.now(timezone.utc).isoformat()
+    info.policy_shown = True
+    info.accepted_at = datetime.now(timezone.utc)
     save_state()
 
 
 def mark_policy_sent(chat_id: int) -> None:
     info = U(chat_id)
-    info["policy_shown"] = True
-    info["offer_prompted"] = True
-    info["offer_remind_at"] = datetime.now(timezone.utc).isoformat()
+    info.policy_shown = True
+    info.offer_prompted = True
+    info.offer_remind_at = datetime.now(timezone.utc)
     save_state()
 
 
 
-def active_plan(chat_id: int) -> str:
-    info = U(chat_id)
-    updated = False
+def plan_from_info(chat_id: object, info: Dict[str, object]) -> str:
+    """Текущий план по записи пользователя, без загрузки и без записи в стор."""
     if str(chat_id) in ALWAYS_PREMIUM:
-        if info.get("permanent_plan") != BEST_PLAN_CODE:
-            info["permanent_plan"] = BEST_PLAN_CODE
-            info["premium_plan"] = BEST_PLAN_CODE
-            info["premium_until"] = datetime.max.replace(tzinfo=timezone.utc).isoformat()
-            updated = True
+        return BEST_PLAN_CODE
     permanent = info.get("permanent_plan")
     if permanent:
-        if updated:
-            save_state()
         return str(permanent)
-
-    ts = info.get("premium_until")
-    if ts:
-        try:
-            until = datetime.fromisoformat(ts) if isinstance(ts, str) else None
-        except Exception:
-            until = None
-        if until:
-            if until.tzinfo is None:
-                until = until.replace(tzinfo=timezone.utc)
-            if until > datetime.now(timezone.utc):
-                plan_code = str(info.get("premium_plan") or "basic")
-                if updated:
-                    save_state()
-                return plan_code
-    if updated:
-        save_state()
+    until = parse_iso_datetime(info.get("premium_until"))
+    if until and until > datetime.now(timezone.utc):
+        return str(info.get("premium_plan") or "basic")
     return "free"
 
 
+def active_plan(chat_id: int) -> str:
+    info = U(chat_id)
+    if str(chat_id) in ALWAYS_PREMIUM:
+        if info.permanent_plan != BEST_PLAN_CODE:
+            info.permanent_plan = BEST_PLAN_CODE
+            info.premium_plan = BEST_PLAN_CODE
+            info.premium_until = datetime.max.replace(tzinfo=timezone.utc)
+            save_state()
+    return plan_from_info(chat_id, info)
+
+
 def has_premium(chat_id: int) -> bool:
     return active_plan(chat_id) != "free"
 
@@ -1165,29 +1883,29 @@ def grant_premium(
 ) -> None:
     info = U(chat_id)
     plan = plan_code if plan_code in PLAN_BEHAVIOR and plan_code != "free" else "basic"
-    info.pop("permanent_plan", None)
+    info.permanent_plan = None
     until = datetime.now(timezone.utc) + timedelta(days=max(1, days))
-    info["premium_until"] = until.isoformat()
-    info["premium_plan"] = plan
-    info["premium_started_at"] = datetime.now(timezone.utc).isoformat()
-    info["premium_source"] = source or "manual"
-    info["premium_payment_method"] = payment_method or info["premium_source"]
-    info["premium_payment_reference"] = payment_reference
-    info["free_used"] = 0
+    info.premium_until = until
+    info.premium_plan = plan
+    info.premium_started_at = datetime.now(timezone.utc)
+    info.premium_source = source or "manual"
+    info.premium_payment_method = payment_method or info.premium_source
+    info.premium_payment_reference = payment_reference
+    info.free_used = 0
     save_state()
 
 
 def grant_permanent_plan(chat_id: int, plan_code: str = BEST_PLAN_CODE) -> None:
     info = U(chat_id)
     plan = plan_code if plan_code in PLAN_BEHAVIOR else BEST_PLAN_CODE
-    info["permanent_plan"] = plan
-    info["premium_plan"] = plan
-    info["premium_until"] = datetime.max.replace(tzinfo=timezone.utc).isoformat()
-    info["premium_started_at"] = datetime.now(timezone.utc).isoformat()
-    info["premium_source"] = "permanent"
-    info["premium_payment_method"] = "permanent"
-    info["premium_payment_reference"] = None
-    info["free_used"] = 0
+    info.permanent_plan = plan
+    info.premium_plan = plan
+    info.premium_until = datetime.max.replace(tzinfo=timezone.utc)
+    info.premium_started_at = datetime.now(timezone.utc)
+    info.premium_source = "permanent"
+    info.premium_payment_method = "permanent"
+    info.premium_payment_reference = None
+    info.free_used = 0
     save_state()
 
 
@@ -1329,18 +2047,9 @@ def should_send_support(chat_id: int, plan_code: str) -> bool:
     interval = plan_behavior(plan_code).get("support_interval")
     if not interval:
         return False
-    info = U(chat_id)
-    last = info.get("last_support")
-    if not last:
-        return True
-    try:
-        last_dt = datetime.fromisoformat(last) if isinstance(last, str) else None
-    except Exception:
-        return True
+    last_dt = U(chat_id).last_support
     if not last_dt:
         return True
-    if last_dt.tzinfo is None:
-        last_dt = last_dt.replace(tzinfo=timezone.utc)
     try:
         hours = float(interval)
     except Exception:
@@ -1349,30 +2058,519 @@ def should_send_support(chat_id: int, plan_code: str) -> bool:
 
 def mark_support_sent(chat_id: int) -> None:
     info = U(chat_id)
-    info["last_support"] = datetime.now(timezone.utc).isoformat()
+    info.last_support = datetime.now(timezone.utc)
     save_state()
 
 
 def set_news_opt_out(chat_id: int) -> bool:
     info = U(chat_id)
-    if info.get("news_opt_out"):
+    if info.news_opt_out:
         return False
-    info["news_opt_out"] = True
-    info["news_opted_at"] = datetime.now(timezone.utc).isoformat()
+    info.news_opt_out = True
+    info.news_opted_at = datetime.now(timezone.utc)
     save_state()
     return True
 
 # ================== OPENAI ==================
-def ask_openai_lyrics(
-        fragment: str,
+# запросы собираются здесь и отправляются либо requests (ниже), либо aiohttp (lumi_async)
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+OPENAI_TRANSCRIBE_URL = "https://api.openai.com/v1/audio/transcriptions"
+CRYPTO_INVOICE_URL = "https://pay.crypt.bot/api/createInvoice"
+
+OPENAI_NO_KEY_REPLY = "API ключ OpenAI не настроен. Проверь .env"
+OPENAI_FAILED_REPLY = "Сейчас мне сложно ответить. Попробуй ещё раз."
+OPENAI_UNAVAILABLE_REPLY = "Сервис ответа временно недоступен. Попробуй ещё раз."
+CRYPTO_FAILED_REPLY = "Ошибка при создании счёта. Попробуйте позже."
+OPENAI_ERROR_REPLIES = frozenset({OPENAI_NO_KEY_REPLY, OPENAI_FAILED_REPLY, OPENAI_UNAVAILABLE_REPLY})
+
+# по одной requests.Session (пулу keep-alive соединений) на апстрим, общей для всех потоков:
+# TLS-рукопожатие — раз на соединение, а не на каждый запрос. Таймауты — (connect, read):
+# соединиться нужно быстро, а ответ модели может идти долго
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(max(10, WEBHOOK_WORKERS))))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_PREWARM = os.getenv("HTTP_PREWARM", "1").strip().lower() in {"1", "true", "yes", "on"}
+HTTP_UPSTREAMS = {
+    "openai": "https://api.openai.com",
+    "telegram": "https://api.telegram.org",
+    "cryptopay": "https://pay.crypt.bot",
+}
+_http_sessions: Dict[str, requests.Session] = {}
+_http_lock = threading.Lock()
+
+
+def http_session(upstream: str) -> requests.Session:
+    session = _http_sessions.get(upstream)
+    if session is None:
+        with _http_lock:
+            session = _http_sessions.get(upstream)
+            if session is None:
+                session = requests.Session()
+                # повтор только при ошибке соединения: запрос до сервера не дошёл, POST не задвоится
+                retry = Retry(total=1, connect=1, read=0, status=0, redirect=0, other=0)
+                session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry))
+                _http_sessions[upstream] = session
+    return session
+
+
+def http_timeout(read: float) -> tuple:
+    return (HTTP_CONNECT_TIMEOUT, read)
+
+
+def prewarm_http() -> None:
+    """Заранее, в фоне, открывает по соединению к каждому апстриму: первый запрос не ждёт TLS."""
+    def warm(upstream: str, url: str) -> None:
+        try:
+            http_session(upstream).head(url, timeout=http_timeout(5))
+        except Exception as exc:
+            logging.warning("HTTP prewarm %s failed: %r", upstream, exc)
+
+    for upstream, url in HTTP_UPSTREAMS.items():
+        threading.Thread(target=warm, args=(upstream, url), name=f"http-prewarm-{upstream}", daemon=True).start()
+
+
+def close_http_sessions() -> None:
+    """Закрывает соединения; сессии остаются и при следующем запросе откроют новые."""
+    with _http_lock:
+        sessions = list(_http_sessions.values())
+    for session in sessions:
+        session.close()
+
+
+# Bot API идёт через тот же пул, что и скачивание файлов Telegram
+apihelper.session = http_session("telegram")
+apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+
+# ================== УСТОЙЧИВОСТЬ К СБОЯМ OPENAI ==================
+# 429 и 5xx чаще всего временные: запрос повторяется до OPENAI_RETRIES раз с паузой
+# по Retry-After, а без него — экспоненциальной со случайным разбросом (чтобы все
+# воркеры не повторяли разом). Если Retry-After длиннее OPENAI_RETRY_AFTER_MAX,
+# ждать его в потоке апдейта бессмысленно — ошибка отдаётся сразу.
+# Настоящий сбой — BREAKER_FAILURES неудач подряд — размыкает автомат эндпоинта:
+# BREAKER_COOLDOWN секунд запросы к нему не уходят вовсе, затем один пробный.
+OPENAI_RETRIES = int(os.getenv("OPENAI_RETRIES", "2"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "8"))
+OPENAI_RETRY_AFTER_MAX = float(os.getenv("OPENAI_RETRY_AFTER_MAX", "20"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+RETRY_STATUSES = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After в секундах: заголовок бывает и числом, и HTTP-датой."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def retry_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    if retry_after is not None:
+        return retry_after
+    # full jitter: случайная пауза от нуля до экспоненциального потолка
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """Автомат на эндпоинт: closed → (failures подряд) open → (cooldown) half-open.
+
+    В half-open пропускается один пробный запрос: успех замыкает автомат,
+    неудача снова размыкает на cooldown. Каждый пропущенный allow() вызов
+    должен закончиться settle(): иначе пробный запрос так и останется «в пути».
+    Неудача засчитывается одна на вызов, а не на каждую его повторную попытку.
+    """
+
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.name = name
+        self.failures = max(1, failures)
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failed = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.rejected = 0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half-open"
+                self.probing = False
+            if self.state == "closed" or (self.state == "half-open" and not self.probing):
+                self.probing = self.state == "half-open"
+                return True
+            self.rejected += 1
+            return False
+
+    def settle(self, ok: Optional[bool]) -> None:
+        """Итог вызова: True — успех, False — сбой, None — без итога (отменён, не дождался лимита)."""
+        if ok is True:
+            self.success()
+        elif ok is False:
+            self.failure()
+        else:
+            with self._lock:
+                self.probing = False
+
+    def success(self) -> None:
+        with self._lock:
+            if self.state != "closed":
+                logging.info("OpenAI %s: circuit closed", self.name)
+            self.state = "closed"
+            self.failed = 0
+            self.probing = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failed += 1
+            if self.state == "half-open" or (self.state == "closed" and self.failed >= self.failures):
+                if self.state == "closed":
+                    self.trips += 1
+                    logging.warning("OpenAI %s: circuit open after %s failures", self.name, self.failed)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {"state": self.state, "failed": self.failed, "trips": self.trips, "rejected": self.rejected}
+
+
+openai_breakers: Dict[str, CircuitBreaker] = {
+    endpoint: CircuitBreaker(endpoint) for endpoint in ("chat", "transcribe", "vision")
+}
+
+
+def openai_post(
+        endpoint: str,
+        url: str,
         *,
-        language: Optional[str],
-        history: Optional[List[Dict[str, str]]],
-        plan: str,
-) -> str:
+        model: str,
+        plan: str = "free",
+        tokens: int = 0,
+        **kwargs,
+) -> Optional[requests.Response]:
+    """POST к OpenAI через лимитер модели, с повторами и автоматом эндпоинта.
+
+    Возвращает последний ответ (в том числе не-200, если повторы кончились или
+    повторять нет смысла) либо None — место в лимите не дождались, автомат
+    разомкнут или соединиться не удалось.
+    """
+    breaker = openai_breakers[endpoint]
+    if not breaker.allow():
+        logging.warning("OpenAI %s: circuit open, request skipped", endpoint)
+        return None
+    ok: Optional[bool] = None  # итог для автомата — один на вызов, а не на попытку
+    try:
+        for attempt in range(OPENAI_RETRIES + 1):
+            last = attempt == OPENAI_RETRIES
+            if not openai_slot(model, plan, tokens):
+                return None
+            try:
+                resp = http_session("openai").post(url, **kwargs)
+            except requests.RequestException as exc:
+                logging.warning("OpenAI %s attempt %s failed: %r", endpoint, attempt + 1, exc)
+                if isinstance(exc, requests.ConnectionError):
+                    openai_refund(model, tokens)
+                if last:
+                    ok = False
+                    return None
+                delay = retry_delay(attempt)
+            else:
+                if resp.status_code not in RETRY_STATUSES:
+                    # 400/401 — ошибка запроса или ключа, а не сбой сервиса: автомат от них не размыкается
+                    ok = True
+                    return resp
+                if resp.status_code == 429:
+                    openai_refund(model, tokens)
+                delay = retry_delay(attempt, parse_retry_after(resp.headers.get("Retry-After")))
+                if last or delay > OPENAI_RETRY_AFTER_MAX:
+                    ok = False
+                    return resp
+                logging.warning("OpenAI %s %s, retry in %.1fs", endpoint, resp.status_code, delay)
+                resp.close()
+            time.sleep(delay)
+        return None
+    finally:
+        breaker.settle(ok)
+
+
+def breaker_stats() -> Dict[str, Dict[str, object]]:
+    return {endpoint: breaker.stats() for endpoint, breaker in openai_breakers.items()}
+
+
+# ================== ЛИМИТЫ OPENAI ==================
+# Клиентские token bucket на модель: запросы в минуту (RPM) и токены в минуту (TPM,
+# по оценке — как считает сам OpenAI: промпт + max_tokens); 0 — без лимита.
+# Кому не хватило места, ждёт в очереди по тарифу (queue_priority в PLAN_BEHAVIOR,
+# warm первым), но не дольше queue_max_wait тарифа — дальше «сервис недоступен».
+# В пик платные подписчики так не стоят за бесплатными.
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "0"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "0"))
+# переопределения по моделям: "gpt-4o=500:30000,whisper-1=50:0"
+OPENAI_MODEL_LIMITS: Dict[str, tuple] = {}
+for _item in os.getenv("OPENAI_MODEL_LIMITS", "").split(","):
+    _model, _, _limits = _item.strip().partition("=")
+    if _model and _limits:
+        _rpm, _, _tpm = _limits.partition(":")
+        OPENAI_MODEL_LIMITS[_model.strip()] = (int(_rpm or 0), int(_tpm or 0))
+# картинка detail=high в gpt-4o(-mini) — до 1105 токенов, low — 85
+IMAGE_TOKENS = {"high": 1105, "low": 85}
+
+try:
+    import tiktoken  # точный подсчёт токенов; без него — оценка ~4 символа на токен
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def load_token_encoding() -> None:
+    """Загружает кодировку tiktoken для OPENAI_TEXT_MODEL; вызывается один раз при старте.
+
+    Файл кодировки скачивается при первом обращении — это секунды сетевого
+    ожидания, им не место в обработчике апдейта или в event loop.
+    """
+    global _encoding
+    if tiktoken is None:
+        logging.warning("tiktoken not installed, estimating tokens by length")
+        return
+    with _encoding_lock:
+        if _encoding is not None:
+            return
+        try:
+            try:
+                _encoding = tiktoken.encoding_for_model(OPENAI_TEXT_MODEL)
+            except KeyError:
+                _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as exc:
+            logging.warning("tiktoken unavailable, estimating tokens by length: %r", exc)
+
+
+def token_encoding():
+    """Кодировка tiktoken, загруженная load_token_encoding(); None — считаем приблизительно."""
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def truncate_tokens(text: str, limit: int) -> str:
+    """Начало text не длиннее limit токенов."""
+    encoding = token_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:limit])
+    return text[:limit * 4]
+
+
+def message_tokens(message: Dict[str, object]) -> int:
+    # +4 — служебная разметка сообщения в chat-формате
+    return count_tokens(str(message.get("content") or "")) + 4
+
+
+def payload_tokens(payload: Dict[str, object]) -> int:
+    """Сколько токенов запрос спишет с TPM: сообщения + max_tokens."""
+    total = int(payload.get("max_tokens") or 0)
+    for message in payload.get("messages") or []:
+        total += 4  # служебная разметка сообщения
+        content = message.get("content")
+        if isinstance(content, str):
+            total += count_tokens(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                total += count_tokens(str(part.get("text") or ""))
+            elif part.get("type") == "image_url":
+                total += IMAGE_TOKENS.get(part.get("image_url", {}).get("detail"), IMAGE_TOKENS["high"])
+    return total
+
+
+class RateLimiter:
+    """RPM- и TPM-ведра одной модели с очередью по приоритету.
+
+    Место получает только голова очереди — наименьший (priority, seq): поздний
+    warm обгоняет ждущих free, внутри тарифа порядок FIFO. poll() не блокирует,
+    поэтому одна очередь годится и для потоков (acquire), и для asyncio.
+    """
+
+    def __init__(self, model: str, rpm: int, tpm: int):
+        self.model = model
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.waiting: List[tuple] = []
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.granted = 0
+        self.delayed = 0
+        self.timeouts = 0
+        self.max_wait = 0.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        if self.rpm:
+            self.requests = min(float(self.rpm), self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(float(self.tpm), self.tokens + elapsed * self.tpm / 60)
+
+    def _shortfall(self, tokens: int) -> float:
+        """Через сколько секунд в вёдрах хватит места на запрос; 0 — уже хватает."""
+        need = 0.0
+        if self.rpm and self.requests < 1:
+            need = (1 - self.requests) * 60 / self.rpm
+        if self.tpm and self.tokens < min(tokens, self.tpm):
+            need = max(need, (min(tokens, self.tpm) - self.tokens) * 60 / self.tpm)
+        return need
+
+    def enqueue(self, priority: int) -> tuple:
+        with self.cond:
+            self.seq += 1
+            ticket = (priority, self.seq, time.monotonic())
+            self.waiting.append(ticket)
+            return ticket
+
+    def poll(self, ticket: tuple, tokens: int) -> float:
+        """0 — место выдано и билет снят с очереди; иначе сколько ещё ждать."""
+        with self.cond:
+            self._refill()
+            need = self._shortfall(tokens)
+            if ticket != min(self.waiting):
+                return max(need, 0.05)
+            if need > 0:
+                return need
+            if self.rpm:
+                self.requests -= 1
+            if self.tpm:
+                self.tokens -= min(tokens, self.tpm)
+            self.waiting.remove(ticket)
+            waited = time.monotonic() - ticket[2]
+            self.granted += 1
+            if waited > 0.001:
+                self.delayed += 1
+                self.max_wait = max(self.max_wait, waited)
+            self.cond.notify_all()
+            return 0.0
+
+    def refund(self, tokens: int) -> None:
+        """Возвращает в TPM-ведро токены попытки, которую OpenAI не засчитал."""
+        with self.cond:
+            if self.tpm:
+                self.tokens = min(float(self.tpm), self.tokens + min(tokens, self.tpm))
+                self.cond.notify_all()
+
+    def cancel(self, ticket: tuple, timeout: bool = False) -> None:
+        with self.cond:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                self.cond.notify_all()
+            if timeout:
+                self.timeouts += 1
+
+    def acquire(self, priority: int, tokens: int, max_wait: float) -> bool:
+        ticket = self.enqueue(priority)
+        deadline = time.monotonic() + max_wait
+        try:
+            with self.cond:
+                while True:
+                    delay = self.poll(ticket, tokens)
+                    if not delay:
+                        return True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.cancel(ticket, timeout=True)
+                        return False
+                    self.cond.wait(min(delay, remaining))
+        except BaseException:
+            self.cancel(ticket)
+            raise
+
+    def stats(self) -> Dict[str, object]:
+        with self.cond:
+            return {
+                "rpm": self.rpm,
+                "tpm": self.tpm,
+                "queued": len(self.waiting),
+                "granted": self.granted,
+                "delayed": self.delayed,
+                "timeouts": self.timeouts,
+                "max_wait_ms": round(self.max_wait * 1000, 1),
+            }
+
+
+_openai_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def openai_limiter(model: str) -> Optional[RateLimiter]:
+    rpm, tpm = OPENAI_MODEL_LIMITS.get(model, (OPENAI_RPM, OPENAI_TPM))
+    if not (rpm or tpm):
+        return None
+    with _limiters_lock:
+        limiter = _openai_limiters.get(model)
+        if limiter is None:
+            limiter = _openai_limiters[model] = RateLimiter(model, rpm, tpm)
+        return limiter
+
+
+def queue_params(plan: str) -> tuple:
+    """(priority, max_wait) тарифа для очереди лимитера."""
+    behavior = plan_behavior(plan)
+    return int(behavior.get("queue_priority", 3)), float(behavior.get("queue_max_wait", 3.0))
+
+
+def openai_slot(model: str, plan: str, tokens: int) -> bool:
+    limiter = openai_limiter(model)
+    if limiter is None:
+        return True
+    priority, max_wait = queue_params(plan)
+    if limiter.acquire(priority, tokens, max_wait):
+        return True
+    logging.warning("OpenAI %s: no rate limit slot within %gs for plan %s", model, max_wait, plan)
+    return False
+
+
+def openai_refund(model: str, tokens: int) -> None:
+    """Попытка не дошла до OpenAI (нет соединения) или отбита 429 — её токены в TPM не ушли."""
+    limiter = openai_limiter(model)
+    if limiter is not None:
+        limiter.refund(tokens)
+
+
+def limiter_stats() -> Dict[str, Dict[str, object]]:
+    with _limiters_lock:
+        limiters = list(_openai_limiters.values())
+    return {limiter.model: limiter.stats() for limiter in limiters}
+
+
+def openai_headers(json_body: bool = True) -> Dict[str, str]:
+    headers = {"Authorization": f"Bearer {OPENAI_KEY}"}
+    if json_body:
+        headers["Content-Type"] = "application/json"
+    return headers
+
+
+def lyrics_prompt(fragment: str, language: Optional[str]) -> str:
     lang = (language or DEFAULT_LANGUAGE).lower()
     if lang.startswith("en"):
-        prompt = (
+        return (
             "MODE: SONG GUESS AND CONTINUATION.\n"
             "You receive one or two lines from a song (or something similar). Tasks:\n"
             "1) Try to identify the song and performer.\n"
@@ -1381,20 +2579,56 @@ def ask_openai_lyrics(
             "4) If the quote contains profanity, repeat it exactly as in the original — it's not an insult toward you.\n"
             f"\nQUOTE: {fragment}"
         )
-    else:
-        prompt = (
-            "РЕЖИМ: ПОИСК ПЕСНИ И КОРОТКОЕ ПРОДОЛЖЕНИЕ.\n"
-            "Тебе прислали одну-две строки из песни (или похожую фразу). Задача:\n"
-            "1) Попробуй узнать песню и исполнителя.\n"
-            "2) Если уверена — продолжи оригинальный текст на 1–2 строки без цензуры.\n"
-            "3) Если не уверена — попроси подсказку и добавь дружелюбный комментарий.\n"
-            "4) Если в цитате есть ненормативная лексика, повтори её как в оригинале — это не оскорбление в твой адрес.\n"
-            f"\nЦИТАТА: {fragment}"
-        )
-    return ask_openai(prompt, language=language, history=history, plan=plan)
+    return (
+        "РЕЖИМ: ПОИСК ПЕСНИ И КОРОТКОЕ ПРОДОЛЖЕНИЕ.\n"
+        "Тебе прислали одну-две строки из песни (или похожую фразу). Задача:\n"
+        "1) Попробуй узнать песню и исполнителя.\n"
+        "2) Если уверена — продолжи оригинальный текст на 1–2 строки без цензуры.\n"
+        "3) Если не уверена — попроси подсказку и добавь дружелюбный комментарий.\n"
+        "4) Если в цитате есть ненормативная лексика, повтори её как в оригинале — это не оскорбление в твой адрес.\n"
+        f"\nЦИТАТА: {fragment}"
+    )
 
 
-def ask_openai(
+def ask_openai_lyrics(
+        fragment: str,
+        *,
+        language: Optional[str],
+        history: Optional[List[Dict[str, str]]],
+        plan: str,
+) -> str:
+    return ask_openai(lyrics_prompt(fragment, language), language=language, history=history, plan=plan)
+
+
+# размер промптов: сколько вызовов упёрлось в prompt_token_budget и урезало историю
+prompt_stats: Dict[str, int] = {"calls": 0, "tokens_total": 0, "tokens_max": 0, "trimmed": 0}
+_prompt_stats_lock = threading.Lock()
+# обрезанная реплика короче этого не нужна — от неё остаётся пара слов без смысла
+MIN_TRUNCATED_TOKENS = 32
+
+
+def fit_history(history: List[Dict[str, str]], budget: int) -> List[Dict[str, str]]:
+    """Самый свежий хвост истории, который влезает в budget токенов.
+
+    Реплики берутся с конца; первая не влезшая обрезается (начало + «…»),
+    если от бюджета осталось хотя бы MIN_TRUNCATED_TOKENS, всё более старое отбрасывается.
+    """
+    fitted: List[Dict[str, str]] = []
+    for message in reversed(history):
+        cost = message_tokens(message)
+        if cost <= budget:
+            fitted.append(message)
+            budget -= cost
+            continue
+        if budget - 4 >= MIN_TRUNCATED_TOKENS:
+            content = truncate_tokens(str(message.get("content") or ""), budget - 5) + "…"
+            fitted.append({**message, "content": content})
+        break
+    fitted.reverse()
+    return fitted
+
+
+def build_chat_payload(
         prompt: str,
         *,
         language: Optional[str] = None,
@@ -1403,7 +2637,7 @@ def ask_openai(
         system_override: Optional[str] = None,
         history_override: Optional[List[Dict[str, str]]] = None,
         context_note: Optional[str] = None,
-) -> str:
+) -> Dict[str, object]:
     lang = (language or DEFAULT_LANGUAGE).lower()
     preset = language_preset(lang)
     persona_map = preset.get("personas", {}) if isinstance(preset.get("personas"), dict) else {}
@@ -1420,9 +2654,6 @@ def ask_openai(
     if max_tokens < 150:
         max_tokens = 150
 
-    if not OPENAI_KEY:
-        return "API ключ OpenAI не настроен. Проверь .env"
-
     messages: List[Dict[str, object]] = [
         {"role": "system", "content": system_message},
     ]
@@ -1432,11 +2663,28 @@ def ask_openai(
         messages.append({"role": "system", "content": style_hint})
     if context_note:
         messages.append({"role": "system", "content": context_note})
-    if effective_history:
-        messages.extend(effective_history[-history_limit * 2:])
+    # история — в бюджет тарифа за вычетом system-сообщений; текущая реплика не режется
+    budget = int(behavior.get("prompt_token_budget") or 0)
+    window = list(effective_history or [])[-history_limit * 2:]
+    fitted = window
+    if budget > 0:
+        fitted = fit_history(window, budget - sum(message_tokens(message) for message in messages))
+    messages.extend(fitted)
     messages.append({"role": "user", "content": prompt})
 
-    payload = {
+    prompt_tokens = sum(message_tokens(message) for message in messages) + 3  # +3 — затравка ответа
+    with _prompt_stats_lock:
+        prompt_stats["calls"] += 1
+        prompt_stats["tokens_total"] += prompt_tokens
+        prompt_stats["tokens_max"] = max(prompt_stats["tokens_max"], prompt_tokens)
+        if fitted != window:
+            prompt_stats["trimmed"] += 1
+    logging.info(
+        "Prompt %s tokens (plan %s, budget %s, history %s/%s messages)",
+        prompt_tokens, plan, budget or "-", len(fitted), len(window),
+    )
+
+    return {
         "model": OPENAI_TEXT_MODEL,
         "messages": messages,
         "temperature": temperature,
@@ -1445,50 +2693,89 @@ def ask_openai(
         "frequency_penalty": frequency_penalty,
     }
 
+
+def prompt_metrics() -> Dict[str, object]:
+    with _prompt_stats_lock:
+        stats = dict(prompt_stats)
+    calls = stats["calls"]
+    return {
+        "calls": calls,
+        "tokens_avg": round(stats["tokens_total"] / calls, 1) if calls else 0.0,
+        "tokens_max": stats["tokens_max"],
+        "trimmed": stats["trimmed"],
+        "tokenizer": "tiktoken" if token_encoding() is not None else "estimate",
+    }
+
+
+def ask_openai(
+        prompt: str,
+        *,
+        language: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        plan: str = "free",
+        system_override: Optional[str] = None,
+        history_override: Optional[List[Dict[str, str]]] = None,
+        context_note: Optional[str] = None,
+) -> str:
+    if not OPENAI_KEY:
+        return OPENAI_NO_KEY_REPLY
+
+    payload = build_chat_payload(
+        prompt,
+        language=language,
+        history=history,
+        plan=plan,
+        system_override=system_override,
+        history_override=history_override,
+        context_note=context_note,
+    )
+
     try:
-        resp = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENAI_KEY}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=30,
+        resp = openai_post(
+            "chat", OPENAI_CHAT_URL, model=OPENAI_TEXT_MODEL, plan=plan, tokens=payload_tokens(payload),
+            headers=openai_headers(), json=payload, timeout=http_timeout(30),
         )
     except Exception as exc:
         logging.exception("OpenAI HTTP error: %r", exc)
-        return "Сейчас мне сложно ответить. Попробуй ещё раз."
+        return OPENAI_FAILED_REPLY
 
+    if resp is None:
+        return OPENAI_UNAVAILABLE_REPLY
     if resp.status_code != 200:
         logging.error("OpenAI %s: %s", resp.status_code, resp.text)
-        return "Сервис ответа временно недоступен. Попробуй ещё раз."
+        return OPENAI_UNAVAILABLE_REPLY
 
     try:
         data = resp.json()
         return data["choices"][0]["message"]["content"].strip()
     except Exception as exc:
         logging.exception("OpenAI parse error: %r | body=%s", exc, resp.text[:500])
-        return "Сейчас мне сложно ответить. Попробуй ещё раз."
+        return OPENAI_FAILED_REPLY
 
 
-def create_crypto_invoice(plan_code: str, chat_id: int) -> str:
+def crypto_invoice_payload(plan_code: str, chat_id: int) -> Optional[Dict[str, str]]:
     plan = PLANS.get(plan_code)
-    if not plan:
-        return FALLBACK.get(plan_code) or "https://t.me/CryptoBot"
-    if CRYPTO_API:
+    if not plan or not CRYPTO_API:
+        return None
+    return {
+        "currency_type": "fiat",
+        "fiat": "RUB",
+        "amount": str(plan["price"]),
+        "description": f"Lumi — план {plan_name(plan_code, 'ru')} на {plan['days']} дней",
+        "hidden_message": "Спасибо за поддержку Lumi!",
+        "expires_in": 900,
+        "payload": f"{chat_id}:{plan_code}",
+    }
+
+
+def create_crypto_invoice(plan_code: str, chat_id: int) -> str:
+    payload = crypto_invoice_payload(plan_code, chat_id)
+    if payload:
         try:
-            url = "https://pay.crypt.bot/api/createInvoice"
             headers = {"Crypto-Pay-API-Token": CRYPTO_API}
-            payload = {
-                "currency_type": "fiat",
-                "fiat": "RUB",
-                "amount": str(plan["price"]),
-                "description": f"Lumi — план {plan_name(plan_code, 'ru')} на {plan['days']} дней",
-                "hidden_message": "Спасибо за поддержку Lumi!",
-                "expires_in": 900,
-                "payload": f"{chat_id}:{plan_code}",
-            }
-            response = requests.post(url, headers=headers, data=payload, timeout=15)
+            response = http_session("cryptopay").post(
+                CRYPTO_INVOICE_URL, headers=headers, data=payload, timeout=http_timeout(15),
+            )
             response.raise_for_status()
             data = response.json()
             pay_url = data.get("result", {}).get("pay_url") if data.get("ok") else None
@@ -1496,15 +2783,18 @@ def create_crypto_invoice(plan_code: str, chat_id: int) -> str:
                 return str(pay_url)
         except Exception as exc:
             logging.exception("CryptoPay error: %r", exc)
-            return "Ошибка при создании счёта. Попробуйте позже."
+            return CRYPTO_FAILED_REPLY
     return FALLBACK.get(plan_code) or "https://t.me/CryptoBot"
 
 
+def telegram_file_url(file_path: str) -> str:
+    return f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
+
+
 def download_file(file_id: str) -> Optional[tuple[bytes, str]]:
     try:
         file_info = bot.get_file(file_id)
-        url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-        response = requests.get(url, timeout=30)
+        response = http_session("telegram").get(telegram_file_url(file_info.file_path), timeout=http_timeout(30))
         response.raise_for_status()
         return response.content, file_info.file_path
     except Exception as exc:
@@ -1512,26 +2802,32 @@ def download_file(file_id: str) -> Optional[tuple[bytes, str]]:
         return None
 
 
-def transcribe_audio(chat_id: int, file_bytes: bytes, filename: str) -> Optional[str]:
-    if not (OPENAI_KEY and OPENAI_TRANSCRIBE_MODEL):
-        return None
-
+def audio_mime(filename: str) -> str:
     # У Telegram voice обычно .oga/.ogg (Opus). Видео нередко .mp4
     mime, _ = mimetypes.guess_type(filename)
     ext = (filename or "").lower()
     if ext.endswith(".oga") or ext.endswith(".ogg"):
         mime = "audio/ogg"
-    if not mime:
-        mime = "application/octet-stream"
+    return mime or "application/octet-stream"
+
+
+def transcribe_audio(chat_id: int, file_bytes: bytes, filename: str) -> Optional[str]:
+    if not (OPENAI_KEY and OPENAI_TRANSCRIBE_MODEL):
+        return None
 
     try:
-        r = requests.post(
-            "https://api.openai.com/v1/audio/transcriptions",
-            headers={"Authorization": f"Bearer {OPENAI_KEY}"},
-            files={"file": (filename, file_bytes, mime)},
+        r = openai_post(
+            "transcribe",
+            OPENAI_TRANSCRIBE_URL,
+            model=OPENAI_TRANSCRIBE_MODEL,
+            plan=active_plan(chat_id),
+            headers=openai_headers(json_body=False),
+            files={"file": (filename, file_bytes, audio_mime(filename))},
             data={"model": OPENAI_TRANSCRIBE_MODEL, "language": get_language(chat_id)},
-            timeout=120,
+            timeout=http_timeout(120),
         )
+        if r is None:
+            return None
         if r.status_code != 200:
             logging.error("ASR HTTP %s: %s", r.status_code, r.text[:2000])
             return None
@@ -1546,10 +2842,7 @@ def transcribe_audio(chat_id: int, file_bytes: bytes, filename: str) -> Optional
         return None
 
 
-def describe_image(chat_id: int, file_bytes: bytes, filename: str) -> Optional[str]:
-    if not (OPENAI_KEY and OPENAI_VISION_MODEL):
-        return None
-
+def vision_payload(chat_id: int, file_bytes: bytes, filename: str) -> Optional[Dict[str, object]]:
     prompt_text = VISION_PROMPTS.get(get_language(chat_id), VISION_PROMPTS[DEFAULT_LANGUAGE])
 
     mime, _ = mimetypes.guess_type(filename)
@@ -1562,7 +2855,7 @@ def describe_image(chat_id: int, file_bytes: bytes, filename: str) -> Optional[s
         logging.exception("Image base64 encode failed: %r", exc)
         return None
 
-    payload = {
+    return {
         "model": OPENAI_VISION_MODEL,  # gpt-4o
         "messages": [{
             "role": "user",
@@ -1577,13 +2870,22 @@ def describe_image(chat_id: int, file_bytes: bytes, filename: str) -> Optional[s
         "max_tokens": 700,
     }
 
+
+def describe_image(chat_id: int, file_bytes: bytes, filename: str) -> Optional[str]:
+    if not (OPENAI_KEY and OPENAI_VISION_MODEL):
+        return None
+
+    payload = vision_payload(chat_id, file_bytes, filename)
+    if payload is None:
+        return None
+
     try:
-        r = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={"Authorization": f"Bearer {OPENAI_KEY}", "Content-Type": "application/json"},
-            json=payload,
-            timeout=120,
+        r = openai_post(
+            "vision", OPENAI_CHAT_URL, model=OPENAI_VISION_MODEL, plan=active_plan(chat_id),
+            tokens=payload_tokens(payload), headers=openai_headers(), json=payload, timeout=http_timeout(120),
         )
+        if r is None:
+            return None
         if r.status_code != 200:
             logging.error("Vision HTTP %s: %s", r.status_code, r.text[:2000])
             return None
@@ -1598,15 +2900,218 @@ def describe_image(chat_id: int, file_bytes: bytes, filename: str) -> Optional[s
         return None
 
 
+# ================== ПОТОКОВЫЕ ОТВЕТЫ ==================
+# OPENAI_STREAM=1 (по умолчанию выключено): ответ модели появляется в чате по мере генерации — первое сообщение
+# с первыми токенами, дальше правки не чаще раза в STREAM_EDIT_INTERVAL секунд
+# (частые edit_message_text в одном чате Telegram режет с 429). В историю ответ
+# попадает только целиком.
+OPENAI_STREAM = os.getenv("OPENAI_STREAM", "0").strip().lower() in {"1", "true", "yes", "on"}
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+# финальный кадр ждёт 429 столько раз; не доставили — ответ в историю не пишется
+STREAM_FINAL_RETRIES = int(os.getenv("STREAM_FINAL_RETRIES", "5"))
+TELEGRAM_TEXT_LIMIT = 4096
+
+# время до первого видимого текста — задержка, которую пользователь ощущает
+stream_stats: Dict[str, float] = {"replies": 0, "incomplete": 0, "first_visible_ms_total": 0, "first_visible_ms_max": 0}
+_stream_stats_lock = threading.Lock()
+
+
+def sse_delta(line: str) -> Optional[str]:
+    """Кусок текста из строки SSE-потока chat completions; None — поток закончился."""
+    if not line.startswith("data:"):
+        return ""
+    data = line[5:].strip()
+    if data == "[DONE]":
+        return None
+    try:
+        choice = json.loads(data)["choices"][0]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return ""
+    return (choice.get("delta") or {}).get("content") or ""
+
+
+def telegram_retry_after(exc: Exception) -> Optional[float]:
+    """Пауза из ответа 429 Telegram; None — это не 429."""
+    if getattr(exc, "error_code", None) != 429:
+        return None
+    params = (getattr(exc, "result_json", None) or {}).get("parameters") or {}
+    return float(params.get("retry_after", 1))
+
+
+class ReplyStream:
+    """Раскладка потокового ответа по сообщениям Telegram, без сетевых вызовов.
+
+    push() копит текст; due() — пора ли показать накопленное (первый раз —
+    сразу, дальше не чаще interval); changes() — какие сообщения ответа
+    отправить (index == числу показанных) или отредактировать. Ответ длиннее
+    TELEGRAM_TEXT_LIMIT продолжается следующим сообщением.
+    """
+
+    def __init__(self, interval: float = STREAM_EDIT_INTERVAL):
+        self.text = ""
+        self.shown: List[str] = []
+        self.interval = interval
+        self.next_at = 0.0
+        self.started = time.monotonic()
+        self.first_visible_ms: Optional[float] = None
+
+    def push(self, delta: str) -> None:
+        self.text += delta
+
+    def parts(self) -> List[str]:
+        text = self.text.strip()
+        return [text[i:i + TELEGRAM_TEXT_LIMIT] for i in range(0, len(text), TELEGRAM_TEXT_LIMIT)]
+
+    def due(self) -> bool:
+        return bool(self.text.strip()) and time.monotonic() >= self.next_at
+
+    def changes(self) -> List[tuple]:
+        return [
+            (index, part) for index, part in enumerate(self.parts())
+            if index >= len(self.shown) or self.shown[index] != part
+        ]
+
+    def mark_shown(self, index: int, part: str) -> None:
+        if index == len(self.shown):
+            self.shown.append(part)
+        else:
+            self.shown[index] = part
+        if self.first_visible_ms is None:
+            self.first_visible_ms = (time.monotonic() - self.started) * 1000
+
+    def throttle(self, delay: Optional[float] = None) -> None:
+        self.next_at = time.monotonic() + (self.interval if delay is None else delay)
+
+    def record(self, complete: bool) -> None:
+        with _stream_stats_lock:
+            stream_stats["replies"] += 1
+            if not complete:
+                stream_stats["incomplete"] += 1
+            if self.first_visible_ms is not None:
+                stream_stats["first_visible_ms_total"] += self.first_visible_ms
+                stream_stats["first_visible_ms_max"] = max(stream_stats["first_visible_ms_max"], self.first_visible_ms)
+
+
+def stream_metrics() -> Dict[str, object]:
+    with _stream_stats_lock:
+        stats = dict(stream_stats)
+    replies = stats["replies"]
+    return {
+        "replies": int(replies),
+        "incomplete": int(stats["incomplete"]),
+        "first_visible_avg_ms": round(stats["first_visible_ms_total"] / replies, 1) if replies else 0.0,
+        "first_visible_max_ms": round(stats["first_visible_ms_max"], 1),
+    }
+
+
+def _stream_frame(chat_id: int, message_ids: List[int], index: int, part: str, final: bool) -> Optional[float]:
+    """Отправляет или правит одно сообщение ответа; возвращает паузу, если Telegram ответил 429.
+
+    Промежуточные кадры идут без разметки (HTML-тег может быть ещё не закрыт),
+    финальный — с parse_mode бота, а если Telegram его не разобрал, остаётся как есть.
+    """
+    for parse_mode in ((None, "") if final else ("",)):
+        try:
+            if index >= len(message_ids):
+                message_ids.append(bot.send_message(chat_id, part, parse_mode=parse_mode).message_id)
+            else:
+                bot.edit_message_text(part, chat_id, message_ids[index], parse_mode=parse_mode)
+            return None
+        except apihelper.ApiTelegramException as exc:
+            delay = telegram_retry_after(exc)
+            if delay is not None:
+                return delay
+            if "message is not modified" in exc.description:
+                return None
+            if "can't parse entities" not in exc.description:
+                raise
+    return None
+
+
+def show_stream(chat_id: int, stream: ReplyStream, message_ids: List[int], final: bool = False) -> bool:
+    """Показывает накопленный текст; False — Telegram не принял кадр (429).
+
+    Промежуточный кадр при 429 просто откладывается, финальный повторяется до
+    STREAM_FINAL_RETRIES раз: иначе в чате остался бы обрезанный ответ.
+    """
+    frames = list(enumerate(stream.parts())) if final else stream.changes()
+    for index, part in frames:
+        delay = _stream_frame(chat_id, message_ids, index, part, final)
+        retries = STREAM_FINAL_RETRIES if final else 0
+        while delay is not None and retries:
+            retries -= 1
+            time.sleep(min(delay, 10.0))
+            delay = _stream_frame(chat_id, message_ids, index, part, final)
+        if delay is not None:
+            stream.throttle(delay)
+            return False
+        stream.mark_shown(index, part)
+    stream.throttle()
+    return True
+
+
+def stream_reply(chat_id: int, prompt: str, **kwargs) -> Optional[str]:
+    """ask_openai + send_message, но ответ показывается по мере генерации.
 
-def plans_text(chat_id: int) -> str:
+    Возвращает ответ целиком; None — ответа нет или он оборвался: что успело
+    прийти, остаётся в чате (с «…»), но в историю не пишется.
+    """
+    if not OPENAI_KEY:
+        bot.send_message(chat_id, OPENAI_NO_KEY_REPLY)
+        return None
+    payload = build_chat_payload(prompt, **kwargs)
+    payload["stream"] = True
+    stream = ReplyStream()
+    message_ids: List[int] = []
+    complete = False
+    try:
+        resp = openai_post(
+            "chat", OPENAI_CHAT_URL, model=OPENAI_TEXT_MODEL, plan=kwargs.get("plan", "free"),
+            tokens=payload_tokens(payload), headers=openai_headers(), json=payload, stream=True,
+            timeout=http_timeout(30),
+        )
+        if resp is None:
+            bot.send_message(chat_id, OPENAI_UNAVAILABLE_REPLY)
+            return None
+        with resp:
+            if resp.status_code != 200:
+                logging.error("OpenAI %s: %s", resp.status_code, resp.text[:2000])
+                bot.send_message(chat_id, OPENAI_UNAVAILABLE_REPLY)
+                return None
+            resp.encoding = "utf-8"  # text/event-stream приходит без charset
+            for line in resp.iter_lines(decode_unicode=True):
+                delta = sse_delta(line or "")
+                if delta is None:
+                    complete = True
+                    break
+                if delta:
+                    stream.push(delta)
+                    if stream.due():
+                        show_stream(chat_id, stream, message_ids)
+    except Exception as exc:
+        logging.exception("OpenAI stream error: %r", exc)
+    if not stream.text.strip():
+        bot.send_message(chat_id, OPENAI_FAILED_REPLY)
+        return None
+    if not complete:
+        stream.push(" …")
+    if not show_stream(chat_id, stream, message_ids, final=True):
+        logging.warning("Stream reply to %s: final frame not delivered", chat_id)
+        complete = False
+    stream.record(complete)
+    return stream.text.strip() if complete else None
+
+
+
+def plans_text(chat_id: int, urls: Optional[Dict[str, str]] = None) -> str:
+    """Текст с тарифами; urls — уже созданные ссылки на оплату (иначе счета создаются здесь)."""
     lang = get_language(chat_id)
     lines = [lang_text(chat_id, "plan_intro") or str(LANGUAGES[DEFAULT_LANGUAGE]["plan_intro"])]
     for code in PLAN_CODES:
         plan = PLANS.get(code)
         if not plan:
             continue
-        url = create_crypto_invoice(code, chat_id)
+        url = urls[code] if urls is not None else create_crypto_invoice(code, chat_id)
         perks = plan_perks(code, lang)
         perks_block = "\n".join(f"  – {perk}" for perk in perks)
         lines.append(
@@ -1693,19 +3198,381 @@ def send_policy(chat_id: int) -> None:
 
 
 
+# ================== ОЧЕРЕДЬ АПДЕЙТОВ ==================
+def update_chat_id(update) -> Optional[int]:
+    for msg in (update.message, update.edited_message):
+        if msg is not None:
+            return msg.chat.id
+    query = update.callback_query
+    if query is not None:
+        if query.message is not None:
+            return query.message.chat.id
+        return query.from_user.id
+    return None
+
+
+def is_free_tier(chat_id: Optional[int]) -> bool:
+    """Бесплатный ли тариф — только по уже загруженной записи, без похода в стор."""
+    if chat_id is None:
+        return True
+    info = users.get(str(chat_id))
+    if info is None:
+        # в ленивом режиме незагруженный пользователь может оказаться платным
+        return not STATE_LAZY
+    return plan_from_info(chat_id, info) == "free"
+
+
+class UpdateDeduper:
+    """Недавно принятые update_id: повторная доставка того же апдейта отбрасывается.
+
+    В памяти — OrderedDict update_id -> время приёма; записи старше window
+    секунд и сверх size штук забываются. С shared апдейт ещё и «забирается»
+    в seen_updates (store.claim_update), так что повтор, пришедший на другой
+    инстанс, тоже отбрасывается.
+    """
+
+    def __init__(self, window: float, size: int, shared: bool = False):
+        self.window = max(1.0, window)
+        self.size = max(1, size)
+        self.shared = shared
+        self._seen: "OrderedDict[int, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+        self.checked = 0
+        self.duplicates = 0
+        self.shared_errors = 0
+
+    def claim(self, update_id: int) -> bool:
+        """True — апдейт новый и теперь числится принятым, False — дубликат."""
+        now = time.monotonic()
+        with self._lock:
+            self.checked += 1
+            while self._seen:
+                oldest = next(iter(self._seen.values()))
+                if now - oldest < self.window and len(self._seen) < self.size:
+                    break
+                self._seen.popitem(last=False)
+            if update_id in self._seen:
+                self.duplicates += 1
+                return False
+            self._seen[update_id] = now
+        if self.shared and store.is_db():
+            try:
+                if not store.claim_update(update_id):
+                    with self._lock:
+                        self.duplicates += 1
+                    return False
+                self._prune_shared(now)
+            except Exception as exc:
+                # база недоступна: лучше обработать апдейт дважды, чем потерять
+                logging.warning("claim_update %s failed: %r", update_id, exc)
+                with self._lock:
+                    self.shared_errors += 1
+        return True
+
+    def release(self, update_id: int) -> None:
+        """Забывает апдейт, который вернули Telegram на повтор (503)."""
+        with self._lock:
+            self._seen.pop(update_id, None)
+        if self.shared and store.is_db():
+            try:
+                store.release_update(update_id)
+            except Exception as exc:
+                logging.warning("release_update %s failed: %r", update_id, exc)
+
+    def _prune_shared(self, now: float) -> None:
+        with self._lock:
+            if now - self._pruned_at < 60:
+                return
+            self._pruned_at = now
+        store.prune_seen_updates(self.window)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "checked": self.checked,
+                "duplicates": self.duplicates,
+                "tracked": len(self._seen),
+                "window_s": self.window,
+                "shared": self.shared,
+                "shared_errors": self.shared_errors,
+            }
+
+
+update_deduper = UpdateDeduper(UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_SIZE, UPDATE_DEDUP_SHARED)
+
+
+class UpdateWorkerPool:
+    """Фиксированный пул потоков для апдейтов с ограниченной очередью.
+
+    Апдейты одного чата выполняются строго по очереди и в порядке поступления,
+    разные чаты — параллельно: у каждого чата своя очередь, а воркеры берут
+    чаты из общей очереди готовых. Чат, который сейчас обрабатывается, в неё
+    не попадает, пока его текущий апдейт не закончится.
+
+    submit() по умолчанию не блокирует: при переполнении апдейт не принимается,
+    что с ним делать — решает вызывающий (см. WEBHOOK_OVERLOAD).
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = max(1, workers)
+        self.capacity = max(1, queue_size)
+        self._cond = threading.Condition()
+        # ключ чата -> ожидающие (enqueued_at, update); ключ есть, пока у чата есть работа
+        self._pending: Dict[object, deque] = {}
+        self._ready: deque = deque()  # чаты с работой, которые сейчас никто не обрабатывает
+        self._size = 0
+        self._threads: List[threading.Thread] = []
+        self.accepted = 0
+        self.rejected = 0
+        self.shed = 0
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.closed = False
+
+    def start(self, workers: Optional[int] = None) -> None:
+        with self._cond:
+            if self._threads:
+                return
+            if workers:
+                self.workers = max(1, workers)
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"update-worker-{n}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def depth(self) -> int:
+        with self._cond:
+            return self._size
+
+    def submit(self, update, block: bool = False) -> bool:
+        key = update_chat_id(update)
+        if key is None:
+            key = ("update", update.update_id)  # без чата — порядок не важен
+        with self._cond:
+            while self._size >= self.capacity and not self.closed:
+                if not block:
+                    self.rejected += 1
+                    return False
+                self._cond.wait()
+            if self.closed:
+                return False
+            items = self._pending.get(key)
+            if items is None:
+                items = self._pending[key] = deque()
+                self._ready.append(key)
+            items.append((time.monotonic(), update))
+            self._size += 1
+            self.accepted += 1
+            self._cond.notify_all()
+        return True
+
+    def close(self) -> None:
+        """Больше не принимает апдейты; уже принятые воркеры доделывают."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def drain(self, timeout: float) -> Dict[str, int]:
+        """Ждёт, пока очередь и воркеры опустеют, но не дольше timeout секунд."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            processed = self.processed
+            pending = self._size + self.busy
+            while self._size + self.busy and self._threads:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return {
+                "pending": pending,
+                "drained": self.processed - processed,
+                "queued_left": self._size,
+                "in_flight_left": self.busy,
+            }
+
+    def note_shed(self) -> None:
+        with self._cond:
+            self.shed += 1
+
+    def _take(self) -> tuple:
+        with self._cond:
+            while not self._ready:
+                self._cond.wait()
+            key = self._ready.popleft()
+            enqueued_at, update = self._pending[key].popleft()
+            waited = time.monotonic() - enqueued_at
+            self._size -= 1
+            self.busy += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self._cond.notify_all()  # освободилось место для блокирующего submit()
+            return key, update
+
+    def _done(self, key: object, ok: bool) -> None:
+        with self._cond:
+            self.busy -= 1
+            self.processed += 1
+            if not ok:
+                self.failed += 1
+            if self._pending[key]:
+                # следующий апдейт этого чата — в конец очереди, чтобы не занимать воркер подряд
+                self._ready.append(key)
+            else:
+                del self._pending[key]
+            self._cond.notify_all()  # и для drain()
+
+    def _run(self) -> None:
+        while True:
+            key, update = self._take()
+            ok = True
+            try:
+                if STATE_SHARED and isinstance(key, int):
+                    refresh_user(key)
+                process_updates_now([update])
+                if STATE_SHARED and isinstance(key, int):
+                    # пишем сразу: следующий апдейт чата может прийти на другой инстанс;
+                    # только этот чат — остальное допишет флашер, воркеры друг друга не ждут
+                    flush_chat(key)
+            except Exception as exc:
+                ok = False
+                logging.exception("update %s failed: %r", getattr(update, "update_id", "?"), exc)
+            finally:
+                self._done(key, ok)
+
+    def stats(self) -> Dict[str, object]:
+        with self._cond:
+            started = self.processed + self.busy
+            return {
+                "workers": self.workers,
+                "busy": self.busy,
+                "queue_depth": self._size,
+                "queue_capacity": self.capacity,
+                "active_chats": len(self._pending),
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "shed": self.shed,
+                "processed": self.processed,
+                "failed": self.failed,
+                "wait_avg_ms": round(self.wait_total / started * 1000, 1) if started else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 1),
+            }
+
+
+# исходный TeleBot.process_new_updates: выполняет хендлеры сразу, в текущем потоке
+process_updates_now = bot.process_new_updates
+update_pool = UpdateWorkerPool(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+
+
+def accept_update(update) -> bool:
+    """Ставит апдейт в пул. False — перегрузка, апдейт нужно вернуть Telegram на повтор."""
+    if update_pool.closed:
+        return False  # останавливаемся: Telegram доставит апдейт заново, уже другому инстансу
+    if not update_deduper.claim(update.update_id):
+        logging.info("duplicate update %s dropped", update.update_id)
+        return True
+    if WEBHOOK_OVERLOAD == "shed":
+        near_full = update_pool.depth() >= update_pool.capacity * WEBHOOK_SHED_AT
+        if near_full and is_free_tier(update_chat_id(update)):
+            update_pool.note_shed()
+            logging.warning("overload: shed free-tier update %s", update.update_id)
+            return True  # 200: Telegram не будет его повторять
+    if update_pool.submit(update):
+        return True
+    logging.warning("overload: update queue full (%d), asking Telegram to retry", update_pool.capacity)
+    update_deduper.release(update.update_id)
+    return False
+
+
+def poll_updates(stop: Optional[threading.Event] = None) -> None:
+    """Цикл getUpdates: апдейты идут через тот же update_pool, что и у вебхука.
+
+    Пачка только ставится в очередь, и следующий getUpdates уходит сразу,
+    пока воркеры разбирают текущую. Очередь полна — ждём, offset сдвигается
+    только за принятыми апдейтами, остальные Telegram отдаст повторно.
+    """
+    global polling_offset
+    offset: Optional[int] = None
+    backoff = 1.0
+    # skip_pending: всё, что накопилось до старта, подтверждаем без обработки
+    try:
+        skipped = bot.get_updates(offset=-1, timeout=10, long_polling_timeout=0)
+        if skipped:
+            offset = skipped[-1].update_id + 1
+    except Exception as exc:
+        logging.warning("skip pending updates failed: %r", exc)
+    while (stop is None or not stop.is_set()) and not update_pool.closed:
+        try:
+            updates = bot.get_updates(
+                offset=offset,
+                limit=POLLING_LIMIT,
+                timeout=POLLING_TIMEOUT + 10,
+                long_polling_timeout=POLLING_TIMEOUT,
+            )
+        except Exception as exc:
+            logging.warning("getUpdates failed: %r, retry in %.0fs", exc, backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        backoff = 1.0
+        for update in updates:
+            if not update_pool.submit(update, block=True):
+                return  # пул закрыт: остальные апдейты пачки Telegram отдаст заново
+            offset = polling_offset = update.update_id + 1
+
+
+polling_offset: Optional[int] = None  # следующий offset; Telegram узнает о нём при очередном getUpdates
+
+
+# поля апдейта с текстом пользователя и личными данными: в лог — только длина
+_REDACTED_KEYS = frozenset({
+    "text", "caption", "first_name", "last_name", "username", "title",
+    "phone_number", "bio", "description", "data", "query", "email",
+})
+
+
+def redact_update(value: object) -> object:
+    if isinstance(value, dict):
+        return {
+            key: f"<{len(item)} chars>" if key in _REDACTED_KEYS and isinstance(item, str) else redact_update(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact_update(item) for item in value]
+    return value
+
+
+def log_update(update, update_json: str) -> None:
+    """Тело апдейта — в лог с вероятностью LOG_UPDATE_SAMPLE; остальные — строкой DEBUG."""
+    if LOG_UPDATE_SAMPLE <= 0 or random.random() >= LOG_UPDATE_SAMPLE:
+        logging.debug("update %s", update.update_id, extra={"update_id": update.update_id})
+        return
+    try:
+        body = json.loads(update_json)
+    except ValueError:
+        return
+    if LOG_REDACT:
+        body = redact_update(body)
+    logging.info(
+        "<<< UPDATE: %s", json.dumps(body, ensure_ascii=False)[:800],
+        extra={"update_id": update.update_id},
+    )
+
+
 def start_polling() -> None:
     try:
         bot.remove_webhook()
     except Exception as exc:
         logging.warning("remove_webhook failed: %r", exc)
     time.sleep(1)
-    print(">>> polling…", flush=True)
-    while True:
-        try:
-            bot.infinity_polling(skip_pending=True, timeout=60, long_polling_timeout=60)
-        except Exception as exc:
-            logging.exception("Polling error: %r", exc)
-            time.sleep(3)
+    update_pool.start(POLLING_WORKERS)
+    if HTTP_PREWARM:
+        prewarm_http()
+    print(f">>> polling… ({update_pool.workers} workers)", flush=True)
+    poll_updates()
 
 
 @app.route(WEBHOOK_PATH, methods=["POST"])
@@ -1717,17 +3584,16 @@ def telegram_webhook():
     try:
         # читаем тело целиком как текст (без двойного чтения stream)
         update_json = request.get_data(cache=False, as_text=True)
-        print("<<< UPDATE:", (update_json or "")[:800], flush=True)
         update = telebot.types.Update.de_json(update_json)
+    except HTTPException:
+        raise  # 413: тело больше WEBHOOK_MAX_BODY
     except Exception as exc:
         logging.exception("Invalid update: %r", exc)
         abort(400)
+    log_update(update, update_json)
 
-    threading.Thread(
-        target=lambda upd=update: bot.process_new_updates([upd]),
-        daemon=True,
-    ).start()
-
+    if not accept_update(update):
+        return "overloaded", 503, {"Retry-After": "5"}
     return "ok", 200
 
 
@@ -1736,6 +3602,25 @@ def healthcheck():
     return "ok", 200
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    data: Dict[str, object] = {
+        "updates": update_pool.stats(),
+        "dedup": update_deduper.stats(),
+        "dirty_users": dirty_count(),
+        "log_dropped": dropped_log_records(),
+        "stream": stream_metrics(),
+        "openai_breakers": breaker_stats(),
+        "openai_limits": limiter_stats(),
+        "prompts": prompt_metrics(),
+    }
+    if STATE_SHARED:
+        data["shared_conflicts"] = shared_conflicts
+    if store.is_db():
+        data["db_pool"] = store.pool_stats()
+    return jsonify(data)
+
+
 def start_webhook() -> None:
     try:
         bot.remove_webhook()
@@ -1766,6 +3651,15 @@ def start_webhook() -> None:
     if WEBHOOK_SSL_CERT and WEBHOOK_SSL_KEY:
         ssl_context = (WEBHOOK_SSL_CERT, WEBHOOK_SSL_KEY)
 
+    if WEBHOOK_SERVER == "gunicorn":
+        serve_gunicorn(ssl_context)
+        return
+    update_pool.start()
+    if HTTP_PREWARM:
+        prewarm_http()
+    if WEBHOOK_SERVER == "waitress":
+        serve_waitress(ssl_context)
+        return
     print(f">>> webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}", flush=True)
     app.run(
         host=WEBHOOK_HOST,
@@ -1775,6 +3669,96 @@ def start_webhook() -> None:
         threaded=True,
     )
 
+
+def serve_waitress(ssl_context=None) -> None:
+    """app под waitress: один процесс, WEBHOOK_SERVER_THREADS потоков на соединения."""
+    try:
+        from waitress import serve
+    except ImportError as exc:
+        raise RuntimeError("WEBHOOK_SERVER=waitress: установите пакет waitress") from exc
+    if ssl_context:
+        raise RuntimeError("waitress не умеет TLS: терминируйте его на прокси или возьмите WEBHOOK_SERVER=gunicorn")
+    print(
+        f">>> webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT} (waitress, {WEBHOOK_SERVER_THREADS} threads)",
+        flush=True,
+    )
+    serve(
+        app,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        threads=WEBHOOK_SERVER_THREADS,
+        connection_limit=WEBHOOK_CONNECTION_LIMIT,
+        channel_timeout=WEBHOOK_TIMEOUT,
+        max_request_body_size=WEBHOOK_MAX_BODY,
+        ident="Lumi",
+    )
+
+
+def serve_gunicorn(ssl_context=None) -> None:
+    """app под gunicorn: WEBHOOK_SERVER_WORKERS процессов по WEBHOOK_SERVER_THREADS потоков.
+
+    Состояние, update_pool, флашер и соединения с базой у каждого воркера
+    свои: они поднимаются после fork (post_fork), а при выходе воркера его
+    изменения дописываются в стор (worker_exit). Мастер только следит за
+    воркерами и пользователей не читает (см. main).
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError as exc:
+        raise RuntimeError("WEBHOOK_SERVER=gunicorn: установите пакет gunicorn") from exc
+    if WEBHOOK_SERVER_WORKERS > 1 and not STATE_SHARED:
+        raise RuntimeError("WEBHOOK_SERVER_WORKERS > 1 требует STATE_SHARED: у процессов разойдётся состояние")
+
+    def post_fork(server, worker) -> None:
+        setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE)
+        # состояние — из стора на момент старта воркера: перезапущенный воркер
+        # (падение, timeout, max_requests, HUP) не должен получить копию мастера
+        load_state()
+        state_flusher.start()
+        update_pool.start()
+        if HTTP_PREWARM:
+            prewarm_http()
+        if store.has_message_log():
+            start_message_pruner()
+
+    def worker_exit(server, worker) -> None:
+        shutdown(f"gunicorn worker {worker.pid} exiting")
+
+    options = {
+        "bind": f"{WEBHOOK_HOST}:{WEBHOOK_PORT}",
+        "workers": max(1, WEBHOOK_SERVER_WORKERS),
+        "worker_class": "gthread",
+        "threads": max(1, WEBHOOK_SERVER_THREADS),
+        "worker_connections": WEBHOOK_CONNECTION_LIMIT,
+        "timeout": WEBHOOK_TIMEOUT,
+        "graceful_timeout": WEBHOOK_GRACEFUL_TIMEOUT,
+        "keepalive": WEBHOOK_KEEPALIVE,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit,
+        "proc_name": "lumi",
+    }
+    if ssl_context:
+        options["certfile"], options["keyfile"] = ssl_context
+
+    class LumiServer(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    # в мастере писать нечего, а соединения и потоки не должны пережить fork
+    state_flusher.stop()
+    store.close()
+    close_http_sessions()
+    print(
+        f">>> webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT} "
+        f"(gunicorn, {options['workers']} workers x {options['threads']} threads)",
+        flush=True,
+    )
+    LumiServer().run()
+
 # где-нибудь рядом с другими хэндлерами, ВЫШЕ любых общих catch-all
 @bot.message_handler(commands=["ping"])
 def cmd_ping(message):
@@ -1927,7 +3911,7 @@ def cmd_grant_best(message):
 @bot.message_handler(commands=["start"])
 def cmd_start(message):
     info = U(message.chat.id)
-    if str(message.chat.id) in ALWAYS_PREMIUM and not info.get("permanent_plan"):
+    if str(message.chat.id) in ALWAYS_PREMIUM and not info.permanent_plan:
         grant_permanent_plan(message.chat.id, BEST_PLAN_CODE)
         bot.send_message(message.chat.id, lang_text(message.chat.id, "grant_permanent"))
         mark_support_sent(message.chat.id)
@@ -1961,8 +3945,8 @@ def cmd_policy(message):
 @bot.message_handler(commands=["reset_policy"])
 def cmd_reset(message):
     info = U(message.chat.id)
-    info["policy_shown"] = False
-    info["accepted_at"] = None
+    info.policy_shown = False
+    info.accepted_at = None
     save_state()
     bot.reply_to(message, lang_text(message.chat.id, "policy_reset"))
 
@@ -1970,7 +3954,7 @@ def cmd_reset(message):
 @bot.message_handler(commands=["diag"])
 def cmd_diag(message):
     info = U(message.chat.id)
-    left = max(0, TRIAL_MESSAGES - int(info.get("free_used", 0)))
+    left = max(0, TRIAL_MESSAGES - (info.free_used or 0))
     plan_code = active_plan(message.chat.id)
     bot.reply_to(
         message,
@@ -2097,29 +4081,21 @@ def any_text(message):
         return
 
     if LYRICS_TRIGGERS_RE.search(text):
-        info["lyrics_expected"] = True
+        info.lyrics_expected = True
         save_state()
         bot.send_message(message.chat.id, lang_text(message.chat.id, "lyrics_ask"))
         return
 
-    if info.get("lyrics_expected"):
-        info["lyrics_expected"] = False
+    if info.lyrics_expected:
+        info.lyrics_expected = False
         save_state()
 
         plan_code = active_plan(message.chat.id)
         lang = get_language(message.chat.id)
-        history = list(info.get("history") or [])
+        history = get_history(message.chat.id)
         reply = ask_openai_lyrics(text, language=lang, history=history, plan=plan_code)
 
-        history.append({"role": "user", "content": f"[LYRICS] {text}"})
-        history.append({"role": "assistant", "content": reply})
-        history_limit = int(plan_behavior(plan_code).get("history_limit", DEFAULT_HISTORY_LIMIT))
-        if history_limit <= 0:
-            history_limit = DEFAULT_HISTORY_LIMIT
-        if len(history) > history_limit * 2:
-            history = history[-history_limit * 2:]
-        info["history"] = history
-        save_state()
+        record_turn(message.chat.id, f"[LYRICS] {text}", reply, plan_code)
         bot.send_message(message.chat.id, reply)
         return
 
@@ -2128,27 +4104,27 @@ def any_text(message):
         return
 
     if is_targeted_abuse(text):
-        strikes = int(info.get("abuse_strikes", 0)) + 1
+        strikes = (info.abuse_strikes or 0) + 1
         key = "abuse_final" if strikes >= 2 else "abuse_first"
-        info["abuse_strikes"] = 0 if strikes >= 2 else strikes
+        info.abuse_strikes = 0 if strikes >= 2 else strikes
         save_state()
         bot.send_message(message.chat.id, lang_text(message.chat.id, key))
         return
 
     vent_note = None
     if has_general_profanity(text):
-        info["last_vent_at"] = datetime.now(timezone.utc).isoformat()
-        info["last_vent_note"] = "general"
+        info.last_vent_at = datetime.now(timezone.utc)
+        info.last_vent_note = "general"
         vent_note = vent_context_note(message.chat.id)
-    else:
-        info["last_vent_note"] = None
+    elif info.last_vent_note is not None:
+        info.last_vent_note = None
 
     plan_code = active_plan(message.chat.id)
     is_premium = plan_code != "free"
     rest = None
     if not is_premium:
-        next_count = int(info.get("free_used", 0)) + 1
-        info["free_used"] = next_count
+        next_count = (info.free_used or 0) + 1
+        info.free_used = next_count
         if next_count > TRIAL_MESSAGES:
             save_state()
             bot.send_message(message.chat.id, lang_text(message.chat.id, "free_end"))
@@ -2156,19 +4132,16 @@ def any_text(message):
             return
         rest = TRIAL_MESSAGES - next_count
 
-    history = list(info.get("history") or [])
+    history = get_history(message.chat.id)
     lang = get_language(message.chat.id)
-    history_limit = int(plan_behavior(plan_code).get("history_limit", DEFAULT_HISTORY_LIMIT))
-    reply = ask_openai(text, language=lang, history=history, plan=plan_code, context_note=vent_note)
-    history.append({"role": "user", "content": text})
-    history.append({"role": "assistant", "content": reply})
-    if history_limit <= 0:
-        history_limit = DEFAULT_HISTORY_LIMIT
-    if len(history) > history_limit * 2:
-        history = history[-history_limit * 2:]
-    info["history"] = history
-    save_state()
-    bot.send_message(message.chat.id, reply)
+    if OPENAI_STREAM:
+        reply = stream_reply(message.chat.id, text, language=lang, history=history, plan=plan_code, context_note=vent_note)
+        if reply is not None:
+            record_turn(message.chat.id, text, reply, plan_code)
+    else:
+        reply = ask_openai(text, language=lang, history=history, plan=plan_code, context_note=vent_note)
+        record_turn(message.chat.id, text, reply, plan_code)
+        bot.send_message(message.chat.id, reply)
 
     if is_premium:
         if should_send_support(message.chat.id, plan_code):
@@ -2257,22 +4230,97 @@ def auto_migrate_file_to_db():
         if store.is_db() and os.path.exists(STATE_FILE):
             data = FileStore(STATE_FILE).load_all()
             if data:
-                store.save_all(data)
+                store.import_users(data)
                 os.rename(STATE_FILE, STATE_FILE + ".migrated")
                 print(f">>> migrated {len(data)} users from file to Postgres", flush=True)
     except Exception as e:
         print(f">>> auto-migrate failed: {e}", flush=True)
 
 
-def main() -> None:
+def start_message_pruner() -> None:
+    """Фоновая чистка messages: у каждого чата остаются последние MESSAGES_KEEP_PER_CHAT реплик."""
+    def loop() -> None:
+        while True:
+            time.sleep(MESSAGES_PRUNE_INTERVAL)
+            try:
+                deleted = store.prune_messages(MESSAGES_KEEP_PER_CHAT)
+                if deleted:
+                    logging.info("pruned %d old messages", deleted)
+            except Exception as exc:
+                logging.exception("prune_messages failed: %r", exc)
+
+    threading.Thread(target=loop, name="messages-pruner", daemon=True).start()
+
+
+def shutdown(reason: str) -> Dict[str, int]:
+    """Останавливает обработку без потерь.
+
+    1. Новые апдейты не принимаются: вебхук отвечает 503 (Telegram доставит
+       их заново, уже новому инстансу), поллинг больше не берёт getUpdates.
+    2. Апдейты в очереди и в работе дорабатываются, но не дольше SHUTDOWN_TIMEOUT.
+    3. Состояние дописывается в стор.
+    4. Закрываются HTTP-сессия бота и пул соединений с базой.
+    """
+    started = time.monotonic()
+    update_pool.close()
+    logging.warning(
+        ">>> %s: draining %d queued + %d in-flight updates (up to %gs)",
+        reason, update_pool.depth(), update_pool.busy, SHUTDOWN_TIMEOUT,
+    )
+    result = update_pool.drain(SHUTDOWN_TIMEOUT)
+    result["dropped"] = result["queued_left"] + result["in_flight_left"]
+    if polling_offset is not None and not result["dropped"]:
+        # подтверждаем обработанное, иначе следующий инстанс получит эти апдейты ещё раз
+        try:
+            bot.get_updates(offset=polling_offset, limit=1, timeout=5, long_polling_timeout=0)
+        except Exception as exc:
+            logging.warning("confirm polling offset failed: %r", exc)
+    result["flushed_users"] = dirty_count()
+    state_flusher.stop()
+    result["unsaved_users"] = dirty_count()
+    close_http_sessions()
+    store.close()
+    logging.log(
+        logging.WARNING if result["dropped"] or result["unsaved_users"] else logging.INFO,
+        ">>> shutdown in %.1fs: drained %d of %d updates, dropped %d; flushed %d users, unsaved %d",
+        time.monotonic() - started, result["drained"], result["pending"], result["dropped"],
+        result["flushed_users"], result["unsaved_users"],
+    )
+    return result
+
+
+def handle_sigterm(signum, frame) -> None:
+    shutdown(f"signal {signum}")
+    raise SystemExit(0)
+
+
+def main(runtime: Optional[str] = None) -> None:
+    runtime = runtime or LUMI_RUNTIME
     print(">>> starting Lumi…", flush=True)
+    if STATE_SHARED and not store.is_db():
+        raise RuntimeError("STATE_SHARED требует DATABASE_URL: инстансы делят состояние через Postgres")
     db_init()
     auto_migrate_file_to_db()  # <-- добавь ЭТУ строку
     if store.is_db():
         print(">>> DB: Postgres", flush=True)
     else:
         print(f">>> DB disabled: file mode ({STATE_FILE})", flush=True)
+    load_token_encoding()  # до fork воркеров gunicorn — они получат готовую кодировку
+    if runtime != "async" and WEBHOOK_URL and WEBHOOK_PORT and WEBHOOK_SERVER == "gunicorn":
+        # состояние читает каждый воркер в post_fork, мастеру оно не нужно
+        start_webhook()
+        return
     load_state()
+    state_flusher.start()
+    if store.has_message_log():
+        start_message_pruner()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    if runtime == "async":
+        # lumi_async делает import Lumi: при запуске скриптом это должен быть этот же модуль
+        sys.modules.setdefault("Lumi", sys.modules[__name__])
+        import lumi_async
+        lumi_async.run()
+        return
     if WEBHOOK_URL and WEBHOOK_PORT:
         start_webhook()
     else:
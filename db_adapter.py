@@ -1,16 +1,102 @@
 # db_adapter.py
 import os
 import json
-from typing import Iterable, Dict, Any, List
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Dict, Any, List, Tuple
 
 DB_URL = os.getenv("DATABASE_URL", "").strip()
 STATE_FILE = os.getenv("STATE_FILE", "users.json")
 
+# connection pool (DB_POOL_MAX=0 disables pooling: one connect() per call)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))  # seconds
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "600"))  # seconds
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+# bulk_upsert_users switches from executemany to COPY + merge at this many rows
+DB_COPY_THRESHOLD = int(os.getenv("DB_COPY_THRESHOLD", "500"))
+
+# every users column we read and write; rows are normalized to exactly this set.
+# history is not here: it lives in the messages table, users.history is legacy
+USER_COLUMNS = (
+    "chat_id",
+    "language",
+    "policy_shown",
+    "lang_confirmed",
+    "accepted_at",
+    "free_used",
+    "premium_plan",
+    "premium_until",
+    "permanent_plan",
+    "news_opt_out",
+    "news_opted_at",
+    "offer_prompted",
+    "offer_remind_at",
+    "abuse_strikes",
+    "lyrics_expected",
+    "last_seen_at",
+    "last_username",
+    "last_first_name",
+    "last_last_name",
+    "last_full_name",
+    "last_vent_at",
+    "last_vent_note",
+    "last_support",
+    "premium_source",
+    "premium_started_at",
+    "premium_payment_method",
+    "premium_payment_reference",
+)
+
+# users.version is bumped by every write; instances sharing the database use it
+# to detect each other's writes (see DbStore.merge_users). Reads return it next to USER_COLUMNS
+VERSIONED_COLUMNS = USER_COLUMNS + ("version",)
+
+# counters merged as deltas when two instances changed the same row concurrently;
+# every other column is last-writer-wins
+COUNTER_COLUMNS = ("free_used", "abuse_strikes")
+
 
 # ---------- File store ----------
+def _env_flag(name: str, default: str = "0") -> bool:
+    return os.getenv(name, default).strip().lower() in {"1", "true", "yes", "on"}
+
+
+# журнал: изменения дописываются в <STATE_FILE>.journal (JSONL), снапшот
+# переписывается в фоне, когда журнал вырастает до STATE_JOURNAL_COMPACT_BYTES
+STATE_JOURNAL = _env_flag("STATE_JOURNAL")
+STATE_JOURNAL_FSYNC = _env_flag("STATE_JOURNAL_FSYNC", "1")
+STATE_JOURNAL_COMPACT_BYTES = int(os.getenv("STATE_JOURNAL_COMPACT_BYTES", str(8 * 1024 * 1024)))
+
+
 class FileStore:
-    def __init__(self, path: str | None = None):
+    """
+    users.json-хранилище.
+
+    Обычный режим: каждая запись атомарно (temp + rename) переписывает файл.
+    Режим журнала (STATE_JOURNAL=1): upsert_users дописывает по строке на
+    пользователя в <path>.journal, load_all накатывает журнал поверх снапшота.
+    Компакция в фоне: журнал переименовывается в <path>.journal.old, снапшот
+    пишется через temp + rename, затем .old удаляется. Записи журнала —
+    идемпотентные «установи эти поля», поэтому после падения на любом шаге
+    повторный накат снапшот + .old + .journal даёт то же состояние.
+    Недописанная (битая) последняя строка журнала пропускается.
+    """
+
+    def __init__(self, path: str | None = None, journal: bool | None = None):
         self.path = path or STATE_FILE
+        self.journal = STATE_JOURNAL if journal is None else journal
+        self.journal_path = self.path + ".journal"
+        self.rotated_journal_path = self.journal_path + ".old"
+        # кэш содержимого файла: chat_id (str) -> поля; нужен для upsert_users
+        self._data: Dict[str, Dict[str, Any]] | None = None
+        self._lock = threading.RLock()
+        self._journal_file = None
+        self._compacting = False
+        self._generation = 0  # растёт при save_all: устаревшую компакцию нужно выбросить
 
     def is_db(self) -> bool:
         return False
@@ -19,32 +105,98 @@ class FileStore:
         # no schema in file mode
         pass
 
-    def load_all(self) -> List[Dict[str, Any]]:
+    def _read_snapshot(self) -> Dict[str, Dict[str, Any]]:
         if not os.path.exists(self.path):
-            return []
+            return {}
         try:
             with open(self.path, "r", encoding="utf-8") as f:
                 data = json.load(f)
         except Exception:
             data = {}
 
-        out: List[Dict[str, Any]] = []
+        out: Dict[str, Dict[str, Any]] = {}
         if isinstance(data, dict):
             for k, v in data.items():
                 try:
                     chat_id = int(k)
                 except Exception:
                     continue
-                row = {"chat_id": chat_id}
-                if isinstance(v, dict):
-                    row.update(v)
-                out.append(row)
+                out[str(chat_id)] = dict(v) if isinstance(v, dict) else {}
         elif isinstance(data, list):
             for item in data:
                 if isinstance(item, dict) and "chat_id" in item:
-                    out.append(item)
+                    out[str(int(item["chat_id"]))] = {k: v for k, v in item.items() if k != "chat_id"}
         return out
 
+    @staticmethod
+    def _trim_torn_tail(path: str) -> None:
+        # недописанная при падении строка: обрезаем, иначе следующая запись склеится с ней
+        with open(path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if not size:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            f.seek(0)
+            cut = f.read().rfind(b"\n") + 1
+            f.truncate(cut)
+            logging.warning("FileStore: dropped %d bytes of torn journal tail in %s", size - cut, path)
+
+    def _replay(self, path: str, data: Dict[str, Dict[str, Any]]) -> int:
+        if not os.path.exists(path):
+            return 0
+        self._trim_torn_tail(path)
+        applied = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for lineno, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    rec = json.loads(line)
+                    cid = str(int(rec["chat_id"]))
+                    fields = rec["set"]
+                except Exception:
+                    logging.warning("FileStore: skipping broken journal line %s:%d", path, lineno)
+                    continue
+                data.setdefault(cid, {}).update(fields)
+                applied += 1
+        return applied
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            data = self._read_snapshot()
+            if self.journal:
+                replayed = self._replay(self.rotated_journal_path, data)
+                replayed += self._replay(self.journal_path, data)
+                if replayed:
+                    logging.info("FileStore: replayed %d journal records", replayed)
+            self._data = data
+            if self.journal and os.path.exists(self.rotated_journal_path):
+                # прошлая компакция не доехала — доделываем её сейчас
+                self.compact()
+            return [dict({"chat_id": int(cid)}, **fields) for cid, fields in data.items()]
+
+    # history is kept inside the user row in file mode
+    def has_message_log(self) -> bool:
+        return False
+
+    def load_one(self, chat_id: int) -> Dict[str, Any] | None:
+        with self._lock:
+            if self._data is None:
+                self.load_all()
+            fields = self._data.get(str(int(chat_id)))
+            return dict({"chat_id": int(chat_id)}, **fields) if fields is not None else None
+
+    def iter_all(self) -> Iterator[Dict[str, Any]]:
+        with self._lock:
+            if self._data is None:
+                self.load_all()
+            items = list(self._data.items())
+        for cid, fields in items:
+            yield dict({"chat_id": int(cid)}, **fields)
+
     # совместимость со старым кодом миграции
     def load_users_from_file(self) -> Iterable[Dict[str, Any]]:
         return self.load_all()
@@ -57,147 +209,710 @@ class FileStore:
                 continue
             cid = str(int(u["chat_id"]))
             data[cid] = {k: v for k, v in u.items() if k != "chat_id"}
+        with self._lock:
+            self._generation += 1
+            self._data = data
+            self._write(data)
+            if self.journal:
+                # полный снапшот уже записан — журнал больше не нужен
+                self._close_journal()
+                for path in (self.journal_path, self.rotated_journal_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def upsert_users(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Сливает переданные строки с уже сохранёнными, остальных не трогает."""
+        with self._lock:
+            if self._data is None:
+                self.load_all()
+            changes: List[tuple] = []
+            for r in rows:
+                if "chat_id" not in r:
+                    continue
+                cid = str(int(r["chat_id"]))
+                fields = {k: v for k, v in r.items() if k != "chat_id"}
+                self._data.setdefault(cid, {}).update(fields)
+                changes.append((cid, fields))
+            if not changes:
+                return 0
+            if self.journal:
+                self._append_journal(changes)
+            else:
+                self._write(self._data)
+            return len(changes)
+
+    def update_fields(self, chat_id: int, fields: Dict[str, Any]) -> bool:
+        return self.update_fields_many([(chat_id, fields)]) > 0
+
+    def update_fields_many(self, changes: Iterable[tuple]) -> int:
+        """(chat_id, {field: value}) пары; в режиме журнала пишутся только эти поля."""
+        return self.upsert_users(dict(fields, chat_id=chat_id) for chat_id, fields in changes if fields)
+
+    def _append_journal(self, changes: List[tuple]) -> None:
+        if self._journal_file is None:
+            os.makedirs(os.path.dirname(self.journal_path) or ".", exist_ok=True)
+            self._journal_file = open(self.journal_path, "a", encoding="utf-8")
+        f = self._journal_file
+        f.write("".join(
+            json.dumps({"chat_id": int(cid), "set": fields}, ensure_ascii=False, default=str) + "\n"
+            for cid, fields in changes
+        ))
+        f.flush()
+        if STATE_JOURNAL_FSYNC:
+            os.fsync(f.fileno())
+        if f.tell() >= STATE_JOURNAL_COMPACT_BYTES and not self._compacting:
+            self._compacting = True
+            threading.Thread(target=self.compact, name="journal-compact", daemon=True).start()
+
+    def _close_journal(self) -> None:
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+
+    def compact(self) -> None:
+        """Сворачивает журнал в снапшот (temp + atomic rename)."""
+        with self._lock:
+            self._compacting = True
+            try:
+                self._close_journal()
+                if os.path.exists(self.journal_path):
+                    if os.path.exists(self.rotated_journal_path):
+                        # .old остался от прерванной компакции: дописываем к нему
+                        with open(self.journal_path, "r", encoding="utf-8") as src, \
+                                open(self.rotated_journal_path, "a", encoding="utf-8") as dst:
+                            dst.write(src.read())
+                        os.remove(self.journal_path)
+                    else:
+                        os.replace(self.journal_path, self.rotated_journal_path)
+                snapshot = {cid: dict(fields) for cid, fields in (self._data or {}).items()}
+                generation = self._generation
+            except Exception:
+                self._compacting = False
+                raise
+        # самое долгое — сериализация снапшота — идёт без блокировки
+        try:
+            tmp_path = self._dump_temp(snapshot)
+            with self._lock:
+                if generation != self._generation:
+                    # пока писали, save_all уже сохранил более новый снапшот
+                    os.remove(tmp_path)
+                    return
+                os.replace(tmp_path, self.path)
+                if os.path.exists(self.rotated_journal_path):
+                    os.remove(self.rotated_journal_path)
+            logging.info("FileStore: compacted journal into %s (%d users)", self.path, len(snapshot))
+        except Exception as exc:
+            logging.exception("FileStore: journal compaction failed: %r", exc)
+        finally:
+            self._compacting = False
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_journal()
+
+    def _dump_temp(self, data: Dict[str, Dict[str, Any]]) -> str:
         os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
-        with open(self.path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        tmp_path = f"{self.path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        return tmp_path
+
+    def _write(self, data: Dict[str, Dict[str, Any]]) -> None:
+        # temp + rename: при падении на диске остаётся либо старый, либо новый файл
+        os.replace(self._dump_temp(data), self.path)
 
 
 # ---------- Postgres store ----------
+# pg_advisory_xact_lock key shared by every instance running init_schema()
+SCHEMA_LOCK_ID = 0x4C756D69  # "Lumi"
+
+
+def _migrate_users_baseline(cur) -> None:
+    # base table
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            chat_id BIGINT PRIMARY KEY
+        );
+        """
+    )
+
+    # idempotent column adds (safe if they already exist)
+    cur.execute(
+        """
+        ALTER TABLE users
+          ADD COLUMN IF NOT EXISTS language                   TEXT,
+          ADD COLUMN IF NOT EXISTS policy_shown               BOOLEAN     DEFAULT FALSE,
+          ADD COLUMN IF NOT EXISTS lang_confirmed             BOOLEAN     DEFAULT FALSE,
+          ADD COLUMN IF NOT EXISTS accepted_at                TIMESTAMPTZ,
+          ADD COLUMN IF NOT EXISTS free_used                  INTEGER     DEFAULT 0,
+          ADD COLUMN IF NOT EXISTS premium_plan               TEXT,
+          ADD COLUMN IF NOT EXISTS premium_until              TIMESTAMPTZ,
+          ADD COLUMN IF NOT EXISTS permanent_plan             TEXT,
+          ADD COLUMN IF NOT EXISTS news_opt_out               BOOLEAN     DEFAULT FALSE,
+          ADD COLUMN IF NOT EXISTS news_opted_at              TIMESTAMPTZ,
+          ADD COLUMN IF NOT EXISTS history                    JSONB       DEFAULT '[]'::jsonb,
+
+          -- new fields used by current code
+          ADD COLUMN IF NOT EXISTS offer_prompted             BOOLEAN     NOT NULL DEFAULT FALSE,
+          ADD COLUMN IF NOT EXISTS offer_remind_at            TIMESTAMPTZ NULL,
+          ADD COLUMN IF NOT EXISTS abuse_strikes              INTEGER     NOT NULL DEFAULT 0,
+          ADD COLUMN IF NOT EXISTS lyrics_expected            BOOLEAN     NOT NULL DEFAULT FALSE,
+          ADD COLUMN IF NOT EXISTS last_seen_at               TIMESTAMPTZ NULL,
+          ADD COLUMN IF NOT EXISTS last_username              TEXT        NULL,
+          ADD COLUMN IF NOT EXISTS last_first_name            TEXT        NULL,
+          ADD COLUMN IF NOT EXISTS last_last_name             TEXT        NULL,
+          ADD COLUMN IF NOT EXISTS last_full_name             TEXT        NULL,
+          ADD COLUMN IF NOT EXISTS last_vent_at               TIMESTAMPTZ NULL,
+          ADD COLUMN IF NOT EXISTS last_vent_note             TEXT        NULL,
+          ADD COLUMN IF NOT EXISTS last_support               TIMESTAMPTZ NULL,
+
+          -- payment fields
+          ADD COLUMN IF NOT EXISTS premium_source             TEXT        NULL,
+          ADD COLUMN IF NOT EXISTS premium_started_at         TIMESTAMPTZ NULL,
+          ADD COLUMN IF NOT EXISTS premium_payment_method     TEXT        NULL,
+          ADD COLUMN IF NOT EXISTS premium_payment_reference  TEXT        NULL
+        ;
+        """
+    )
+
+    # language: default + backfill + relax nullability
+    cur.execute("ALTER TABLE users ALTER COLUMN language SET DEFAULT 'ru';")
+    cur.execute("UPDATE users SET language = 'ru' WHERE language IS NULL;")
+    cur.execute("ALTER TABLE users ALTER COLUMN language DROP NOT NULL;")
+
+    # news_opt_out: default + backfill + relax nullability
+    cur.execute("ALTER TABLE users ALTER COLUMN news_opt_out SET DEFAULT FALSE;")
+    cur.execute("UPDATE users SET news_opt_out = FALSE WHERE news_opt_out IS NULL;")
+    cur.execute("ALTER TABLE users ALTER COLUMN news_opt_out DROP NOT NULL;")
+
+    # lang_confirmed: default + backfill + relax nullability
+    cur.execute("ALTER TABLE users ALTER COLUMN lang_confirmed SET DEFAULT FALSE;")
+    cur.execute("UPDATE users SET lang_confirmed = FALSE WHERE lang_confirmed IS NULL;")
+    cur.execute("ALTER TABLE users ALTER COLUMN lang_confirmed DROP NOT NULL;")
+
+
+def _migrate_messages_table(cur) -> None:
+    # append-only conversation log; (chat_id, seq) PK also serves tail reads.
+    # Databases set up before schema_version existed may already have it
+    cur.execute("SELECT to_regclass('messages') IS NULL;")
+    created = cur.fetchone()[0]
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            chat_id    BIGINT      NOT NULL,
+            seq        BIGINT      GENERATED ALWAYS AS IDENTITY,
+            role       TEXT        NOT NULL,
+            content    TEXT        NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (chat_id, seq)
+        );
+        """
+    )
+    if created:
+        # one-time copy of the legacy users.history arrays
+        cur.execute(
+            """
+            INSERT INTO messages (chat_id, role, content)
+            SELECT u.chat_id, h.m->>'role', COALESCE(h.m->>'content', '')
+            FROM users u
+            CROSS JOIN LATERAL jsonb_array_elements(
+                CASE WHEN jsonb_typeof(u.history) = 'array' THEN u.history ELSE '[]'::jsonb END
+            ) WITH ORDINALITY AS h(m, ord)
+            WHERE h.m->>'role' IS NOT NULL
+            ORDER BY u.chat_id, h.ord;
+            """
+        )
+
+
+def _migrate_users_version(cur) -> None:
+    # row version for optimistic concurrency between bot instances
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;")
+
+
+def _migrate_seen_updates(cur) -> None:
+    # update_ids already taken by some instance, for de-duplicating redeliveries
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS seen_updates (
+            update_id BIGINT      PRIMARY KEY,
+            seen_at   TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS seen_updates_seen_at ON seen_updates (seen_at);")
+
+
+# (version, name, step) in apply order. Each step runs once per database and is
+# recorded in schema_version; add new steps at the end, never edit applied ones.
+# Steps must stay idempotent: pre-existing databases replay them once on upgrade.
+MIGRATIONS: List[Tuple[int, str, Callable[[Any], None]]] = [
+    (1, "users baseline", _migrate_users_baseline),
+    (2, "messages table", _migrate_messages_table),
+    (3, "users version", _migrate_users_version),
+    (4, "seen updates", _migrate_seen_updates),
+]
+
+
 class DbStore:
-    def __init__(self, url: str):
+    def __init__(self, url: str, pool_max: int | None = None):
         import psycopg  # v3
         self.psycopg = psycopg
         self.url = url
+        self.pool_max = DB_POOL_MAX if pool_max is None else pool_max
+        self.pool = None
+        self._pool_lock = threading.Lock()
+        self._pool_exhausted = 0
+        self._pool_wait_max_ms = 0.0
+        self._update_sql_cache: Dict[tuple, tuple] = {}
+        # chats that got new messages since the last prune_messages()
+        self._touched: set = set()
+        self._touched_lock = threading.Lock()
 
     def is_db(self) -> bool:
         return True
 
+    def _get_pool(self):
+        # the pool is opened on first use, so an unused store never holds connections
+        if self.pool is not None or self.pool_max <= 0:
+            return self.pool
+        with self._pool_lock:
+            if self.pool is None:
+                try:
+                    from psycopg_pool import ConnectionPool
+                except ImportError:
+                    logging.warning("psycopg_pool is not installed — DB connections are not pooled")
+                    self.pool_max = 0
+                    return None
+                self.pool = ConnectionPool(
+                    self.url,
+                    min_size=max(0, min(DB_POOL_MIN, self.pool_max)),
+                    max_size=self.pool_max,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    timeout=DB_POOL_TIMEOUT,
+                    check=ConnectionPool.check_connection,  # health check on checkout
+                    name="lumi-db",
+                    open=True,
+                )
+        return self.pool
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        """Borrow a connection from the pool (or open a one-off one if pooling is off)."""
+        pool = self._get_pool()
+        if pool is None:
+            with self.psycopg.connect(self.url) as conn:
+                yield conn
+            return
+
+        from psycopg_pool import PoolTimeout
+
+        started = time.monotonic()
+        try:
+            with pool.connection() as conn:
+                waited_ms = (time.monotonic() - started) * 1000
+                if waited_ms > self._pool_wait_max_ms:
+                    self._pool_wait_max_ms = waited_ms
+                yield conn
+        except PoolTimeout:
+            self._pool_exhausted += 1
+            logging.warning("DB pool exhausted (%s): %s", self._pool_exhausted, self.pool_stats())
+            raise
+
+    def pool_stats(self) -> Dict[str, Any]:
+        if self.pool is None:
+            return {"pooled": False}
+        stats: Dict[str, Any] = {"pooled": True}
+        stats.update(self.pool.get_stats())
+        stats["exhausted"] = self._pool_exhausted
+        stats["wait_max_ms"] = round(self._pool_wait_max_ms, 1)
+        return stats
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
     def init_schema(self) -> None:
-        psycopg = self.psycopg
-        with psycopg.connect(self.url) as conn:
+        """Apply pending MIGRATIONS; a no-op beyond one SELECT when the schema is current."""
+        latest = MIGRATIONS[-1][0]
+        with self.connection() as conn:
             with conn.cursor() as cur:
-                # base table
+                cur.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+                if cur.fetchone()[0]:
+                    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+                    if cur.fetchone()[0] >= latest:
+                        conn.commit()
+                        return
+
+                # one migrator at a time across instances; released on commit
+                cur.execute("SELECT pg_advisory_xact_lock(%s);", (SCHEMA_LOCK_ID,))
                 cur.execute(
                     """
-                    CREATE TABLE IF NOT EXISTS users (
-                        chat_id BIGINT PRIMARY KEY
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version    INTEGER     PRIMARY KEY,
+                        name       TEXT        NOT NULL,
+                        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
                     );
                     """
                 )
-
-                # idempotent column adds (safe if they already exist)
-                cur.execute(
-                    """
-                    ALTER TABLE users
-                      ADD COLUMN IF NOT EXISTS language                   TEXT,
-                      ADD COLUMN IF NOT EXISTS policy_shown               BOOLEAN     DEFAULT FALSE,
-                      ADD COLUMN IF NOT EXISTS lang_confirmed             BOOLEAN     DEFAULT FALSE,
-                      ADD COLUMN IF NOT EXISTS accepted_at                TIMESTAMPTZ,
-                      ADD COLUMN IF NOT EXISTS free_used                  INTEGER     DEFAULT 0,
-                      ADD COLUMN IF NOT EXISTS premium_plan               TEXT,
-                      ADD COLUMN IF NOT EXISTS premium_until              TIMESTAMPTZ,
-                      ADD COLUMN IF NOT EXISTS permanent_plan             TEXT,
-                      ADD COLUMN IF NOT EXISTS news_opt_out               BOOLEAN     DEFAULT FALSE,
-                      ADD COLUMN IF NOT EXISTS news_opted_at              TIMESTAMPTZ,
-                      ADD COLUMN IF NOT EXISTS history                    JSONB       DEFAULT '[]'::jsonb,
-
-                      -- new fields used by current code
-                      ADD COLUMN IF NOT EXISTS offer_prompted             BOOLEAN     NOT NULL DEFAULT FALSE,
-                      ADD COLUMN IF NOT EXISTS offer_remind_at            TIMESTAMPTZ NULL,
-                      ADD COLUMN IF NOT EXISTS abuse_strikes              INTEGER     NOT NULL DEFAULT 0,
-                      ADD COLUMN IF NOT EXISTS lyrics_expected            BOOLEAN     NOT NULL DEFAULT FALSE,
-                      ADD COLUMN IF NOT EXISTS last_seen_at               TIMESTAMPTZ NULL,
-                      ADD COLUMN IF NOT EXISTS last_username              TEXT        NULL,
-                      ADD COLUMN IF NOT EXISTS last_first_name            TEXT        NULL,
-                      ADD COLUMN IF NOT EXISTS last_last_name             TEXT        NULL,
-                      ADD COLUMN IF NOT EXISTS last_full_name             TEXT        NULL,
-                      ADD COLUMN IF NOT EXISTS last_vent_at               TIMESTAMPTZ NULL,
-                      ADD COLUMN IF NOT EXISTS last_vent_note             TEXT        NULL,
-
-                      -- payment fields
-                      ADD COLUMN IF NOT EXISTS premium_source             TEXT        NULL,
-                      ADD COLUMN IF NOT EXISTS premium_started_at         TIMESTAMPTZ NULL,
-                      ADD COLUMN IF NOT EXISTS premium_payment_method     TEXT        NULL,
-                      ADD COLUMN IF NOT EXISTS premium_payment_reference  TEXT        NULL
-                    ;
-                    """
-                )
-
-                # language: default + backfill + relax nullability
-                cur.execute("ALTER TABLE users ALTER COLUMN language SET DEFAULT 'ru';")
-                cur.execute("UPDATE users SET language = COALESCE(language, 'ru');")
-                cur.execute("ALTER TABLE users ALTER COLUMN language DROP NOT NULL;")
-
-                # news_opt_out: default + backfill + relax nullability
-                cur.execute("ALTER TABLE users ALTER COLUMN news_opt_out SET DEFAULT FALSE;")
-                cur.execute("UPDATE users SET news_opt_out = COALESCE(news_opt_out, FALSE);")
-                cur.execute("ALTER TABLE users ALTER COLUMN news_opt_out DROP NOT NULL;")
-
-                # lang_confirmed: default + backfill + relax nullability
-                cur.execute("ALTER TABLE users ALTER COLUMN lang_confirmed SET DEFAULT FALSE;")
-                cur.execute("UPDATE users SET lang_confirmed = COALESCE(lang_confirmed, FALSE);")
-                cur.execute("ALTER TABLE users ALTER COLUMN lang_confirmed DROP NOT NULL;")
+                cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+                current = cur.fetchone()[0]
+                for version, name, step in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    started = time.perf_counter()
+                    step(cur)
+                    cur.execute(
+                        "INSERT INTO schema_version (version, name) VALUES (%s, %s);",
+                        (version, name),
+                    )
+                    logging.info(
+                        "schema migration %d (%s) applied in %.2fs",
+                        version, name, time.perf_counter() - started,
+                    )
             conn.commit()
 
+    # rows come back without "history": see load_history()
     def load_all(self) -> List[Dict[str, Any]]:
-        psycopg = self.psycopg
         out: List[Dict[str, Any]] = []
-        with psycopg.connect(self.url) as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT * FROM users;")
-                cols = [d.name if hasattr(d, "name") else d[0] for d in cur.description]
+                cur.execute(f"SELECT {', '.join(VERSIONED_COLUMNS)} FROM users;")
                 for row in cur.fetchall():
-                    out.append(dict(zip(cols, row)))
+                    out.append(dict(zip(VERSIONED_COLUMNS, row)))
         return out
 
-    def bulk_upsert_users(self, rows: Iterable[Dict[str, Any]]) -> int:
-        psycopg = self.psycopg
-        default_lang = (os.getenv("DEFAULT_LANGUAGE", "ru") or "ru").lower()
-        count = 0
-        with psycopg.connect(self.url) as conn:
+    def load_one(self, chat_id: int) -> Dict[str, Any] | None:
+        with self.connection() as conn:
             with conn.cursor() as cur:
-                for r in rows:
-                    if "chat_id" not in r:
-                        continue
+                cur.execute(
+                    f"SELECT {', '.join(VERSIONED_COLUMNS)} FROM users WHERE chat_id = %s;",
+                    (int(chat_id),),
+                )
+                row = cur.fetchone()
+                return dict(zip(VERSIONED_COLUMNS, row)) if row is not None else None
+
+    def iter_all(self, batch_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        """Stream every user through a server-side cursor, batch_size rows at a time."""
+        with self.connection() as conn:
+            with conn.cursor(name="users_scan") as cur:
+                cur.itersize = batch_size
+                cur.execute(f"SELECT {', '.join(VERSIONED_COLUMNS)} FROM users;")
+                for row in cur:
+                    yield dict(zip(VERSIONED_COLUMNS, row))
+
+    # ---------- conversation log ----------
+    def has_message_log(self) -> bool:
+        return True
 
-                    # --- sane defaults to avoid NOT NULL/type issues ---
-                    if not r.get("language"):
-                        r["language"] = default_lang
+    def append_messages(self, messages: Iterable[tuple]) -> int:
+        """Append (chat_id, role, content) tuples to the messages table."""
+        batch = [(int(cid), str(role), str(content or "")) for cid, role, content in messages]
+        if not batch:
+            return 0
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.executemany(
+                    "INSERT INTO messages (chat_id, role, content) VALUES (%s, %s, %s);",
+                    batch,
+                )
+            conn.commit()
+        with self._touched_lock:
+            self._touched.update(cid for cid, _, _ in batch)
+        return len(batch)
 
-                    # bools: None -> False
-                    for b in ("policy_shown", "offer_prompted", "lyrics_expected", "news_opt_out", "lang_confirmed"):
-                        if r.get(b) is None:
-                            r[b] = False
+    def load_history(self, chat_id: int, limit: int) -> List[Dict[str, str]]:
+        """Last `limit` messages of a chat, oldest first (index scan on the PK)."""
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT role, content FROM ("
+                    "  SELECT seq, role, content FROM messages"
+                    "  WHERE chat_id = %s ORDER BY seq DESC LIMIT %s"
+                    ") tail ORDER BY seq;",
+                    (int(chat_id), int(limit)),
+                )
+                return [{"role": role, "content": content} for role, content in cur.fetchall()]
+
+    def prune_messages(self, keep_per_chat: int) -> int:
+        """Drop all but the newest keep_per_chat messages of chats written since the last prune."""
+        with self._touched_lock:
+            chats = list(self._touched)
+            self._touched.clear()
+        if not chats:
+            return 0
+        deleted = 0
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                for cid in chats:
+                    cur.execute(
+                        "DELETE FROM messages WHERE chat_id = %s AND seq <= ("
+                        "  SELECT seq FROM messages WHERE chat_id = %s"
+                        "  ORDER BY seq DESC OFFSET %s LIMIT 1"
+                        ");",
+                        (cid, cid, int(keep_per_chat)),
+                    )
+                    deleted += max(cur.rowcount, 0)
+            conn.commit()
+        return deleted
 
-                    # ints: None -> 0
-                    for i in ("free_used", "abuse_strikes"):
-                        if r.get(i) is None:
-                            r[i] = 0
+    # ---------- update de-duplication ----------
+    def claim_update(self, update_id: int) -> bool:
+        """Record update_id as taken; False if some instance already took it."""
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO seen_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING;",
+                    (int(update_id),),
+                    prepare=True,
+                )
+                claimed = cur.rowcount == 1
+            conn.commit()
+        return claimed
 
-                    # history: ensure list for jsonb
-                    h = r.get("history")
-                    if h is None or isinstance(h, dict):
-                        r["history"] = []
+    def release_update(self, update_id: int) -> None:
+        """Forget a claimed update_id, e.g. when it was handed back to Telegram for a retry."""
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM seen_updates WHERE update_id = %s;", (int(update_id),))
+            conn.commit()
 
-                    cols = list(r.keys())
-                    vals = [r[k] for k in cols]
-                    placeholders = ", ".join(["%s"] * len(vals))
-                    columns = ", ".join(cols)
-                    updates = ", ".join([f"{k}=EXCLUDED.{k}" for k in cols if k != "chat_id"])
+    def prune_seen_updates(self, older_than: float) -> int:
+        """Drop update_ids seen more than older_than seconds ago."""
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM seen_updates WHERE seen_at < now() - make_interval(secs => %s);",
+                    (float(older_than),),
+                )
+                deleted = max(cur.rowcount, 0)
+            conn.commit()
+        return deleted
+
+    def import_users(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Upsert users coming from users.json and move their history into the messages table."""
+        rows = list(rows)
+        count = self.bulk_upsert_users(rows)
+        self.append_messages(
+            (r["chat_id"], m.get("role"), m.get("content"))
+            for r in rows
+            if "chat_id" in r and isinstance(r.get("history"), list)
+            for m in r["history"]
+            if isinstance(m, dict) and m.get("role")
+        )
+        return count
+
+    @staticmethod
+    def _column_default(column: str, value: Any, default_lang: str) -> Any:
+        # sane defaults to avoid NOT NULL/type issues
+        if column == "language" and not value:
+            return default_lang
+        if value is None and column in ("policy_shown", "offer_prompted", "lyrics_expected", "news_opt_out", "lang_confirmed"):
+            return False
+        if value is None and column in ("free_used", "abuse_strikes"):
+            return 0
+        return value
+
+    def _normalize_user_row(self, r: Dict[str, Any], default_lang: str) -> tuple:
+        """Map a user dict onto USER_COLUMNS with sane defaults for NOT NULL/type issues."""
+        values = [int(r["chat_id"])]
+        for c in USER_COLUMNS[1:]:
+            values.append(self._column_default(c, r.get(c), default_lang))
+        return tuple(values)
+
+    def _update_sql(self, columns: tuple) -> tuple:
+        # one cached (UPDATE, INSERT fallback) pair per column set; statements are server-prepared
+        sql = self._update_sql_cache.get(columns)
+        if sql is None:
+            assignments = ", ".join(f"{c} = %s" for c in columns)
+            names = ", ".join(("chat_id",) + columns)
+            placeholders = ", ".join(["%s"] * (len(columns) + 1))
+            updates = ", ".join(f"{c}=EXCLUDED.{c}" for c in columns)
+            sql = (
+                f"UPDATE users SET {assignments}, version = version + 1 WHERE chat_id = %s;",
+                f"INSERT INTO users ({names}) VALUES ({placeholders}) "
+                f"ON CONFLICT (chat_id) DO UPDATE SET {updates}, version = users.version + 1;",
+            )
+            self._update_sql_cache[columns] = sql
+        return sql
+
+    def update_fields(self, chat_id: int, fields: Dict[str, Any]) -> bool:
+        return self.update_fields_many([(chat_id, fields)]) > 0
+
+    def update_fields_many(self, changes: Iterable[tuple]) -> int:
+        """
+        Write only the given columns: UPDATE users SET a=%s, b=%s WHERE chat_id=%s.
+        changes are (chat_id, {column: value}) pairs; keys outside USER_COLUMNS
+        are ignored. A chat without a row yet gets it inserted with just these columns.
+        """
+        default_lang = (os.getenv("DEFAULT_LANGUAGE", "ru") or "ru").lower()
+        known = set(USER_COLUMNS[1:])
+        batch = []
+        for chat_id, fields in changes:
+            columns = tuple(sorted(k for k in fields if k in known))
+            if columns:
+                values = tuple(self._column_default(c, fields[c], default_lang) for c in columns)
+                batch.append((int(chat_id), columns, values))
+        if not batch:
+            return 0
+
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                for chat_id, columns, values in batch:
+                    update_sql, insert_sql = self._update_sql(columns)
+                    cur.execute(update_sql, values + (chat_id,), prepare=True)
+                    if cur.rowcount == 0:
+                        cur.execute(insert_sql, (chat_id,) + values, prepare=True)
+            conn.commit()
+        return len(batch)
+
+    def _merge_sql(self, columns: tuple, counters: tuple) -> tuple:
+        # (version-checked UPDATE, unconditional merge UPDATE, INSERT) per column set
+        key = ("merge", columns, counters)
+        sql = self._update_sql_cache.get(key)
+        if sql is None:
+            assignments = [f"{c} = %s" for c in columns]
+            assignments += [f"{c} = COALESCE({c}, 0) + %s" for c in counters]
+            assignments.append("version = version + 1")
+            returning = ", ".join(VERSIONED_COLUMNS)
+            update = f"UPDATE users SET {', '.join(assignments)} WHERE chat_id = %s"
+            names = ", ".join(("chat_id",) + columns + counters)
+            placeholders = ", ".join(["%s"] * (len(columns) + len(counters) + 1))
+            sql = (
+                f"{update} AND version = %s RETURNING {returning};",
+                f"{update} RETURNING {returning};",
+                f"INSERT INTO users ({names}) VALUES ({placeholders}) "
+                f"ON CONFLICT (chat_id) DO NOTHING RETURNING {returning};",
+            )
+            self._update_sql_cache[key] = sql
+        return sql
+
+    def merge_users(self, changes: Iterable[tuple]) -> List[tuple]:
+        """
+        Write changes from one of several bot instances sharing this database.
+        changes are (chat_id, {column: value}, {counter: delta}, expected_version)
+        tuples; expected_version is the users.version the instance last read
+        (None if it never saw a row).
+
+        Conflict policy: last writer wins per field. Only the columns in the
+        change are written, so concurrent changes to different fields of one
+        chat both survive; counters (COUNTER_COLUMNS) are added as deltas, so
+        concurrent increments both count. When two instances changed the same
+        non-counter column, the later write overwrites the earlier one; it is
+        not retried or rejected.
+
+        The version check (a compare-and-set UPDATE first) does not block
+        anything. It tells whether another instance wrote the row since this
+        one read it. If so, the same change is applied with an unconditional
+        UPDATE and flagged as conflicted.
+        Returns (row, conflicted) per change, row being the stored result with
+        VERSIONED_COLUMNS, so the caller can pick up the other instance's fields.
+        """
+        default_lang = (os.getenv("DEFAULT_LANGUAGE", "ru") or "ru").lower()
+        known = set(USER_COLUMNS[1:])
+        batch = []
+        for chat_id, fields, deltas, expected in changes:
+            counters = tuple(sorted(c for c in deltas if c in COUNTER_COLUMNS))
+            columns = tuple(sorted(k for k in fields if k in known and k not in counters))
+            values = tuple(self._column_default(c, fields[c], default_lang) for c in columns)
+            values += tuple(int(deltas[c] or 0) for c in counters)
+            batch.append((int(chat_id), columns, counters, values, expected))
+        results: List[tuple] = []
+        if not batch:
+            return results
+
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                for chat_id, columns, counters, values, expected in batch:
+                    cas_sql, merge_sql, insert_sql = self._merge_sql(columns, counters)
+                    if expected is not None:
+                        cur.execute(cas_sql, values + (chat_id, expected), prepare=True)
+                    else:
+                        # no row seen yet; counters start from their delta
+                        cur.execute(insert_sql, (chat_id,) + values, prepare=True)
+                    row = cur.fetchone()
+                    conflicted = row is None
+                    if row is None:
+                        cur.execute(merge_sql, values + (chat_id,), prepare=True)
+                        row = cur.fetchone()
+                    if row is None:
+                        # the row was deleted in between
+                        cur.execute(insert_sql, (chat_id,) + values, prepare=True)
+                        row = cur.fetchone()
+                    results.append((dict(zip(VERSIONED_COLUMNS, row)), conflicted))
+            conn.commit()
+        return results
 
+    def bulk_upsert_users(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """
+        Upsert users with one fixed column set (USER_COLUMNS; history goes
+        to the messages table, see append_messages/import_users).
+        Small batches go through a pipelined executemany; batches of
+        DB_COPY_THRESHOLD rows or more are COPY'd into a temp staging table
+        and merged with a single INSERT ... SELECT ... ON CONFLICT.
+        Keys missing from a row are written as NULL/defaults.
+        """
+        default_lang = (os.getenv("DEFAULT_LANGUAGE", "ru") or "ru").lower()
+
+        # one row per chat_id (last wins): ON CONFLICT can't touch a row twice
+        by_id: Dict[int, tuple] = {}
+        for r in rows:
+            if "chat_id" not in r:
+                continue
+            values = self._normalize_user_row(r, default_lang)
+            by_id[values[0]] = values
+        if not by_id:
+            return 0
+
+        columns = ", ".join(USER_COLUMNS)
+        updates = ", ".join(f"{c}=EXCLUDED.{c}" for c in USER_COLUMNS if c != "chat_id")
+        updates += ", version = users.version + 1"
+        use_copy = len(by_id) >= DB_COPY_THRESHOLD
+        started = time.monotonic()
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                if use_copy:
                     cur.execute(
+                        "CREATE TEMP TABLE IF NOT EXISTS users_stage "
+                        "(LIKE users INCLUDING DEFAULTS) ON COMMIT DROP;"
+                    )
+                    with cur.copy(f"COPY users_stage ({columns}) FROM STDIN") as copy:
+                        for values in by_id.values():
+                            copy.write_row(values)
+                    cur.execute(
+                        f"INSERT INTO users ({columns}) SELECT {columns} FROM users_stage "
+                        f"ON CONFLICT (chat_id) DO UPDATE SET {updates};"
+                    )
+                else:
+                    placeholders = ", ".join(["%s"] * len(USER_COLUMNS))
+                    cur.executemany(
                         f"INSERT INTO users ({columns}) VALUES ({placeholders}) "
                         f"ON CONFLICT (chat_id) DO UPDATE SET {updates};",
-                        vals,
+                        list(by_id.values()),
                     )
-                    count += 1
             conn.commit()
+
+        count = len(by_id)
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logging.log(
+            logging.INFO if use_copy else logging.DEBUG,
+            "bulk_upsert_users: %d rows via %s in %.3fs (%.0f rows/s)",
+            count, "COPY" if use_copy else "executemany", elapsed, count / elapsed,
+        )
         return count
 
     # compatibility with code calling store.save_all(...)
     def save_all(self, users: List[Dict[str, Any]]) -> None:
         self.bulk_upsert_users(users or [])
 
+    # only the given rows are written, the rest of the table is untouched
+    def upsert_users(self, rows: Iterable[Dict[str, Any]]) -> int:
+        return self.bulk_upsert_users(rows)
+
 
 # ---------- factory & helpers ----------
 def get_store():
@@ -222,7 +937,7 @@ def auto_migrate_file_to_db() -> None:
         file_store = FileStore()
         rows = list(file_store.load_all())
         if rows:
-            inserted = store.bulk_upsert_users(rows)
+            inserted = store.import_users(rows)
             print(f">>> migrated {inserted} users from file to DB", flush=True)
         else:
             print(">>> no users.json or it is empty — nothing to migrate", flush=True)
@@ -0,0 +1,1430 @@
+# lumi_async.py
+"""asyncio-рантайм Lumi (LUMI_RUNTIME=async).
+
+Состояние пользователей, тексты, тарифы и сборка запросов к OpenAI/CryptoPay
+общие с Lumi.py; здесь только сетевая часть: AsyncTeleBot, aiohttp-клиент
+для внешних API и aiohttp-сервер вебхука. Все апдейты обрабатываются в одном
+event loop, поэтому ожидание ответа модели не занимает поток. Хелперы
+состояния синхронные и работают с памятью: то, что читается из стора
+(промах U() в ленивом режиме, хвост истории из messages), диспетчер
+подгружает через asyncio.to_thread до запуска хендлеров.
+
+Запуск: LUMI_RUNTIME=async python Lumi.py (или python lumi_async.py).
+"""
+import asyncio
+import logging
+import os
+import random
+import signal
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+from telebot import ExceptionHandler, asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+
+import Lumi as core
+from Lumi import (
+    ALWAYS_PREMIUM,
+    BEST_PLAN_CODE,
+    BOT_TOKEN,
+    CRYPTO_API,
+    CRYPTO_FAILED_REPLY,
+    CRYPTO_INVOICE_URL,
+    DEFAULT_LANGUAGE,
+    FALLBACK,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_POOL_SIZE,
+    HTTP_PREWARM,
+    HTTP_UPSTREAMS,
+    LANGUAGES,
+    LYRICS_TRIGGERS_RE,
+    OPENAI_CHAT_URL,
+    OPENAI_FAILED_REPLY,
+    OPENAI_KEY,
+    OPENAI_NO_KEY_REPLY,
+    OPENAI_RETRIES,
+    OPENAI_RETRY_AFTER_MAX,
+    OPENAI_STREAM,
+    OPENAI_TEXT_MODEL,
+    OPENAI_TRANSCRIBE_MODEL,
+    OPENAI_TRANSCRIBE_URL,
+    OPENAI_UNAVAILABLE_REPLY,
+    OPENAI_VISION_MODEL,
+    PLAN_CODES,
+    PLANS,
+    POLLING_LIMIT,
+    POLLING_TIMEOUT,
+    REMIND_AT,
+    RETRY_STATUSES,
+    ReplyStream,
+    SHUTDOWN_TIMEOUT,
+    SENSITIVE_PATTERNS,
+    SENSITIVE_REGEXES,
+    STREAM_FINAL_RETRIES,
+    TRIAL_MESSAGES,
+    UNSUBSCRIBE_RE,
+    WEBHOOK_HOST,
+    WEBHOOK_OVERLOAD,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_SHED_AT,
+    WEBHOOK_SSL_CERT,
+    WEBHOOK_SSL_KEY,
+    WEBHOOK_URL,
+    U,
+    _chunk_text,
+    active_plan,
+    audio_mime,
+    build_chat_payload,
+    contains_patterns,
+    crypto_invoice_payload,
+    dirty_count,
+    get_history,
+    get_language,
+    grant_permanent_plan,
+    grant_premium,
+    greeting_text,
+    has_general_profanity,
+    has_premium,
+    is_admin,
+    is_free_tier,
+    is_language_confirmed,
+    is_targeted_abuse,
+    lang_text,
+    lang_text_fallback,
+    log_update,
+    lyrics_prompt,
+    mark_language_confirmed,
+    mark_policy_sent,
+    mark_policy_shown,
+    mark_support_sent,
+    openai_breakers,
+    openai_headers,
+    openai_limiter,
+    openai_refund,
+    parse_retry_after,
+    payload_tokens,
+    plan_behavior,
+    plan_name,
+    plans_text,
+    policy_is_shown,
+    queue_params,
+    record_turn,
+    retry_delay,
+    save_state,
+    set_language,
+    set_news_opt_out,
+    should_send_support,
+    sse_delta,
+    store,
+    subscription_overview,
+    telegram_file_url,
+    telegram_retry_after,
+    touch_user_profile,
+    update_chat_id,
+    update_deduper,
+    vent_context_note,
+    vision_payload,
+)
+
+# сколько апдейтов одновременно в работе; сверх этого вебхук применяет WEBHOOK_OVERLOAD,
+# а поллинг ждёт, пока не освободится место
+ASYNC_MAX_UPDATES = int(os.getenv("ASYNC_MAX_UPDATES", "1000"))
+
+
+class RaiseHandlerErrors(ExceptionHandler):
+    """Ошибка хендлера уходит в AsyncUpdateDispatcher, как у TeleBot(threaded=False).
+
+    Сам AsyncTeleBot её глотает: в лог только str(e), traceback — на DEBUG,
+    и updates.failed в /metrics не растёт.
+    """
+
+    def handle(self, exception: Exception) -> bool:
+        raise exception
+
+
+abot = AsyncTeleBot(BOT_TOKEN, parse_mode="HTML", exception_handler=RaiseHandlerErrors())
+
+_http: Optional[aiohttp.ClientSession] = None
+
+
+def http() -> aiohttp.ClientSession:
+    """Общая aiohttp-сессия для OpenAI, CryptoPay и файлов Telegram (создаётся внутри loop).
+
+    Соединения keep-alive, не больше HTTP_POOL_SIZE на хост — как у пулов requests в Lumi.py.
+    """
+    global _http
+    if _http is None or _http.closed:
+        _http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=HTTP_POOL_SIZE))
+    return _http
+
+
+def http_timeout(read: float, stream: bool = False) -> aiohttp.ClientTimeout:
+    """Как Lumi.http_timeout: быстрое соединение, read — пауза в ответе.
+
+    Обычный запрос целиком тоже не дольше read; у потокового ответа общего
+    предела нет — генерация идёт дольше, ограничена только пауза между кусками.
+    """
+    return aiohttp.ClientTimeout(total=None if stream else read, connect=HTTP_CONNECT_TIMEOUT, sock_read=read)
+
+
+async def prewarm_http() -> None:
+    async def warm(upstream: str, url: str) -> None:
+        try:
+            async with http().head(url, timeout=http_timeout(5)):
+                pass
+        except Exception as exc:
+            logging.warning("HTTP prewarm %s failed: %r", upstream, exc)
+
+    await asyncio.gather(*(warm(upstream, url) for upstream, url in HTTP_UPSTREAMS.items()))
+
+
+# ================== OPENAI ==================
+async def openai_slot(model: str, plan: str, tokens: int) -> bool:
+    """Асинхронная версия core.openai_slot: та же очередь лимитера, ожидание — asyncio.sleep."""
+    limiter = openai_limiter(model)
+    if limiter is None:
+        return True
+    priority, max_wait = queue_params(plan)
+    ticket = limiter.enqueue(priority)
+    deadline = time.monotonic() + max_wait
+    try:
+        while True:
+            delay = limiter.poll(ticket, tokens)
+            if not delay:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                limiter.cancel(ticket, timeout=True)
+                logging.warning("OpenAI %s: no rate limit slot within %gs for plan %s", model, max_wait, plan)
+                return False
+            await asyncio.sleep(min(delay, remaining))
+    except BaseException:
+        limiter.cancel(ticket)
+        raise
+
+
+async def openai_post(
+        endpoint: str,
+        url: str,
+        *,
+        model: str,
+        plan: str = "free",
+        tokens: int = 0,
+        form=None,
+        **kwargs,
+) -> Optional[aiohttp.ClientResponse]:
+    """Асинхронная версия core.openai_post; ответ закрывает вызывающий (async with resp).
+
+    form — фабрика aiohttp.FormData: FormData одноразовая, на повтор нужна новая.
+    """
+    breaker = openai_breakers[endpoint]
+    if not breaker.allow():
+        logging.warning("OpenAI %s: circuit open, request skipped", endpoint)
+        return None
+    ok: Optional[bool] = None  # итог для автомата — один на вызов; отмена задачи тоже его снимает
+    try:
+        for attempt in range(OPENAI_RETRIES + 1):
+            last = attempt == OPENAI_RETRIES
+            if not await openai_slot(model, plan, tokens):
+                return None
+            if form is not None:
+                kwargs["data"] = form()
+            try:
+                resp = await http().post(url, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                logging.warning("OpenAI %s attempt %s failed: %r", endpoint, attempt + 1, exc)
+                if isinstance(exc, aiohttp.ClientConnectorError):
+                    openai_refund(model, tokens)
+                if last:
+                    ok = False
+                    return None
+                delay = retry_delay(attempt)
+            else:
+                if resp.status not in RETRY_STATUSES:
+                    ok = True
+                    return resp
+                if resp.status == 429:
+                    openai_refund(model, tokens)
+                delay = retry_delay(attempt, parse_retry_after(resp.headers.get("Retry-After")))
+                if last or delay > OPENAI_RETRY_AFTER_MAX:
+                    ok = False
+                    return resp
+                logging.warning("OpenAI %s %s, retry in %.1fs", endpoint, resp.status, delay)
+                resp.release()
+            await asyncio.sleep(delay)
+        return None
+    finally:
+        breaker.settle(ok)
+
+
+async def ask_openai(prompt: str, **kwargs) -> str:
+    if not OPENAI_KEY:
+        return OPENAI_NO_KEY_REPLY
+
+    payload = build_chat_payload(prompt, **kwargs)
+    try:
+        resp = await openai_post(
+            "chat",
+            OPENAI_CHAT_URL,
+            model=OPENAI_TEXT_MODEL,
+            plan=kwargs.get("plan", "free"),
+            tokens=payload_tokens(payload),
+            headers=openai_headers(),
+            json=payload,
+            timeout=http_timeout(30),
+        )
+        if resp is None:
+            return OPENAI_UNAVAILABLE_REPLY
+        async with resp:
+            body = await resp.text()
+            if resp.status != 200:
+                logging.error("OpenAI %s: %s", resp.status, body)
+                return OPENAI_UNAVAILABLE_REPLY
+            try:
+                data = await resp.json(content_type=None)
+                return data["choices"][0]["message"]["content"].strip()
+            except Exception as exc:
+                logging.exception("OpenAI parse error: %r | body=%s", exc, body[:500])
+                return OPENAI_FAILED_REPLY
+    except Exception as exc:
+        logging.exception("OpenAI HTTP error: %r", exc)
+        return OPENAI_FAILED_REPLY
+
+
+async def ask_openai_lyrics(
+        fragment: str,
+        *,
+        language: Optional[str],
+        history: Optional[List[Dict[str, str]]],
+        plan: str,
+) -> str:
+    return await ask_openai(lyrics_prompt(fragment, language), language=language, history=history, plan=plan)
+
+
+async def _stream_frame(chat_id: int, message_ids: List[int], index: int, part: str, final: bool) -> Optional[float]:
+    for parse_mode in ((None, "") if final else ("",)):
+        try:
+            if index >= len(message_ids):
+                message_ids.append((await abot.send_message(chat_id, part, parse_mode=parse_mode)).message_id)
+            else:
+                await abot.edit_message_text(part, chat_id, message_ids[index], parse_mode=parse_mode)
+            return None
+        except asyncio_helper.ApiTelegramException as exc:
+            delay = telegram_retry_after(exc)
+            if delay is not None:
+                return delay
+            if "message is not modified" in exc.description:
+                return None
+            if "can't parse entities" not in exc.description:
+                raise
+    return None
+
+
+async def show_stream(chat_id: int, stream: ReplyStream, message_ids: List[int], final: bool = False) -> bool:
+    frames = list(enumerate(stream.parts())) if final else stream.changes()
+    for index, part in frames:
+        delay = await _stream_frame(chat_id, message_ids, index, part, final)
+        retries = STREAM_FINAL_RETRIES if final else 0
+        while delay is not None and retries:
+            retries -= 1
+            await asyncio.sleep(min(delay, 10.0))
+            delay = await _stream_frame(chat_id, message_ids, index, part, final)
+        if delay is not None:
+            stream.throttle(delay)
+            return False
+        stream.mark_shown(index, part)
+    stream.throttle()
+    return True
+
+
+async def stream_reply(chat_id: int, prompt: str, **kwargs) -> Optional[str]:
+    """Асинхронная версия core.stream_reply."""
+    if not OPENAI_KEY:
+        await abot.send_message(chat_id, OPENAI_NO_KEY_REPLY)
+        return None
+    payload = build_chat_payload(prompt, **kwargs)
+    payload["stream"] = True
+    stream = ReplyStream()
+    message_ids: List[int] = []
+    complete = False
+    try:
+        resp = await openai_post(
+            "chat",
+            OPENAI_CHAT_URL,
+            model=OPENAI_TEXT_MODEL,
+            plan=kwargs.get("plan", "free"),
+            tokens=payload_tokens(payload),
+            headers=openai_headers(),
+            json=payload,
+            timeout=http_timeout(30, stream=True),
+        )
+        if resp is None:
+            await abot.send_message(chat_id, OPENAI_UNAVAILABLE_REPLY)
+            return None
+        async with resp:
+            if resp.status != 200:
+                logging.error("OpenAI %s: %s", resp.status, (await resp.text())[:2000])
+                await abot.send_message(chat_id, OPENAI_UNAVAILABLE_REPLY)
+                return None
+            async for raw in resp.content:
+                delta = sse_delta(raw.decode("utf-8", "replace").strip())
+                if delta is None:
+                    complete = True
+                    break
+                if delta:
+                    stream.push(delta)
+                    if stream.due():
+                        await show_stream(chat_id, stream, message_ids)
+    except Exception as exc:
+        logging.exception("OpenAI stream error: %r", exc)
+    if not stream.text.strip():
+        await abot.send_message(chat_id, OPENAI_FAILED_REPLY)
+        return None
+    if not complete:
+        stream.push(" …")
+    if not await show_stream(chat_id, stream, message_ids, final=True):
+        logging.warning("Stream reply to %s: final frame not delivered", chat_id)
+        complete = False
+    stream.record(complete)
+    return stream.text.strip() if complete else None
+
+
+async def create_crypto_invoice(plan_code: str, chat_id: int) -> str:
+    payload = crypto_invoice_payload(plan_code, chat_id)
+    if payload:
+        try:
+            async with http().post(
+                CRYPTO_INVOICE_URL,
+                headers={"Crypto-Pay-API-Token": CRYPTO_API},
+                data=payload,
+                timeout=http_timeout(15),
+            ) as resp:
+                resp.raise_for_status()
+                data = await resp.json(content_type=None)
+            pay_url = data.get("result", {}).get("pay_url") if data.get("ok") else None
+            if pay_url:
+                return str(pay_url)
+        except Exception as exc:
+            logging.exception("CryptoPay error: %r", exc)
+            return CRYPTO_FAILED_REPLY
+    return FALLBACK.get(plan_code) or "https://t.me/CryptoBot"
+
+
+async def plans_text_async(chat_id: int) -> str:
+    # счета по всем тарифам создаём параллельно
+    codes = [code for code in PLAN_CODES if PLANS.get(code)]
+    urls = await asyncio.gather(*(create_crypto_invoice(code, chat_id) for code in codes))
+    return plans_text(chat_id, dict(zip(codes, urls)))
+
+
+async def download_file(file_id: str) -> Optional[tuple[bytes, str]]:
+    try:
+        file_info = await abot.get_file(file_id)
+        async with http().get(
+            telegram_file_url(file_info.file_path),
+            timeout=http_timeout(30),
+        ) as resp:
+            resp.raise_for_status()
+            return await resp.read(), file_info.file_path
+    except Exception as exc:
+        logging.exception("Failed to download file %s: %r", file_id, exc)
+        return None
+
+
+async def transcribe_audio(chat_id: int, file_bytes: bytes, filename: str) -> Optional[str]:
+    if not (OPENAI_KEY and OPENAI_TRANSCRIBE_MODEL):
+        return None
+
+    language = get_language(chat_id)
+
+    def form() -> aiohttp.FormData:
+        data = aiohttp.FormData()
+        data.add_field("file", file_bytes, filename=filename, content_type=audio_mime(filename))
+        data.add_field("model", OPENAI_TRANSCRIBE_MODEL)
+        data.add_field("language", language)
+        return data
+
+    try:
+        resp = await openai_post(
+            "transcribe",
+            OPENAI_TRANSCRIBE_URL,
+            model=OPENAI_TRANSCRIBE_MODEL,
+            plan=active_plan(chat_id),
+            headers=openai_headers(json_body=False),
+            form=form,
+            timeout=http_timeout(120),
+        )
+        if resp is None:
+            return None
+        async with resp:
+            if resp.status != 200:
+                logging.error("ASR HTTP %s: %s", resp.status, (await resp.text())[:2000])
+                return None
+            j = await resp.json(content_type=None)
+        text = (j.get("text") or "").strip()
+        if not text:
+            logging.error("ASR empty text: %s", j)
+            return None
+        return text
+    except Exception as exc:
+        logging.exception("ASR error: %r", exc)
+        return None
+
+
+async def describe_image(chat_id: int, file_bytes: bytes, filename: str) -> Optional[str]:
+    if not (OPENAI_KEY and OPENAI_VISION_MODEL):
+        return None
+
+    payload = vision_payload(chat_id, file_bytes, filename)
+    if payload is None:
+        return None
+
+    try:
+        resp = await openai_post(
+            "vision",
+            OPENAI_CHAT_URL,
+            model=OPENAI_VISION_MODEL,
+            plan=active_plan(chat_id),
+            tokens=payload_tokens(payload),
+            headers=openai_headers(),
+            json=payload,
+            timeout=http_timeout(120),
+        )
+        if resp is None:
+            return None
+        async with resp:
+            if resp.status != 200:
+                logging.error("Vision HTTP %s: %s", resp.status, (await resp.text())[:2000])
+                return None
+            j = await resp.json(content_type=None)
+        out = j["choices"][0]["message"]["content"].strip()
+        if not out:
+            logging.error("Vision empty content: %s", j)
+            return None
+        return out
+    except Exception as exc:
+        logging.exception("Vision error: %r", exc)
+        return None
+
+
+# ================== ОТПРАВКА ==================
+async def send_supportive_phrase(chat_id: int) -> None:
+    lang = get_language(chat_id)
+    pack = LANGUAGES.get(lang, LANGUAGES[DEFAULT_LANGUAGE])
+    phrases = pack.get("supportive", [])
+    if not phrases:
+        return
+    phrase = random.choice(list(phrases))
+    template = pack.get("supportive_intro", "{phrase}")
+    try:
+        await abot.send_message(chat_id, str(template).format(phrase=phrase))
+        mark_support_sent(chat_id)
+    except Exception:
+        await abot.send_message(chat_id, lang_text(chat_id, "support_error"))
+
+
+async def send_language_choice(chat_id: int) -> None:
+    markup = types.InlineKeyboardMarkup()
+    for code, data in LANGUAGES.items():
+        markup.add(types.InlineKeyboardButton(str(data["name"]), callback_data=f"lang:{code}"))
+    await abot.send_message(chat_id, lang_text(chat_id, "language_prompt"), reply_markup=markup)
+
+
+def policy_keyboard(chat_id: int) -> types.InlineKeyboardMarkup:
+    kb = types.InlineKeyboardMarkup()
+    kb.add(
+        types.InlineKeyboardButton(
+            lang_text(chat_id, "policy_accept") or LANGUAGES[DEFAULT_LANGUAGE].get("policy_accept", "Accept"),
+            callback_data="offer:accept",
+        )
+    )
+    return kb
+
+
+async def send_policy(chat_id: int) -> None:
+    chunks = _chunk_text(lang_text(chat_id, "policy"))
+    kb = policy_keyboard(chat_id)
+    try:
+        # все части без кнопки, последняя — с кнопкой
+        for c in chunks[:-1]:
+            await abot.send_message(chat_id, c, disable_web_page_preview=True)
+        last = chunks[-1] if chunks else "—"
+        await abot.send_message(chat_id, last, reply_markup=kb, disable_web_page_preview=True)
+        mark_policy_sent(chat_id)
+    except Exception as e:
+        logging.exception("send_policy failed: %r", e)
+        hint = lang_text_fallback(chat_id, "policy_repeat") or "Чтобы продолжить, нажми «Принимаю» или /accept."
+        try:
+            await abot.send_message(chat_id, hint, reply_markup=kb, disable_web_page_preview=True)
+            mark_policy_sent(chat_id)
+        except Exception as e2:
+            logging.exception("send_policy fallback failed: %r", e2)
+
+
+async def ensure_ready(message) -> bool:
+    chat_id = message.chat.id
+    touch_user_profile(message)
+
+    if not is_language_confirmed(chat_id):
+        logging.info("ensure_ready: lang not confirmed for %s", chat_id)
+        await send_language_choice(chat_id)
+        return False
+
+    if not policy_is_shown(chat_id):
+        logging.info("ensure_ready: policy not accepted for %s", chat_id)
+        info = U(chat_id)
+        now = datetime.now(timezone.utc)
+        if not info.offer_prompted:
+            info.offer_prompted = True
+            info.offer_remind_at = now
+            save_state()
+            await abot.send_message(chat_id, greeting_text(chat_id))
+            await send_policy(chat_id)
+            return False
+
+        # напоминание раз в 2 минуты
+        last = info.offer_remind_at
+        if not last or now - last >= timedelta(minutes=2):
+            msg = lang_text_fallback(chat_id, "policy_repeat") or "Чтобы продолжить, нажми «Принимаю» или /accept."
+            await abot.send_message(chat_id, msg, reply_markup=policy_keyboard(chat_id))
+            info.offer_remind_at = now
+            save_state()
+        return False
+
+    return True
+
+
+# ================== ХЭНДЛЕРЫ ==================
+@abot.message_handler(commands=["ping"])
+async def cmd_ping(message):
+    await abot.reply_to(message, "pong")
+
+
+@abot.message_handler(func=lambda m: m.content_type == "text" and m.text.strip().lower() == "ping")
+async def txt_ping(message):
+    await abot.reply_to(message, "pong-echo")
+
+
+@abot.message_handler(commands=["buy"])
+async def cmd_buy(message):
+    await abot.send_message(message.chat.id, await plans_text_async(message.chat.id))
+
+
+@abot.message_handler(commands=["language"])
+async def cmd_language(message):
+    current = get_language(message.chat.id)
+    kb = types.InlineKeyboardMarkup()
+    for code, data in LANGUAGES.items():
+        label = f"✅ {data['name']}" if code == current else str(data["name"])
+        kb.add(types.InlineKeyboardButton(label, callback_data=f"lang:{code}"))
+    await abot.send_message(
+        message.chat.id,
+        f"Текущий язык: {LANGUAGES.get(current, LANGUAGES['ru'])['name']}. Выбери язык:",
+        reply_markup=kb,
+    )
+
+
+@abot.message_handler(commands=["subs"])
+async def cmd_subscriptions(message):
+    touch_user_profile(message)
+    if not is_admin(message.from_user.id):
+        await abot.reply_to(message, lang_text(message.chat.id, "grant_best_denied"))
+        return
+
+    tokens = message.text.split()
+    show_all = len(tokens) > 1 and tokens[1].lower() in {"all", "все", "all/", "all."}
+    # обход всех пользователей (в ленивом режиме — чтение из стора) уводим из loop
+    overview = await asyncio.to_thread(subscription_overview, show_all, get_language(message.chat.id))
+    for chunk in _chunk_text(overview):
+        await abot.reply_to(message, chunk)
+
+
+@abot.message_handler(commands=["grant"])
+async def cmd_grant(message):
+    touch_user_profile(message)
+    if not is_admin(message.from_user.id):
+        await abot.reply_to(message, lang_text(message.chat.id, "grant_best_denied"))
+        return
+
+    plan_code: Optional[str] = None
+    days: Optional[int] = None
+    payment_method: Optional[str] = None
+    payment_reference: Optional[str] = None
+    for token in message.text.split()[1:]:
+        low = token.lower()
+        if low in PLAN_CODES:
+            plan_code = low
+        elif low.startswith("pay=") or low.startswith("method="):
+            _, _, raw = token.partition("=")
+            if raw:
+                payment_method = raw
+        elif low.startswith("ref=") or low.startswith("id="):
+            _, _, raw = token.partition("=")
+            if raw:
+                payment_reference = raw
+        else:
+            try:
+                days = int(low)
+            except Exception:
+                continue
+
+    plan_code = plan_code or "basic"
+    default_days = PLANS.get(plan_code, {}).get("days", 30)
+    days = days if days and days > 0 else int(default_days)
+    grant_premium(
+        message.chat.id,
+        days,
+        plan_code,
+        source="admin_grant",
+        payment_method=payment_method or "admin_grant",
+        payment_reference=payment_reference,
+    )
+    await abot.reply_to(
+        message,
+        lang_text(
+            message.chat.id,
+            "premium_granted",
+            days=days,
+            plan=plan_name(plan_code, get_language(message.chat.id)),
+        ),
+    )
+
+
+async def resolve_user_identifier(value: str) -> Optional[int]:
+    """Асинхронная версия core.resolve_user_identifier: @username — через abot.get_chat."""
+    candidate = (value or "").strip()
+    if candidate.startswith("@"):
+        try:
+            return (await abot.get_chat(candidate)).id
+        except Exception as exc:
+            logging.warning("Failed to resolve username %s: %r", candidate, exc)
+            return None
+    return core.resolve_user_identifier(candidate)
+
+
+@abot.message_handler(commands=["grant_best"])
+async def cmd_grant_best(message):
+    if not is_admin(message.from_user.id):
+        await abot.reply_to(message, lang_text(message.chat.id, "grant_best_denied"))
+        return
+
+    target_id: Optional[int] = None
+    target_label: Optional[str] = None
+
+    if message.reply_to_message and message.reply_to_message.from_user:
+        user = message.reply_to_message.from_user
+        target_id = user.id
+        target_label = f"@{user.username}" if user.username else (user.full_name or str(user.id))
+    else:
+        parts = message.text.split(maxsplit=1)
+        if len(parts) > 1:
+            raw = parts[1].strip()
+            resolved = await resolve_user_identifier(raw)
+            if resolved:
+                target_id = resolved
+                if raw.startswith("@"):
+                    target_label = raw
+        if target_id and not target_label:
+            try:
+                chat = await abot.get_chat(target_id)
+                target_label = chat.full_name or (f"@{chat.username}" if chat.username else str(target_id))
+            except Exception:
+                target_label = str(target_id)
+
+    if not target_id:
+        await abot.reply_to(message, lang_text(message.chat.id, "grant_best_prompt"))
+        return
+
+    grant_permanent_plan(target_id, BEST_PLAN_CODE)
+    if plan_behavior(BEST_PLAN_CODE).get("support_interval"):
+        mark_support_sent(target_id)
+
+    label = target_label or str(target_id)
+    await abot.reply_to(message, lang_text(message.chat.id, "grant_best_done", target=label))
+    try:
+        await abot.send_message(target_id, lang_text(target_id, "grant_permanent"))
+    except Exception as exc:
+        logging.warning("Failed to notify user %s about permanent access: %r", target_id, exc)
+
+
+@abot.message_handler(commands=["start"])
+async def cmd_start(message):
+    chat_id = message.chat.id
+    info = U(chat_id)
+    if str(chat_id) in ALWAYS_PREMIUM and not info.permanent_plan:
+        grant_permanent_plan(chat_id, BEST_PLAN_CODE)
+        await abot.send_message(chat_id, lang_text(chat_id, "grant_permanent"))
+        mark_support_sent(chat_id)
+
+    if not is_language_confirmed(chat_id):
+        await send_language_choice(chat_id)
+        return
+
+    if policy_is_shown(chat_id):
+        await abot.send_message(chat_id, lang_text(chat_id, "policy_again"))
+    else:
+        await abot.send_message(chat_id, greeting_text(chat_id))
+        await send_policy(chat_id)
+
+
+@abot.message_handler(commands=["news_off"])
+async def cmd_news_off(message):
+    changed = set_news_opt_out(message.chat.id)
+    key = "news_off_done" if changed else "news_off_already"
+    reply = lang_text_fallback(message.chat.id, key) or "Маркетинговые уведомления отключены."
+    await abot.reply_to(message, reply)
+
+
+@abot.message_handler(commands=["policy"])
+async def cmd_policy(message):
+    await send_policy(message.chat.id)
+
+
+@abot.message_handler(commands=["reset_policy"])
+async def cmd_reset(message):
+    info = U(message.chat.id)
+    info.policy_shown = False
+    info.accepted_at = None
+    save_state()
+    await abot.reply_to(message, lang_text(message.chat.id, "policy_reset"))
+
+
+@abot.message_handler(commands=["diag"])
+async def cmd_diag(message):
+    info = U(message.chat.id)
+    left = max(0, TRIAL_MESSAGES - (info.free_used or 0))
+    plan_code = active_plan(message.chat.id)
+    await abot.reply_to(
+        message,
+        lang_text(
+            message.chat.id,
+            "diagnostics",
+            router="ok" if OPENAI_KEY else "missing",
+            left=left,
+            premium="yes" if has_premium(message.chat.id) else "no",
+            plan=plan_name(plan_code, get_language(message.chat.id)),
+        ),
+    )
+
+
+@abot.callback_query_handler(func=lambda c: c.data and c.data.startswith("lang:"))
+async def cb_language(callback):
+    try:
+        await abot.answer_callback_query(callback.id)
+    except Exception:
+        pass
+
+    lang = callback.data.split(":", 1)[1].lower()
+    chat_id = callback.message.chat.id if callback.message else callback.from_user.id
+    set_language(chat_id, lang)
+    mark_language_confirmed(chat_id)
+
+    if callback.message:
+        try:
+            await abot.edit_message_reply_markup(chat_id, callback.message.message_id, reply_markup=None)
+        except Exception:
+            pass
+
+    confirm = LANGUAGES.get(lang, LANGUAGES[DEFAULT_LANGUAGE]).get("language_confirm")
+    if confirm:
+        await abot.send_message(chat_id, str(confirm))
+
+    if not policy_is_shown(chat_id):
+        await abot.send_message(chat_id, greeting_text(chat_id))
+        await send_policy(chat_id)
+
+
+@abot.callback_query_handler(func=lambda c: c.data == "offer:accept")
+async def cb_offer_accept(callback):
+    chat_id = callback.message.chat.id if callback.message else callback.from_user.id
+    toast = lang_text(chat_id, "policy_accept_toast") or LANGUAGES[DEFAULT_LANGUAGE].get("policy_accept_toast", "")
+    try:
+        await abot.answer_callback_query(callback.id, toast if toast else None)
+    except Exception:
+        pass
+
+    mark_policy_shown(chat_id)
+
+    if callback.message:
+        try:
+            await abot.edit_message_reply_markup(chat_id, callback.message.message_id, reply_markup=None)
+        except Exception:
+            pass
+
+    await abot.send_message(chat_id, lang_text(chat_id, "thank_you"))
+
+
+@abot.message_handler(func=lambda m: m.content_type == "text" and m.text and m.text.strip().lower() in {"принимаю", "accept"})
+async def txt_accept(message):
+    mark_policy_shown(message.chat.id)
+    toast = lang_text(message.chat.id, "policy_accept_toast") or "Условия приняты"
+    try:
+        await abot.reply_to(message, toast)
+    except Exception:
+        pass
+    await abot.send_message(message.chat.id, lang_text(message.chat.id, "thank_you"))
+
+
+@abot.callback_query_handler(func=lambda c: True)
+async def cb_fallback(callback):
+    try:
+        await abot.answer_callback_query(callback.id)
+    except Exception:
+        pass
+
+
+@abot.message_handler(func=lambda m: m.content_type == "text" and m.text and m.text.strip().lower() in {"да", "yes"})
+async def txt_yes_accept(message):
+    # «Да/Yes» до принятия оферты считаем согласием
+    if not policy_is_shown(message.chat.id):
+        mark_policy_shown(message.chat.id)
+        await abot.reply_to(message, lang_text(message.chat.id, "policy_accept_toast") or "Условия приняты")
+        await abot.send_message(message.chat.id, lang_text(message.chat.id, "thank_you"))
+
+
+@abot.message_handler(content_types=["text"])
+async def any_text(message):
+    chat_id = message.chat.id
+    if not is_language_confirmed(chat_id):
+        set_language(chat_id, get_language(chat_id))
+        mark_language_confirmed(chat_id)
+
+    if not await ensure_ready(message):
+        return
+
+    info = U(chat_id)
+    text = (message.text or "").strip()
+    if not text:
+        await abot.send_message(chat_id, lang_text(chat_id, "ask_topic"))
+        return
+    if UNSUBSCRIBE_RE.match(text):
+        changed = set_news_opt_out(chat_id)
+        key = "news_off_done" if changed else "news_off_already"
+        reply = lang_text_fallback(chat_id, key) or "Маркетинговые уведомления отключены."
+        await abot.send_message(chat_id, reply)
+        return
+
+    if LYRICS_TRIGGERS_RE.search(text):
+        info.lyrics_expected = True
+        save_state()
+        await abot.send_message(chat_id, lang_text(chat_id, "lyrics_ask"))
+        return
+
+    if info.lyrics_expected:
+        info.lyrics_expected = False
+        save_state()
+
+        plan_code = active_plan(chat_id)
+        reply = await ask_openai_lyrics(
+            text, language=get_language(chat_id), history=get_history(chat_id), plan=plan_code,
+        )
+        record_turn(chat_id, f"[LYRICS] {text}", reply, plan_code)
+        await abot.send_message(chat_id, reply)
+        return
+
+    if contains_patterns(text, SENSITIVE_PATTERNS, SENSITIVE_REGEXES):
+        await abot.send_message(chat_id, lang_text(chat_id, "sensitive"))
+        return
+
+    if is_targeted_abuse(text):
+        strikes = (info.abuse_strikes or 0) + 1
+        key = "abuse_final" if strikes >= 2 else "abuse_first"
+        info.abuse_strikes = 0 if strikes >= 2 else strikes
+        save_state()
+        await abot.send_message(chat_id, lang_text(chat_id, key))
+        return
+
+    vent_note = None
+    if has_general_profanity(text):
+        info.last_vent_at = datetime.now(timezone.utc)
+        info.last_vent_note = "general"
+        vent_note = vent_context_note(chat_id)
+    elif info.last_vent_note is not None:
+        info.last_vent_note = None
+
+    plan_code = active_plan(chat_id)
+    is_premium = plan_code != "free"
+    rest = None
+    if not is_premium:
+        next_count = (info.free_used or 0) + 1
+        info.free_used = next_count
+        if next_count > TRIAL_MESSAGES:
+            save_state()
+            await abot.send_message(chat_id, lang_text(chat_id, "free_end"))
+            await abot.send_message(chat_id, await plans_text_async(chat_id))
+            return
+        rest = TRIAL_MESSAGES - next_count
+
+    if OPENAI_STREAM:
+        reply = await stream_reply(
+            chat_id, text, language=get_language(chat_id), history=get_history(chat_id), plan=plan_code,
+            context_note=vent_note,
+        )
+        if reply is not None:
+            record_turn(chat_id, text, reply, plan_code)
+    else:
+        reply = await ask_openai(
+            text, language=get_language(chat_id), history=get_history(chat_id), plan=plan_code, context_note=vent_note,
+        )
+        record_turn(chat_id, text, reply, plan_code)
+        await abot.send_message(chat_id, reply)
+
+    if is_premium:
+        if should_send_support(chat_id, plan_code):
+            await send_supportive_phrase(chat_id)
+    elif rest is not None and rest in REMIND_AT:
+        await abot.send_message(chat_id, lang_text(chat_id, "trial_left", rest=rest))
+
+
+async def _transcribed_text(message, file_id: str, failed_key: str, prompt_key: str) -> None:
+    downloaded = await download_file(file_id)
+    if not downloaded:
+        await abot.send_message(message.chat.id, lang_text(message.chat.id, failed_key))
+        return
+    file_bytes, filename = downloaded
+    transcript = await transcribe_audio(message.chat.id, file_bytes, filename)
+    if not transcript:
+        await abot.send_message(message.chat.id, lang_text(message.chat.id, failed_key))
+        return
+    await abot.send_message(message.chat.id, lang_text(message.chat.id, prompt_key, text=transcript))
+    message.text = transcript
+    await any_text(message)
+
+
+@abot.message_handler(content_types=["voice", "audio"])
+async def handle_voice(message):
+    if not await ensure_ready(message):
+        return
+    file_id = message.voice.file_id if message.content_type == "voice" else message.audio.file_id
+    await _transcribed_text(message, file_id, "voice_failed", "voice_prompt")
+
+
+@abot.message_handler(content_types=["video", "video_note"])
+async def handle_video(message):
+    if not await ensure_ready(message):
+        return
+    file_id = message.video.file_id if message.content_type == "video" else message.video_note.file_id
+    await _transcribed_text(message, file_id, "video_failed", "video_prompt")
+
+
+@abot.message_handler(content_types=["photo"])
+async def handle_photo(message):
+    if not await ensure_ready(message):
+        return
+    downloaded = await download_file(message.photo[-1].file_id)
+    if not downloaded:
+        await abot.send_message(message.chat.id, lang_text(message.chat.id, "photo_failed"))
+        return
+    file_bytes, filename = downloaded
+    description = await describe_image(message.chat.id, file_bytes, filename)
+    if not description:
+        await abot.send_message(message.chat.id, lang_text(message.chat.id, "photo_failed"))
+        return
+    await abot.send_message(message.chat.id, lang_text(message.chat.id, "photo_prompt", description=description))
+    template = LANGUAGES.get(get_language(message.chat.id), LANGUAGES[DEFAULT_LANGUAGE]).get("photo_model")
+    message.text = str(template or "Photo description: {description}").format(description=description)
+    await any_text(message)
+
+
+@abot.message_handler(commands=["accept"])
+async def cmd_accept(message):
+    mark_policy_shown(message.chat.id)
+    toast = lang_text(message.chat.id, "policy_accept_toast") or "Условия приняты"
+    try:
+        await abot.reply_to(message, toast)
+    except Exception:
+        pass
+    await abot.send_message(message.chat.id, lang_text(message.chat.id, "thank_you"))
+
+
+# ================== ДИСПЕТЧЕР ==================
+class AsyncUpdateDispatcher:
+    """Async-аналог UpdateWorkerPool: апдейт — задача в loop, не поток.
+
+    Апдейты одного чата идут строго по очереди (asyncio.Lock на чат отдаёт
+    захват в порядке ожидания), разные чаты — параллельно. Одновременно
+    в работе не больше limit апдейтов.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self._locks: Dict[object, asyncio.Lock] = {}
+        self._holders: Dict[object, int] = {}  # сколько апдейтов чата в работе или в ожидании
+        self._tasks: set = set()
+        self._room: Optional[asyncio.Condition] = None
+        self.in_flight = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.shed = 0
+        self.processed = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.refused = 0  # поллинг не отдал: приём уже закрыт
+        self.closed = False
+
+    def submit(self, update) -> bool:
+        """Не ждёт: при limit апдейтов в работе возвращает False."""
+        if self.closed:
+            return False
+        if self.in_flight >= self.limit:
+            self.rejected += 1
+            return False
+        self._start(update)
+        return True
+
+    async def submit_wait(self, update) -> bool:
+        """Для поллинга: ждёт свободного места. False — приём закрыт, апдейт не взят."""
+        if self._room is None:
+            self._room = asyncio.Condition()
+        async with self._room:
+            await self._room.wait_for(lambda: self.closed or self.in_flight < self.limit)
+        if self.closed:
+            self.refused += 1
+            return False
+        self._start(update)
+        return True
+
+    async def close(self) -> None:
+        """Закрывает приём; ждущие места submit_wait получают отказ."""
+        self.closed = True
+        if self._room is not None:
+            async with self._room:
+                self._room.notify_all()
+
+    async def drain(self, timeout: float) -> Dict[str, int]:
+        """Закрывает приём и ждёт апдейты в работе, но не дольше timeout секунд."""
+        await self.close()
+        processed = self.processed
+        pending = self.in_flight
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+        return {
+            "pending": pending,
+            "drained": self.processed - processed,
+            "queued_left": 0,
+            "in_flight_left": self.in_flight,
+            "refused": self.refused,
+        }
+
+    def _start(self, update) -> None:
+        key = update_chat_id(update)
+        if key is None:
+            key = ("update", update.update_id)
+        self.in_flight += 1
+        self.accepted += 1
+        self._holders[key] = self._holders.get(key, 0) + 1
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        task = asyncio.create_task(self._run(key, lock, update, time.monotonic()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key: object, lock: asyncio.Lock, update, enqueued_at: float) -> None:
+        try:
+            async with lock:
+                waited = time.monotonic() - enqueued_at
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                try:
+                    if isinstance(key, int) and (core.STATE_LAZY or store.has_message_log()):
+                        # промах U() и хвост истории читаются из базы синхронно — не в loop
+                        await asyncio.to_thread(core.prefetch_user, key)
+                    await process_updates_now([update])
+                    if core.STATE_SHARED and isinstance(key, int):
+                        await asyncio.to_thread(core.flush_chat, key)
+                except Exception as exc:
+                    self.failed += 1
+                    logging.exception("update %s failed: %r", update.update_id, exc)
+        finally:
+            self.in_flight -= 1
+            self.processed += 1
+            self._holders[key] -= 1
+            if not self._holders[key]:
+                del self._holders[key]
+                del self._locks[key]
+            if self._room is not None:
+                async with self._room:
+                    self._room.notify_all()
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "runtime": "async",
+            "in_flight": self.in_flight,
+            "limit": self.limit,
+            "active_chats": len(self._holders),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "shed": self.shed,
+            "processed": self.processed,
+            "failed": self.failed,
+            "refused": self.refused,
+            "wait_avg_ms": round(self.wait_total / self.processed * 1000, 1) if self.processed else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 1),
+        }
+
+
+dispatcher = AsyncUpdateDispatcher(ASYNC_MAX_UPDATES)
+
+# исходный AsyncTeleBot.process_new_updates: выполняет хендлеры сразу
+process_updates_now = abot.process_new_updates
+
+
+async def claim_update(update_id: int) -> bool:
+    """update_deduper.claim; с общей таблицей в Postgres — вне event loop."""
+    if update_deduper.shared:
+        return await asyncio.to_thread(update_deduper.claim, update_id)
+    return update_deduper.claim(update_id)
+
+
+async def release_update(update_id: int) -> None:
+    if update_deduper.shared:
+        await asyncio.to_thread(update_deduper.release, update_id)
+    else:
+        update_deduper.release(update_id)
+
+
+def accept_update(update) -> bool:
+    """Как Lumi.accept_update, но для dispatcher. False — вернуть Telegram на повтор."""
+    if dispatcher.closed:
+        return False
+    if WEBHOOK_OVERLOAD == "shed":
+        near_full = dispatcher.in_flight >= dispatcher.limit * WEBHOOK_SHED_AT
+        if near_full and is_free_tier(update_chat_id(update)):
+            dispatcher.shed += 1
+            logging.warning("overload: shed free-tier update %s", update.update_id)
+            return True
+    if dispatcher.submit(update):
+        return True
+    logging.warning("overload: %d updates in flight, asking Telegram to retry", dispatcher.limit)
+    return False
+
+
+polling_offset: Optional[int] = None  # следующий offset; подтверждается при остановке
+
+
+async def poll_updates() -> None:
+    """Цикл getUpdates, как Lumi.poll_updates, но в event loop.
+
+    Апдейт подтверждается (offset сдвигается за него) только после того, как
+    dispatcher его принял. Пока места нет, следующий getUpdates не уходит:
+    непринятые апдейты копятся у Telegram, а не в памяти процесса.
+    """
+    global polling_offset
+    offset: Optional[int] = None
+    backoff = 1.0
+    # skip_pending: всё, что накопилось до старта, подтверждаем без обработки
+    try:
+        skipped = await abot.get_updates(offset=-1, timeout=0, request_timeout=10)
+        if skipped:
+            offset = skipped[-1].update_id + 1
+    except Exception as exc:
+        logging.warning("skip pending updates failed: %r", exc)
+    while not dispatcher.closed:
+        try:
+            updates = await abot.get_updates(
+                offset=offset,
+                limit=POLLING_LIMIT,
+                timeout=POLLING_TIMEOUT,
+                request_timeout=POLLING_TIMEOUT + 10,
+            )
+        except Exception as exc:
+            logging.warning("getUpdates failed: %r, retry in %.0fs", exc, backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        backoff = 1.0
+        for update in updates:
+            if not await dispatcher.submit_wait(update):
+                return  # приём закрыт: остальные апдейты пачки Telegram отдаст заново
+            offset = polling_offset = update.update_id + 1
+
+
+# ================== ВЕБХУК ==================
+async def telegram_webhook(request: web.Request) -> web.Response:
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        raise web.HTTPForbidden()
+    try:
+        update_json = await request.text()
+        update = types.Update.de_json(update_json)
+    except web.HTTPException:
+        raise  # 413: тело больше WEBHOOK_MAX_BODY
+    except Exception as exc:
+        logging.exception("Invalid update: %r", exc)
+        raise web.HTTPBadRequest()
+    log_update(update, update_json)
+    if dispatcher.closed:
+        # останавливаемся: Telegram доставит апдейт заново, уже другому инстансу
+        return web.Response(status=503, text="shutting down", headers={"Retry-After": "5"})
+    if not await claim_update(update.update_id):
+        logging.info("duplicate update %s dropped", update.update_id)
+        return web.Response(text="ok")
+    if not accept_update(update):
+        await release_update(update.update_id)
+        return web.Response(status=503, text="overloaded", headers={"Retry-After": "5"})
+    return web.Response(text="ok")
+
+
+async def healthcheck(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+async def metrics(request: web.Request) -> web.Response:
+    data: Dict[str, object] = {
+        "updates": dispatcher.stats(),
+        "dedup": update_deduper.stats(),
+        "dirty_users": dirty_count(),
+        "log_dropped": core.dropped_log_records(),
+        "stream": core.stream_metrics(),
+        "openai_breakers": core.breaker_stats(),
+        "openai_limits": core.limiter_stats(),
+        "prompts": core.prompt_metrics(),
+    }
+    if core.STATE_SHARED:
+        data["shared_conflicts"] = core.shared_conflicts
+    if store.is_db():
+        data["db_pool"] = store.pool_stats()
+    return web.json_response(data)
+
+
+def make_app() -> web.Application:
+    app = web.Application(client_max_size=core.WEBHOOK_MAX_BODY)
+    app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    app.router.add_get("/health", healthcheck)
+    app.router.add_get("/metrics", metrics)
+    return app
+
+
+async def start_webhook() -> None:
+    try:
+        await abot.remove_webhook()
+    except Exception as exc:
+        logging.warning("remove_webhook failed: %r", exc)
+    await asyncio.sleep(1)
+
+    base_url = (WEBHOOK_URL or "").rstrip("/")
+    if not base_url.startswith("http"):
+        raise RuntimeError("WEBHOOK_URL не задан или некорректен (ожидается https://domain)")
+    full_url = base_url + WEBHOOK_PATH
+
+    ok = await abot.set_webhook(
+        url=full_url,
+        secret_token=WEBHOOK_SECRET or None,
+        drop_pending_updates=True,
+        allowed_updates=["message", "callback_query", "edited_message"],
+    )
+    print(f">>> webhook set to {full_url} (ok={ok})", flush=True)
+
+    ssl_context = None
+    if WEBHOOK_SSL_CERT and WEBHOOK_SSL_KEY:
+        import ssl
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(WEBHOOK_SSL_CERT, WEBHOOK_SSL_KEY)
+
+    runner = web.AppRunner(make_app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, ssl_context=ssl_context).start()
+    print(f">>> webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT} (async)", flush=True)
+    try:
+        await stopping().wait()
+        # сервер ещё слушает: новые апдейты получают 503, пока дорабатываем принятые
+        await drain_updates()
+    finally:
+        await runner.cleanup()
+
+
+async def start_polling() -> None:
+    try:
+        await abot.remove_webhook()
+    except Exception as exc:
+        logging.warning("remove_webhook failed: %r", exc)
+    await asyncio.sleep(1)
+    print(">>> polling… (async)", flush=True)
+    polling = asyncio.create_task(poll_updates())
+    stop = asyncio.create_task(stopping().wait())
+    await asyncio.wait({polling, stop}, return_when=asyncio.FIRST_COMPLETED)
+    stop.cancel()
+    # сначала перестаём брать апдейты, потом дорабатываем принятые
+    await dispatcher.close()
+    polling.cancel()
+    for result in await asyncio.gather(polling, return_exceptions=True):
+        if isinstance(result, Exception):
+            logging.error("polling stopped with error: %r", result)
+    await drain_updates()
+    if polling_offset is not None and not _shutdown["in_flight_left"]:
+        # подтверждаем обработанное, иначе следующий инстанс получит эти апдейты ещё раз
+        try:
+            await abot.get_updates(offset=polling_offset, limit=1, timeout=0, request_timeout=5)
+        except Exception as exc:
+            logging.warning("confirm polling offset failed: %r", exc)
+
+
+# ================== ОСТАНОВКА ==================
+_stop: Optional[asyncio.Event] = None
+_shutdown: Dict[str, int] = {}
+
+
+def stopping() -> asyncio.Event:
+    """Событие остановки; его выставляет SIGTERM (см. serve)."""
+    global _stop
+    if _stop is None:
+        _stop = asyncio.Event()
+    return _stop
+
+
+async def drain_updates() -> None:
+    started = time.monotonic()
+    logging.warning(
+        ">>> shutting down: draining %d in-flight updates (up to %gs)", dispatcher.in_flight, SHUTDOWN_TIMEOUT,
+    )
+    _shutdown.update(await dispatcher.drain(SHUTDOWN_TIMEOUT))
+    # не доработаны или не взяты из-за остановки (последние Telegram отдаст заново)
+    _shutdown["dropped"] = _shutdown["in_flight_left"] + _shutdown["refused"]
+    _shutdown["drain_ms"] = int((time.monotonic() - started) * 1000)
+
+
+async def serve() -> None:
+    """Вебхук или поллинг до SIGTERM, затем остановка как в Lumi.shutdown():
+    приём закрыт, принятые апдейты дорабатываются не дольше SHUTDOWN_TIMEOUT,
+    состояние дописывается в стор, HTTP-сессии и пул базы закрываются."""
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stopping().set)
+    warmup = asyncio.create_task(prewarm_http()) if HTTP_PREWARM else None  # ссылка держит задачу
+    try:
+        if WEBHOOK_URL and WEBHOOK_PORT:
+            await start_webhook()
+        else:
+            await start_polling()
+    finally:
+        if warmup is not None:
+            warmup.cancel()
+            await asyncio.gather(warmup, return_exceptions=True)
+        dirty = dirty_count()
+        await asyncio.to_thread(core.state_flusher.stop)
+        if _http is not None:
+            await _http.close()
+        await abot.close_session()
+        store.close()
+        if _shutdown:
+            logging.log(
+                logging.WARNING if _shutdown["dropped"] or dirty_count() else logging.INFO,
+                ">>> shutdown in %.1fs: drained %d of %d updates, dropped %d; flushed %d users, unsaved %d",
+                _shutdown["drain_ms"] / 1000, _shutdown["drained"], _shutdown["pending"],
+                _shutdown["dropped"], dirty, dirty_count(),
+            )
+
+
+def run() -> None:
+    """Запускает async-рантайм; стор, состояние и флашер уже подняты Lumi.main()."""
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    # Lumi.main() импортирует lumi_async — пусть это будет этот же модуль, а не вторая копия
+    import sys
+    sys.modules.setdefault("lumi_async", sys.modules[__name__])
+    core.main(runtime="async")
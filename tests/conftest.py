@@ -0,0 +1,32 @@
+# tests/conftest.py
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Lumi читает окружение при импорте: токен нужен TeleBot, стор — файловый во временной папке
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.pop("DATABASE_URL", None)
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ["STATE_FILE"] = os.path.join(tempfile.mkdtemp(prefix="lumi-tests-"), "users.json")
+
+import Lumi  # noqa: E402
+
+
+def _reset_dirty() -> None:
+    with Lumi._dirty_lock:
+        Lumi._dirty.clear()
+        Lumi._flushing.clear()
+        Lumi._dirty_refs.clear()
+        Lumi._pending_messages.clear()
+
+
+@pytest.fixture
+def lumi(monkeypatch):
+    """Lumi с пустой таблицей пользователей и пустыми очередями сброса."""
+    monkeypatch.setattr(Lumi, "users", Lumi.UserTable(4))
+    _reset_dirty()
+    yield Lumi
+    _reset_dirty()
@@ -0,0 +1,79 @@
+# tests/test_file_store.py
+import json
+import os
+
+from db_adapter import FileStore
+
+
+def _journal_line(chat_id, **fields):
+    return json.dumps({"chat_id": chat_id, "set": fields}) + "\n"
+
+
+def test_trim_torn_tail_drops_partial_line(tmp_path):
+    path = tmp_path / "users.json.journal"
+    path.write_text(_journal_line(1, language="en") + '{"chat_id": 2, "se')
+
+    FileStore._trim_torn_tail(str(path))
+
+    assert path.read_text() == _journal_line(1, language="en")
+
+
+def test_trim_torn_tail_keeps_complete_journal(tmp_path):
+    path = tmp_path / "users.json.journal"
+    content = _journal_line(1, language="en") + _journal_line(2, free_used=3)
+    path.write_text(content)
+
+    FileStore._trim_torn_tail(str(path))
+
+    assert path.read_text() == content
+
+
+def test_replay_after_torn_tail_does_not_glue_next_write(tmp_path):
+    path = str(tmp_path / "users.json")
+    with open(path + ".journal", "w", encoding="utf-8") as f:
+        f.write(_journal_line(1, language="en") + '{"chat_id": 1, "set": {"free_u')
+
+    store = FileStore(path, journal=True)
+    assert store.load_all() == [{"chat_id": 1, "language": "en"}]
+    store.update_fields(2, {"free_used": 1})
+    store.close()
+
+    reloaded = FileStore(path, journal=True)
+    rows = {row["chat_id"]: row for row in reloaded.load_all()}
+    assert rows == {1: {"chat_id": 1, "language": "en"}, 2: {"chat_id": 2, "free_used": 1}}
+
+
+def test_compact_folds_journal_into_snapshot(tmp_path):
+    path = str(tmp_path / "users.json")
+    store = FileStore(path, journal=True)
+    store.load_all()
+    store.upsert_users([{"chat_id": 1, "language": "ru", "free_used": 1}])
+    store.update_fields(1, {"free_used": 2})
+    store.update_fields(2, {"language": "en"})
+
+    store.compact()
+
+    assert not os.path.exists(store.journal_path)
+    assert not os.path.exists(store.rotated_journal_path)
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f) == {"1": {"language": "ru", "free_used": 2}, "2": {"language": "en"}}
+    rows = {row["chat_id"]: row for row in FileStore(path, journal=True).load_all()}
+    assert rows[1]["free_used"] == 2 and rows[2]["language"] == "en"
+
+
+def test_interrupted_compaction_is_finished_on_load(tmp_path):
+    # упали после rename журнала в .old, но до записи снапшота
+    path = str(tmp_path / "users.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"1": {"language": "ru", "free_used": 0}}, f)
+    with open(path + ".journal.old", "w", encoding="utf-8") as f:
+        f.write(_journal_line(1, free_used=1))
+    with open(path + ".journal", "w", encoding="utf-8") as f:
+        f.write(_journal_line(1, free_used=2))
+
+    store = FileStore(path, journal=True)
+    assert store.load_all() == [{"chat_id": 1, "language": "ru", "free_used": 2}]
+    assert not os.path.exists(store.journal_path)
+    assert not os.path.exists(store.rotated_journal_path)
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f) == {"1": {"language": "ru", "free_used": 2}}
@@ -0,0 +1,227 @@
+# tests/test_openai_limits.py
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import Lumi
+
+
+# ---------- CircuitBreaker ----------
+def _open_breaker(breaker):
+    for _ in range(breaker.failures):
+        assert breaker.allow()
+        breaker.settle(False)
+    assert breaker.state == "open"
+
+
+def test_breaker_half_open_lets_one_probe_through():
+    breaker = Lumi.CircuitBreaker("test", failures=2, cooldown=0)
+    _open_breaker(breaker)
+
+    assert breaker.allow()  # пробный запрос
+    assert breaker.state == "half-open" and breaker.probing
+    assert not breaker.allow()
+
+    breaker.settle(True)
+    assert breaker.state == "closed" and not breaker.probing
+    assert breaker.allow()
+
+
+def test_breaker_probe_without_outcome_is_released():
+    breaker = Lumi.CircuitBreaker("test", failures=1, cooldown=0)
+    _open_breaker(breaker)
+    assert breaker.allow()
+
+    breaker.settle(None)  # отменён или не дождался лимита
+
+    assert not breaker.probing
+    assert breaker.allow()
+
+
+def test_breaker_failed_probe_reopens():
+    breaker = Lumi.CircuitBreaker("test", failures=1, cooldown=60)
+    breaker.state, breaker.opened_at = "open", -60.0
+    assert breaker.allow()
+
+    breaker.settle(False)
+
+    assert breaker.state == "open" and not breaker.probing
+    assert not breaker.allow()
+
+
+class _Session:
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+
+    def post(self, url, **kwargs):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return _Response(outcome)
+
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def openai(monkeypatch):
+    breaker = Lumi.CircuitBreaker("chat", failures=3, cooldown=60)
+    monkeypatch.setitem(Lumi.openai_breakers, "chat", breaker)
+    monkeypatch.setattr(Lumi, "OPENAI_RETRIES", 2)
+    monkeypatch.setattr(Lumi, "retry_delay", lambda attempt, retry_after=None: 0)
+    monkeypatch.setattr(Lumi, "OPENAI_MODEL_LIMITS", {})
+    monkeypatch.setattr(Lumi, "_openai_limiters", {})
+
+    def post(*outcomes):
+        session = _Session(*outcomes)
+        monkeypatch.setattr(Lumi, "http_session", lambda upstream: session)
+        return Lumi.openai_post("chat", "http://openai.test", model="m", tokens=100)
+
+    post.breaker = breaker
+    return post
+
+
+def test_retries_of_one_call_count_as_one_failure(openai):
+    assert openai(requests.ConnectionError(), requests.ConnectionError(), requests.ConnectionError()) is None
+    assert openai.breaker.failed == 1 and openai.breaker.state == "closed"
+
+
+def test_probe_is_released_when_the_call_raises(openai):
+    openai.breaker.state, openai.breaker.opened_at = "open", -60.0
+    with pytest.raises(ValueError):
+        openai(ValueError("boom"))
+
+    assert openai.breaker.state == "half-open" and not openai.breaker.probing
+    assert openai.breaker.allow()
+
+
+# ---------- RateLimiter ----------
+@pytest.fixture
+def clock(monkeypatch):
+    """Остановленные часы для лимитера: вёдра пополняются только по advance()."""
+    now = [1000.0]
+    monkeypatch.setattr(Lumi, "time", SimpleNamespace(monotonic=lambda: now[0], sleep=time.sleep, time=time.time))
+
+    def advance(seconds):
+        now[0] += seconds
+
+    return advance
+
+
+def test_limiter_serves_higher_priority_first(clock):
+    limiter = Lumi.RateLimiter("m", rpm=60, tpm=0)
+    limiter.requests = 0.0
+    free = limiter.enqueue(3)
+    warm = limiter.enqueue(0)
+
+    clock(1.0)  # ровно одно место
+    assert limiter.poll(free, 0) > 0  # не голова очереди — ждёт, хотя место есть
+    assert limiter.poll(warm, 0) == 0
+    assert limiter.waiting == [free]
+    assert limiter.poll(free, 0) == pytest.approx(1.0)  # место ушло warm — ждёт следующего
+
+
+def test_limiter_is_fifo_within_a_tier(clock):
+    limiter = Lumi.RateLimiter("m", rpm=60, tpm=0)
+    first = limiter.enqueue(3)
+    second = limiter.enqueue(3)
+
+    assert limiter.poll(second, 0) > 0
+    assert limiter.poll(first, 0) == 0
+    assert limiter.poll(second, 0) == 0
+
+
+def test_limiter_waits_for_tokens_and_refund_returns_them(clock):
+    limiter = Lumi.RateLimiter("m", rpm=0, tpm=1000)
+    assert limiter.poll(limiter.enqueue(3), 600) == 0
+    assert limiter.tokens == 400
+
+    ticket = limiter.enqueue(3)
+    assert limiter.poll(ticket, 600) > 0
+
+    limiter.refund(600)
+    assert limiter.tokens == 1000
+    limiter.refund(600)
+    assert limiter.tokens == 1000  # не больше объёма ведра
+    assert limiter.poll(ticket, 600) == 0
+
+
+def test_rejected_attempts_are_refunded(openai, clock, monkeypatch):
+    monkeypatch.setattr(Lumi, "OPENAI_MODEL_LIMITS", {"m": (0, 1000)})
+
+    resp = openai(429, requests.ConnectionError(), 200)
+
+    assert resp.status_code == 200
+    assert Lumi.openai_limiter("m").tokens == 900
+
+
+def test_server_errors_keep_their_tokens(openai, clock, monkeypatch):
+    monkeypatch.setattr(Lumi, "OPENAI_MODEL_LIMITS", {"m": (0, 1000)})
+
+    openai(500, 200)
+
+    assert Lumi.openai_limiter("m").tokens == 800
+
+
+# ---------- fit_history ----------
+def _message(role, words):
+    return {"role": role, "content": " ".join(["word"] * words)}
+
+
+@pytest.fixture
+def estimate(monkeypatch):
+    # оценка ~4 символа на токен, без tiktoken: бюджеты в тестах не зависят от кодировки
+    monkeypatch.setattr(Lumi, "_encoding", None)
+
+
+def test_fit_history_keeps_everything_within_budget(estimate):
+    history = [_message("user", 5), _message("assistant", 5)]
+    assert Lumi.fit_history(history, 1000) == history
+
+
+def test_fit_history_keeps_newest_tail_in_order(estimate):
+    history = [_message("user", 50), _message("assistant", 50), _message("user", 10), _message("assistant", 10)]
+    tail_cost = sum(Lumi.message_tokens(m) for m in history[2:])
+
+    fitted = Lumi.fit_history(history, tail_cost + 10)
+
+    assert fitted == history[2:]
+
+
+def test_fit_history_truncates_the_first_message_that_does_not_fit(estimate):
+    history = [_message("user", 200), _message("assistant", 10)]
+    budget = Lumi.message_tokens(history[1]) + Lumi.MIN_TRUNCATED_TOKENS + 20
+
+    fitted = Lumi.fit_history(history, budget)
+
+    assert fitted[1] == history[1]
+    assert fitted[0]["role"] == "user" and fitted[0]["content"].endswith("…")
+    assert sum(Lumi.message_tokens(m) for m in fitted) <= budget
+
+
+def test_fit_history_drops_instead_of_keeping_a_stub(estimate):
+    history = [_message("user", 200), _message("assistant", 10)]
+    budget = Lumi.message_tokens(history[1]) + Lumi.MIN_TRUNCATED_TOKENS // 2
+
+    assert Lumi.fit_history(history, budget) == history[1:]
+
+
+def test_payload_history_is_trimmed_to_plan_budget(estimate, monkeypatch):
+    monkeypatch.setitem(Lumi.PLAN_BEHAVIOR, "free", dict(Lumi.PLAN_BEHAVIOR["free"], prompt_token_budget=400))
+    history = [_message("user" if n % 2 == 0 else "assistant", 60) for n in range(20)]
+    trimmed = Lumi.prompt_metrics()["trimmed"]
+
+    payload = Lumi.build_chat_payload("hi", history=history, plan="free")
+
+    sent_history = [m for m in payload["messages"] if m["role"] != "system"][:-1]
+    assert sent_history and sent_history == history[-len(sent_history):]
+    assert sum(Lumi.message_tokens(m) for m in payload["messages"][:-1]) <= 400
+    assert Lumi.prompt_metrics()["trimmed"] == trimmed + 1
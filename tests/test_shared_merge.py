@@ -0,0 +1,162 @@
+# tests/test_shared_merge.py
+import logging
+import os
+
+import pytest
+
+from db_adapter import COUNTER_COLUMNS, USER_COLUMNS, VERSIONED_COLUMNS, DbStore, FileStore
+
+
+class SharedFileStore(FileStore):
+    """FileStore с merge_users по контракту DbStore.merge_users (версия строки, CAS, счётчики приростом).
+
+    Нужен, чтобы прогнать путь STATE_SHARED в Lumi без Postgres.
+    """
+
+    def merge_users(self, changes):
+        results = []
+        with self._lock:
+            if self._data is None:
+                self.load_all()
+            for chat_id, fields, deltas, expected in changes:
+                row = self._data.get(str(chat_id))
+                conflicted = row is not None and row.get("version", 0) != expected
+                if row is None:
+                    row = self._data[str(chat_id)] = {"version": 0}
+                row.update({k: v for k, v in fields.items() if k not in COUNTER_COLUMNS})
+                for name, delta in deltas.items():
+                    row[name] = (row.get(name) or 0) + delta
+                row["version"] += 1
+                stored = {c: row.get(c) for c in USER_COLUMNS[1:]}
+                results.append((dict(stored, chat_id=chat_id, version=row["version"]), conflicted))
+        return results
+
+    def write_as_other_instance(self, chat_id, **fields):
+        with self._lock:
+            row = self._data.setdefault(str(chat_id), {"version": 0})
+            row.update(fields)
+            row["version"] += 1
+
+
+@pytest.fixture
+def shared(lumi, monkeypatch, tmp_path):
+    store = SharedFileStore(str(tmp_path / "users.json"))
+    store.load_all()
+    monkeypatch.setattr(lumi, "STATE_SHARED", True)
+    monkeypatch.setattr(lumi, "store", store)
+    monkeypatch.setattr(lumi, "shared_conflicts", 0)
+    return store
+
+
+def _read_user(lumi, store, chat_id):
+    row = store.load_one(chat_id)
+    info = lumi.UserState(str(chat_id), row)
+    return lumi.users.setdefault(str(chat_id), info)
+
+
+def test_counter_deltas_from_two_instances_both_count(lumi, shared):
+    shared.write_as_other_instance(42, free_used=3)
+    info = _read_user(lumi, shared, 42)
+
+    shared.write_as_other_instance(42, free_used=5)  # другой инстанс: +2
+    info.free_used += 1
+    lumi.flush_chat(42)
+
+    assert shared.load_one(42)["free_used"] == 6
+    assert info.free_used == 6
+    assert info.counter_deltas({"free_used"}) == {"free_used": 0}
+    assert lumi.shared_conflicts == 1
+
+
+def test_unconflicted_write_is_not_counted_as_conflict(lumi, shared):
+    shared.write_as_other_instance(42, free_used=1)
+    info = _read_user(lumi, shared, 42)
+
+    info.free_used += 1
+    lumi.flush_chat(42)
+    info.free_used += 1
+    lumi.flush_chat(42)
+
+    assert shared.load_one(42)["free_used"] == 3
+    assert lumi.shared_conflicts == 0
+
+
+def test_different_fields_from_two_instances_both_survive(lumi, shared):
+    shared.write_as_other_instance(42, language="ru", news_opt_out=False)
+    info = _read_user(lumi, shared, 42)
+
+    shared.write_as_other_instance(42, language="en")
+    info.news_opt_out = True
+    lumi.flush_chat(42)
+
+    stored = shared.load_one(42)
+    assert stored["language"] == "en" and stored["news_opt_out"] is True
+    assert info.language == "en"  # чужое поле подтянулось после записи
+
+
+def test_same_field_last_writer_wins(lumi, shared):
+    shared.write_as_other_instance(42, language="ru")
+    info = _read_user(lumi, shared, 42)
+
+    shared.write_as_other_instance(42, language="en")
+    info.language = "uk"
+    lumi.flush_chat(42)
+
+    assert shared.load_one(42)["language"] == "uk"
+    assert lumi.shared_conflicts == 1
+
+
+def test_sync_keeps_unwritten_local_fields(lumi):
+    info = lumi.UserState("42", {"language": "ru", "free_used": 2, "version": 1})
+    object.__setattr__(info, "base", {c: getattr(info, c) or 0 for c in COUNTER_COLUMNS})
+    info.set_cached("language", "uk")
+    info.set_cached("free_used", 3)
+
+    info.sync({"language": "en", "free_used": 4, "version": 2}, keep={"language"})
+
+    assert info.language == "uk"
+    assert info.free_used == 5  # 4 из стора + свой незаписанный прирост
+    assert info.version == 2
+
+
+# ---------- DbStore.merge_users против настоящего Postgres ----------
+@pytest.fixture(scope="module")
+def db_store(tmp_path_factory):
+    url = os.getenv("TEST_DATABASE_URL")
+    server = None
+    if not url:
+        pgserver = pytest.importorskip("pgserver")
+        logging.getLogger("pgserver").setLevel(logging.WARNING)  # его поток пишет в лог уже после pytest
+        server = pgserver.get_server(str(tmp_path_factory.mktemp("pg")), cleanup_mode="stop")
+        url = server.get_uri()
+    store = DbStore(url, pool_max=0)
+    store.init_schema()
+    yield store
+    with store.connection() as conn:
+        conn.execute("DELETE FROM users WHERE chat_id IN (9001, 9002)")
+        conn.commit()
+    store.close()
+    if server is not None:
+        server.cleanup()
+
+
+def test_db_merge_users_cas_and_counter_deltas(db_store):
+    (row, conflicted), = db_store.merge_users([(9001, {"language": "ru"}, {"free_used": 2}, None)])
+    assert not conflicted and row["free_used"] == 2
+    version = row["version"]
+
+    (row, conflicted), = db_store.merge_users([(9001, {"language": "en"}, {"free_used": 1}, version)])
+    assert not conflicted and row["version"] == version + 1
+
+    # устаревшая версия: запись всё равно проходит, прирост добавляется, конфликт отмечен
+    (row, conflicted), = db_store.merge_users([(9001, {"news_opt_out": True}, {"free_used": 1}, version)])
+    assert conflicted
+    assert row["free_used"] == 4 and row["language"] == "en" and row["news_opt_out"] is True
+    assert set(row) == set(VERSIONED_COLUMNS)
+
+
+def test_db_merge_users_insert_race_counts_both_deltas(db_store):
+    # два инстанса не видели строки: второй INSERT упирается в конфликт и сливается
+    db_store.merge_users([(9002, {}, {"abuse_strikes": 1}, None)])
+    (row, conflicted), = db_store.merge_users([(9002, {}, {"abuse_strikes": 1}, None)])
+    assert conflicted and row["abuse_strikes"] == 2
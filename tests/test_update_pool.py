@@ -0,0 +1,76 @@
+# tests/test_update_pool.py
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import Lumi
+
+
+def _update(update_id, chat_id):
+    message = SimpleNamespace(chat=SimpleNamespace(id=chat_id))
+    return SimpleNamespace(update_id=update_id, message=message, edited_message=None, callback_query=None)
+
+
+def test_same_chat_updates_run_in_order_one_at_a_time(monkeypatch):
+    seen = {1: [], 2: []}
+    running = {1: 0, 2: 0}
+    overlaps = []
+    lock = threading.Lock()
+
+    def handle(updates):
+        update, = updates
+        chat_id = update.message.chat.id
+        with lock:
+            running[chat_id] += 1
+            if running[chat_id] > 1:
+                overlaps.append(update.update_id)
+        time.sleep(random.uniform(0, 0.003))
+        with lock:
+            running[chat_id] -= 1
+            seen[chat_id].append(update.update_id)
+
+    monkeypatch.setattr(Lumi, "process_updates_now", handle)
+    pool = Lumi.UpdateWorkerPool(workers=4, queue_size=200)
+    pool.start()
+    for n in range(40):
+        assert pool.submit(_update(n, 1 + n % 2))
+
+    assert pool.drain(10)["in_flight_left"] == 0
+    assert seen[1] == list(range(0, 40, 2))
+    assert seen[2] == list(range(1, 40, 2))
+    assert overlaps == []
+    assert pool.stats()["failed"] == 0
+
+
+def test_different_chats_run_in_parallel(monkeypatch):
+    # каждый хендлер ждёт остальных: пройдут, только если все четыре идут одновременно
+    barrier = threading.Barrier(4, timeout=5)
+
+    def handle(updates):
+        barrier.wait()
+
+    monkeypatch.setattr(Lumi, "process_updates_now", handle)
+    pool = Lumi.UpdateWorkerPool(workers=4, queue_size=10)
+    pool.start()
+    for chat_id in range(4):
+        assert pool.submit(_update(chat_id, chat_id))
+
+    assert pool.drain(10)["drained"] == 4
+    assert not barrier.broken
+    assert pool.stats()["failed"] == 0
+
+
+def test_full_queue_rejects_without_blocking(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(Lumi, "process_updates_now", lambda updates: release.wait(5))
+    pool = Lumi.UpdateWorkerPool(workers=1, queue_size=1)
+    pool.start()
+    assert pool.submit(_update(1, 1))
+    time.sleep(0.05)  # первый апдейт уже у воркера, очередь пуста
+    assert pool.submit(_update(2, 1))
+    assert not pool.submit(_update(3, 1))
+    release.set()
+
+    assert pool.drain(5)["drained"] == 2
+    assert pool.stats()["rejected"] == 1
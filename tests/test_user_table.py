@@ -0,0 +1,22 @@
+# tests/test_user_table.py
+import Lumi
+
+
+def test_contains_accepts_int_and_str_chat_ids():
+    table = Lumi.UserTable(4)
+    table.setdefault("12345", Lumi.UserState("12345"))
+
+    assert 12345 in table and "12345" in table
+    assert 54321 not in table
+
+
+def test_lru_keeps_chats_with_unsaved_changes(lumi):
+    table = Lumi.UserTable(1, capacity=2)
+    lumi.mark_dirty("1", "language")
+    lumi.queue_messages(2, ("user", "hi"))
+
+    for n in range(1, 6):
+        table.setdefault(str(n), Lumi.UserState(str(n)))
+
+    assert 1 in table and 2 in table  # грязное поле и реплика в очереди держат чат
+    assert 5 in table and len(table) == 3